@@ -1,15 +1,30 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 
 from .forms import UserAdminCreationForm, UserAdminChangeForm
-from .models import EmailActivation, News
+from .models import EmailActivation, News, Settlement, OutgoingEmail
 
 
 User = get_user_model()
 
 
+def settlement_action(kind, description):
+    """ Admin action running a settlement over the selected users in the background """
+    def action(modeladmin, request, queryset):
+        settlement = Settlement.objects.settle_async(kind, user_ids=list(queryset.values_list('pk', flat=True)))
+        modeladmin.message_user(
+            request,
+            '{kind} started for {users} users (run {run_id}). Rows processed and elapsed time are shown in '
+            'Settlements.'.format(kind=settlement.get_kind_display(), users=settlement.users, run_id=settlement.run_id),
+            messages.SUCCESS
+        )
+    action.short_description = description
+    action.__name__ = 'settle_{kind}'.format(kind=kind)
+    return action
+
+
 class UserAdmin(BaseUserAdmin):
     # The forms to change and add user instances
     form = UserAdminChangeForm
@@ -39,6 +54,11 @@ class UserAdmin(BaseUserAdmin):
     search_fields = ('username', 'email', 'full_name')
     ordering = ('username', 'email')
     filter_horizontal = ()
+    actions = [
+        settlement_action('tax', 'Deduct income tax of selected users'),
+        settlement_action('interest', 'Deduct loan interest of selected users'),
+        settlement_action('loan', 'Cancel loans of selected users'),
+    ]
 
 
 admin.site.register(User, UserAdmin)
@@ -57,3 +77,29 @@ class EmailActivationAdmin(admin.ModelAdmin):
 admin.site.register(EmailActivation, EmailActivationAdmin)
 
 admin.site.register(News)
+
+
+class SettlementAdmin(admin.ModelAdmin):
+    list_display = ('run_id', 'kind', 'status', 'users', 'rows', 'elapsed', 'timestamp')
+    list_filter = ('kind', 'status')
+    search_fields = ['run_id']
+    readonly_fields = ('run_id', 'kind', 'status', 'users', 'rows', 'elapsed', 'timestamp', 'updated')
+
+    class Meta:
+        model = Settlement
+
+
+admin.site.register(Settlement, SettlementAdmin)
+
+
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ('recipients', 'subject', 'status', 'attempts', 'next_attempt', 'sent_at')
+    list_filter = ('status', )
+    search_fields = ['recipients', 'subject']
+    readonly_fields = ('attempts', 'last_error', 'sent_at', 'timestamp', 'updated')
+
+    class Meta:
+        model = OutgoingEmail
+
+
+admin.site.register(OutgoingEmail, OutgoingEmailAdmin)
@@ -0,0 +1,34 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from accounts.models import welford_update, coefficient_of_variation
+from market.models import Transaction
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Rebuild every user's net worth running statistics and coefficient of variation from transaction history"
+
+    def handle(self, *args, **options):
+        stats = {}
+        history = Transaction.objects.order_by('user_id', 'timestamp', 'id').values_list('user_id', 'user_net_worth')
+        for user_id, net_worth in history.iterator():  # single pass over the history
+            stats[user_id] = welford_update(*stats.get(user_id, (0, 0.0, 0.0)), float(net_worth))
+
+        with transaction.atomic():
+            User.objects.exclude(pk__in=list(stats)).update(
+                net_worth_count=0, net_worth_mean=0.0, net_worth_m2=0.0, coeff_of_variation=0.00
+            )
+            for user_id, (count, mean, m2) in stats.items():
+                User.objects.filter(pk=user_id).update(
+                    net_worth_count=count,
+                    net_worth_mean=mean,
+                    net_worth_m2=m2,
+                    coeff_of_variation=coefficient_of_variation(count, mean, m2)
+                )
+        self.stdout.write('Rebuilt statistics of {users} users from {transactions} transactions'.format(
+            users=len(stats), transactions=sum(count for count, _, _ in stats.values())
+        ))
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.outbox import send_queued, OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL
+
+
+class Command(BaseCommand):
+    help = 'Send the queued emails of the outbox (each batch over one SMTP connection)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=OUTBOX_BATCH_SIZE)
+        parser.add_argument('--loop', action='store_true', help='Keep polling the outbox instead of exiting')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = send_queued(options['batch_size'])
+            if sent or failed or not options['loop']:
+                self.stdout.write('{sent} emails sent, {failed} failed'.format(sent=sent, failed=failed))
+            if not options['loop']:
+                return
+            time.sleep(OUTBOX_POLL_INTERVAL)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.models import Settlement, SettlementConflict, SETTLEMENT_KINDS
+
+
+class Command(BaseCommand):
+    help = 'Apply a settlement (tax, interest or loan cancellation) to every user. A run id is applied only once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=[kind for kind, _ in SETTLEMENT_KINDS])
+        parser.add_argument('--run-id', help='Idempotency key of the run, a random one is used if omitted')
+
+    def handle(self, *args, **options):
+        try:
+            settlement = Settlement.objects.settle(options['kind'], run_id=options['run_id'])
+        except SettlementConflict as e:
+            raise CommandError(str(e))
+        self.stdout.write('{settlement}: {status}, {rows} rows processed in {elapsed:.4f}s'.format(
+            settlement=settlement, status=settlement.get_status_display(), rows=settlement.rows,
+            elapsed=settlement.elapsed or 0
+        ))
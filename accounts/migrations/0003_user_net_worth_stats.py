@@ -0,0 +1,28 @@
+# Generated by Django 2.0.2 on 2026-10-18 16:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_auto_20180512_1727'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='net_worth_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='net_worth_m2',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='net_worth_mean',
+            field=models.FloatField(default=0.0),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.0.2 on 2026-10-18 16:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_user_net_worth_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Settlement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_id', models.CharField(max_length=64, unique=True)),
+                ('kind', models.CharField(choices=[('tax', 'Income Tax'), ('interest', 'Loan Interest'), ('loan', 'Loan Cancellation')], max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done')], default='pending', max_length=20)),
+                ('users', models.IntegerField(blank=True, null=True)),
+                ('rows', models.IntegerField(default=0)),
+                ('elapsed', models.FloatField(blank=True, null=True)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['-timestamp'],
+            },
+        ),
+    ]
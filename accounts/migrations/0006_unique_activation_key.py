@@ -0,0 +1,18 @@
+# Generated by Django 2.0.2 on 2026-10-18 16:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_outgoing_email'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emailactivation',
+            name='key',
+            field=models.CharField(blank=True, max_length=120, null=True, unique=True),
+        ),
+    ]
@@ -1,28 +1,69 @@
+import math
+import threading
+import time
+import uuid
 from datetime import timedelta
 from decimal import Decimal
-import numpy as np
 
 from django.conf import settings
-from django.db import models
-from django.db.models import Q
-from django.db.models.signals import pre_save, post_save
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models import Q, F
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.core.cache import cache
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.utils import timezone
-from django.core.mail import send_mail
 from django.urls import reverse
 from django.template.loader import get_template
 
-from stock_bridge.utils import unique_key_generator
+from stock_bridge.cache import bump_page_version
+from stock_bridge.utils import secure_key_generator
+from .outbox import wake_outbox_worker
 
 
 DEFAULT_ACTIVATION_DAYS = getattr(settings, 'DEFAULT_ACTIVATION_DAYS', 7)
 DEFAULT_LOAN_AMOUNT = getattr(settings, 'DEFAULT_LOAN_AMOUNT', Decimal(10000.00))
 RATE_OF_INTEREST = getattr(settings, 'RATE_OF_INTEREST', Decimal(0.15))
+TAX_RATE = getattr(settings, 'TAX_RATE', Decimal(0.40))
 MAX_LOAN_ISSUE = getattr(settings, 'MAX_LOAN_ISSUE')
+NEWS_COUNT_TIMEOUT = getattr(settings, 'NEWS_COUNT_TIMEOUT', 60)  # seconds
+SETTLEMENT_BATCH_SIZE = getattr(settings, 'SETTLEMENT_BATCH_SIZE', 500)  # selected users per UPDATE
+KEY_INSERT_ATTEMPTS = 3  # activation inserts retried with a new key on a (practically impossible) collision
+
+
+def welford_update(count, mean, m2, value):
+    """ Add one sample to running statistics (count, mean, sum of squared deviations) - Welford's algorithm """
+    count += 1
+    delta = value - mean
+    mean += delta / count
+    m2 += delta * (value - mean)
+    return count, mean, m2
+
+
+def coefficient_of_variation(count, mean, m2):
+    """ Population std / mean of the running statistics (same as np.std(samples) / np.mean(samples)) """
+    if count == 0 or mean == 0:
+        return Decimal(0.00)
+    return Decimal(math.sqrt(m2 / count) / mean)
+
+
+class UserQuerySet(models.query.QuerySet):
+    """ Set-based bank operations, each one is a single UPDATE over the queryset """
+
+    def deduct_tax(self):
+        return self.update(cash=F('cash') - F('cash') * TAX_RATE)
+
+    def deduct_interest(self):
+        return self.update(cash=F('cash') - F('loan') * RATE_OF_INTEREST)
+
+    def cancel_loan(self):
+        return self.update(cash=F('cash') - F('loan'), loan=Decimal(0.00), loan_count=0, loan_count_absolute=0)
 
 
 class UserManager(BaseUserManager):
 
+    def get_queryset(self):
+        return UserQuerySet(self.model, using=self._db)
+
     def create_user(self, username, email, password=None, full_name=None, is_active=True, is_staff=False, is_superuser=False):
         if not username:
             raise ValueError('Users must have a unique username.')
@@ -75,6 +116,10 @@ class User(AbstractBaseUser):
     loan_count = models.IntegerField(default=1)  # For arithmetic interest calculation
     loan_count_absolute = models.IntegerField(default=1)  # For overall loan issue count
     coeff_of_variation = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)  # For tie breaker in leaderboard
+    # Running statistics of the user's net worth after each transaction, used to update coeff_of_variation
+    net_worth_count = models.IntegerField(default=0)
+    net_worth_mean = models.FloatField(default=0.0)
+    net_worth_m2 = models.FloatField(default=0.0)  # sum of squared deviations from the mean
     is_active = models.BooleanField(default=True)
     staff = models.BooleanField(default=False)
     is_superuser = models.BooleanField(default=False)
@@ -156,9 +201,18 @@ class User(AbstractBaseUser):
         self.cash -= compound_interest
         self.save()
 
-    def update_cv(self, net_worth_list):
-        self.coeff_of_variation = Decimal(np.std(net_worth_list) / np.mean(net_worth_list))
-        self.save()
+    def update_cv(self, net_worth):
+        """ Add the net worth after a transaction to the running statistics and update the CV in O(1) """
+        with transaction.atomic():
+            stats = User.objects.select_for_update().filter(pk=self.pk).values_list(
+                'net_worth_count', 'net_worth_mean', 'net_worth_m2'
+            ).get()
+            self.net_worth_count, self.net_worth_mean, self.net_worth_m2 = welford_update(*stats, float(net_worth))
+            self.coeff_of_variation = coefficient_of_variation(
+                self.net_worth_count, self.net_worth_mean, self.net_worth_m2
+            )
+            # don't overwrite cash changed by concurrent orders
+            self.save(update_fields=['net_worth_count', 'net_worth_mean', 'net_worth_m2', 'coeff_of_variation'])
 
 
 class EmailActivationQuerySet(models.query.QuerySet):
@@ -197,7 +251,7 @@ class EmailActivationManager(models.Manager):
 class EmailActivation(models.Model):
     user = models.ForeignKey(User, on_delete=True)
     email = models.EmailField()
-    key = models.CharField(max_length=120, blank=True, null=True)  # activation key
+    key = models.CharField(max_length=120, blank=True, null=True, unique=True)  # activation key
     activated = models.BooleanField(default=False)
     forced_expire = models.BooleanField(default=False)  # link expired manually
     expires = models.IntegerField(default=7)  # automatic expire (after days)
@@ -209,6 +263,20 @@ class EmailActivation(models.Model):
     def __str__(self):
         return self.email
 
+    def save(self, *args, **kwargs):
+        """ Insert with a new key if the generated one collides with an existing key """
+        if self.pk is not None:
+            return super(EmailActivation, self).save(*args, **kwargs)
+        for attempt in range(KEY_INSERT_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    return super(EmailActivation, self).save(*args, **kwargs)
+            except IntegrityError:
+                if attempt == KEY_INSERT_ATTEMPTS - 1:
+                    raise
+                self.pk = None
+                self.key = secure_key_generator()
+
     def can_activate(self):
         qs = EmailActivation.objects.filter(pk=self.pk).confirmable()
         if qs.exists():
@@ -240,21 +308,20 @@ class EmailActivation(models.Model):
                 subject = 'Morphosis Stock Bridge - Verify your Account'
                 from_email = settings.DEFAULT_FROM_EMAIL
                 recipient_list = [self.email]
-                sent_mail = send_mail(
+                # queued in the outbox and sent by a background worker, see accounts.outbox
+                return OutgoingEmail.objects.enqueue(
                     subject,
                     txt_,  # If content_type is text/plain
                     from_email,
                     recipient_list,
-                    html_message=html_,  # If content_type is text/html
-                    fail_silently=False  # If false, then an email will be sent if error occurs while sending the email
+                    html_message=html_  # If content_type is text/html
                 )
-                return sent_mail
         return False
 
 
 def pre_save_email_activation_receiver(sender, instance, *args, **kwargs):
     if not instance.activated and not instance.forced_expire and not instance.key:
-        instance.key = unique_key_generator(instance)
+        instance.key = secure_key_generator()
 
 pre_save.connect(pre_save_email_activation_receiver, sender=EmailActivation)
 
@@ -267,6 +334,35 @@ def post_save_user_create_receiver(sender, instance, created, *args, **kwargs):
 post_save.connect(post_save_user_create_receiver, sender=User)
 
 
+ACTIVE_NEWS_COUNT_KEY = 'accounts:active_news_count'
+
+
+class NewsQuerySet(models.query.QuerySet):
+
+    def active(self):
+        return self.filter(is_active=True)
+
+
+class NewsManager(models.Manager):
+
+    def get_queryset(self):
+        return NewsQuerySet(self.model, using=self._db)
+
+    def active(self):
+        return self.get_queryset().active()
+
+    def active_count(self):
+        """
+        Number of active news, kept in the shared cache until a news is saved or deleted, or for at most
+        NEWS_COUNT_TIMEOUT seconds (news changed with queryset.update() send no signal)
+        """
+        count = cache.get(ACTIVE_NEWS_COUNT_KEY)
+        if count is None:
+            count = self.active().count()
+            cache.set(ACTIVE_NEWS_COUNT_KEY, count, NEWS_COUNT_TIMEOUT)
+        return count
+
+
 class News(models.Model):
     title = models.CharField(max_length=120)
     content = models.TextField()
@@ -274,8 +370,173 @@ class News(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    objects = NewsManager()
+
     class Meta:
         ordering = ['-timestamp', '-updated']
 
     def __str__(self):
         return self.title
+
+
+def news_change_receiver(sender, instance, *args, **kwargs):
+    cache.delete(ACTIVE_NEWS_COUNT_KEY)
+    bump_page_version()
+
+post_save.connect(news_change_receiver, sender=News)
+post_delete.connect(news_change_receiver, sender=News)
+
+
+SETTLEMENT_KINDS = (
+    ('tax', 'Income Tax'),
+    ('interest', 'Loan Interest'),
+    ('loan', 'Loan Cancellation')
+)
+
+SETTLEMENT_STATUS = (
+    ('pending', 'Pending'),
+    ('done', 'Done')
+)
+
+SETTLEMENT_OPERATIONS = {
+    'tax': UserQuerySet.deduct_tax,
+    'interest': UserQuerySet.deduct_interest,
+    'loan': UserQuerySet.cancel_loan
+}
+
+
+class SettlementConflict(Exception):
+    """ A run id was reused for a settlement of another kind """
+
+
+class SettlementManager(models.Manager):
+
+    def settle(self, kind, run_id=None, user_ids=None):
+        """
+        Run a settlement over every user (or only user_ids). A run id is applied at most once, so calling it
+        again with the same run_id returns the recorded settlement without touching any balance.
+        """
+        settlement = self.start(kind, run_id, user_ids)
+        settlement.apply(user_ids)
+        return settlement
+
+    def settle_async(self, kind, run_id=None, user_ids=None):
+        """ Same as settle(), but the balances are updated in a background thread """
+        settlement = self.start(kind, run_id, user_ids)
+        thread = threading.Thread(target=settlement.apply_in_background, args=(user_ids, ))
+        transaction.on_commit(thread.start)
+        return settlement
+
+    def start(self, kind, run_id=None, user_ids=None):
+        """ Record the run, or return the recorded one. Raises SettlementConflict if its kind is not 'kind'. """
+        settlement, created = self.get_or_create(
+            run_id=run_id or uuid.uuid4().hex,
+            defaults={'kind': kind, 'users': len(user_ids) if user_ids is not None else None}
+        )
+        if settlement.kind != kind:
+            raise SettlementConflict('Run {run_id} is a {kind} settlement.'.format(
+                run_id=settlement.run_id, kind=settlement.get_kind_display()
+            ))
+        return settlement
+
+
+class Settlement(models.Model):
+    """ A settlement run (tax, interest or loan cancellation) applied to all users with a single UPDATE """
+    run_id = models.CharField(max_length=64, unique=True)
+    kind = models.CharField(max_length=20, choices=SETTLEMENT_KINDS)
+    status = models.CharField(max_length=20, choices=SETTLEMENT_STATUS, default='pending')
+    users = models.IntegerField(blank=True, null=True)  # number of selected users, empty for all users
+    rows = models.IntegerField(default=0)  # rows processed
+    elapsed = models.FloatField(blank=True, null=True)  # seconds
+    timestamp = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = SettlementManager()
+
+    class Meta:
+        ordering = ['-timestamp']
+
+    def __str__(self):
+        return '{kind} - {run_id}'.format(kind=self.get_kind_display(), run_id=self.run_id)
+
+    def apply(self, user_ids=None):
+        """ Apply the settlement if it has not been applied yet. Returns True if balances were changed. """
+        from market.models import UserNetWorth
+
+        start = time.perf_counter()
+        with transaction.atomic():
+            # claim the run, concurrent or repeated calls find it already done
+            if not Settlement.objects.filter(pk=self.pk, status='pending').update(status='done'):
+                self.refresh_from_db()
+                return False
+            if user_ids is None:
+                self.rows = SETTLEMENT_OPERATIONS[self.kind](User.objects.all())
+                UserNetWorth.objects.refresh()
+            else:
+                # the selected users are updated in batches, one pk__in of every admin selection could exceed
+                # the number of query parameters of the database
+                self.rows = 0
+                for i in range(0, len(user_ids), SETTLEMENT_BATCH_SIZE):
+                    batch = user_ids[i:i + SETTLEMENT_BATCH_SIZE]
+                    self.rows += SETTLEMENT_OPERATIONS[self.kind](User.objects.filter(pk__in=batch))
+                    UserNetWorth.objects.refresh(users=batch)
+            self.status = 'done'
+            self.elapsed = time.perf_counter() - start
+            self.save()
+        return True
+
+    def apply_in_background(self, user_ids=None):
+        try:
+            self.apply(user_ids)
+        finally:
+            connection.close()
+
+
+EMAIL_STATUS = (
+    ('queued', 'Queued'),
+    ('sending', 'Sending'),
+    ('sent', 'Sent'),
+    ('failed', 'Failed')
+)
+
+
+class OutgoingEmailManager(models.Manager):
+
+    def enqueue(self, subject, message, from_email, recipient_list, html_message=None):
+        """ Queue an email and wake the outbox worker once the current transaction commits """
+        email = self.create(
+            subject=subject,
+            body=message,
+            html_body=html_message or '',
+            from_email=from_email,
+            recipients=','.join(recipient_list)
+        )
+        transaction.on_commit(wake_outbox_worker)
+        return email
+
+
+class OutgoingEmail(models.Model):
+    """ Outbox of the emails sent by the site, delivered in the background by accounts.outbox """
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=255)
+    recipients = models.TextField()  # comma separated
+    status = models.CharField(max_length=20, choices=EMAIL_STATUS, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+    timestamp = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = OutgoingEmailManager()
+
+    class Meta:
+        ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='accounts_outbox_due_idx')
+        ]
+
+    def __str__(self):
+        return '{recipients}: {subject}'.format(recipients=self.recipients, subject=self.subject)
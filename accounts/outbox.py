@@ -0,0 +1,153 @@
+"""
+Background delivery of the email outbox (OutgoingEmail).
+
+Queued emails are claimed in batches and sent over a single SMTP connection per batch. A failed email is
+retried with exponential backoff (OUTBOX_RETRY_DELAY * 2 ** attempts, capped at OUTBOX_MAX_RETRY_DELAY)
+until OUTBOX_MAX_ATTEMPTS is reached, then it is marked as failed.
+
+Every web process runs a worker thread, woken up when an email is queued; 'manage.py send_queued_email'
+drains the outbox from the command line (or keeps doing it with --loop). To try it against a local SMTP
+stand-in, run 'python -m smtpd -n -c DebuggingServer localhost:1025' with EMAIL_HOST='localhost',
+EMAIL_PORT=1025 and EMAIL_USE_TLS=False.
+"""
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connection as db_connection, transaction
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = getattr(settings, 'OUTBOX_BATCH_SIZE', 50)  # emails sent per SMTP connection
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 6)
+OUTBOX_RETRY_DELAY = getattr(settings, 'OUTBOX_RETRY_DELAY', 30)  # seconds, doubled after every attempt
+OUTBOX_MAX_RETRY_DELAY = getattr(settings, 'OUTBOX_MAX_RETRY_DELAY', 60 * 60)
+OUTBOX_POLL_INTERVAL = getattr(settings, 'OUTBOX_POLL_INTERVAL', 30)  # seconds, to pick up the retries
+OUTBOX_SENDING_TIMEOUT = 60 * 10  # emails claimed longer ago than this were lost by a dead worker
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(OUTBOX_RETRY_DELAY * 2 ** attempts, OUTBOX_MAX_RETRY_DELAY))
+
+
+def claim_batch(batch_size=OUTBOX_BATCH_SIZE):
+    """ Mark a batch of due emails as being sent by this worker and return them """
+    from .models import OutgoingEmail
+
+    now = timezone.now()
+    OutgoingEmail.objects.filter(
+        status='sending', updated__lt=now - timedelta(seconds=OUTBOX_SENDING_TIMEOUT)
+    ).update(status='queued')
+    with transaction.atomic():
+        # rows locked by a concurrent worker are skipped, each email is sent by the worker that claimed it
+        emails = list(OutgoingEmail.objects.select_for_update(skip_locked=True).filter(
+            status='queued', next_attempt__lte=now
+        ).order_by('next_attempt', 'pk')[:batch_size])
+        OutgoingEmail.objects.filter(pk__in=[email.pk for email in emails]).update(status='sending', updated=now)
+    for email in emails:
+        email.status = 'sending'
+    return emails
+
+
+def send_batch(emails):
+    """ Send claimed emails over one SMTP connection. Returns (sent, failed) """
+    sent = failed = 0
+    if not emails:
+        return sent, failed
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as error:
+        for email in emails:
+            _failed(email, error)
+        return sent, len(emails)
+    try:
+        for email in emails:
+            message = EmailMultiAlternatives(
+                email.subject, email.body, email.from_email, email.recipients.split(','), connection=connection
+            )
+            if email.html_body:
+                message.attach_alternative(email.html_body, 'text/html')
+            try:
+                message.send()
+            except Exception as error:
+                _failed(email, error)
+                failed += 1
+                connection.close()  # the connection may be broken, it is reopened for the next email
+                connection.open()
+            else:
+                email.status = 'sent'
+                email.attempts += 1
+                email.sent_at = timezone.now()
+                email.save(update_fields=['status', 'attempts', 'sent_at', 'updated'])
+                sent += 1
+    except Exception as error:  # the connection could not be reopened, the rest is retried later
+        for email in emails:
+            if email.status == 'sending':
+                _failed(email, error)
+                failed += 1
+    finally:
+        connection.close()
+    return sent, failed
+
+
+def _failed(email, error):
+    email.attempts += 1
+    email.last_error = repr(error)
+    if email.attempts >= OUTBOX_MAX_ATTEMPTS:
+        email.status = 'failed'
+    else:
+        email.status = 'queued'
+        email.next_attempt = timezone.now() + retry_delay(email.attempts)
+    email.save(update_fields=['status', 'attempts', 'last_error', 'next_attempt', 'updated'])
+    logger.warning('Could not send email %s (attempt %s): %r', email.pk, email.attempts, error)
+
+
+def send_queued(batch_size=OUTBOX_BATCH_SIZE):
+    """ Send every due email, batch by batch. Returns (sent, failed) """
+    sent = failed = 0
+    while True:
+        emails = claim_batch(batch_size)
+        if not emails:
+            return sent, failed
+        batch_sent, batch_failed = send_batch(emails)
+        sent += batch_sent
+        failed += batch_failed
+
+
+class OutboxWorker(object):
+    """ Thread of the current process sending the outbox whenever it is woken up or the poll interval elapses """
+
+    def __init__(self):
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def wake(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='outbox-worker', daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(OUTBOX_POLL_INTERVAL)
+            self.wakeup.clear()
+            try:
+                send_queued()
+            except Exception:
+                logger.exception('Could not send the email outbox')
+            finally:
+                db_connection.close()
+
+
+_worker = OutboxWorker()
+
+
+def wake_outbox_worker():
+    _worker.wake()
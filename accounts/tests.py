@@ -1,3 +1,180 @@
+import math
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.db import IntegrityError
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from market.models import UserNetWorth
+from stock_bridge.cache import get_page_version
+from .models import (
+    DEFAULT_LOAN_AMOUNT, KEY_INSERT_ATTEMPTS, EmailActivation, News, OutgoingEmail, Settlement, SettlementConflict, coefficient_of_variation,
+    welford_update
+)
+from .outbox import OUTBOX_MAX_ATTEMPTS, OUTBOX_MAX_RETRY_DELAY, retry_delay, send_queued
+
+
+User = get_user_model()
+
+
+class AccountsTestCase(TestCase):
+
+    def create_user(self, username, cash=Decimal(10000), loan=Decimal(0)):
+        user = User.objects.create_user(username, '{name}@example.com'.format(name=username), password='pass')
+        User.objects.filter(pk=user.pk).update(cash=cash, loan=loan)
+        return User.objects.get(pk=user.pk)
+
+    def cash(self, user):
+        return User.objects.get(pk=user.pk).cash
+
+
+class SettlementTests(AccountsTestCase):
+
+    def setUp(self):
+        self.user = self.create_user('borrower', cash=Decimal(10000), loan=Decimal(2000))
+
+    def test_run_id_is_applied_once(self):
+        first = Settlement.objects.settle('loan', run_id='run-1')
+        second = Settlement.objects.settle('loan', run_id='run-1')
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(self.cash(self.user), Decimal(8000))
+        self.assertEqual(Settlement.objects.count(), 1)
+        self.assertEqual(UserNetWorth.objects.get(user=self.user).net_worth, Decimal(8000))
+
+    def test_run_id_of_another_kind_is_a_conflict(self):
+        Settlement.objects.settle('interest', run_id='run-1')
+        with self.assertRaises(SettlementConflict):
+            Settlement.objects.settle('loan', run_id='run-1')
+        self.assertEqual(User.objects.get(pk=self.user.pk).loan, Decimal(2000))
+
+    def test_view_answers_a_conflict_with_409(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', password='pass')
+        self.client.force_login(admin)
+        url = reverse('account:deduct_interest')
+        self.assertEqual(self.client.get(url, {'run': 'run-1'}).status_code, 200)
+        self.assertEqual(self.client.get(url, {'run': 'run-1'}).status_code, 200)
+        self.assertEqual(self.client.get(reverse('account:cancel_loan'), {'run': 'run-1'}).status_code, 409)
+        self.assertEqual(self.cash(self.user), Decimal(10000) - Decimal(2000) * Decimal('0.15'))
+
+    def test_selected_users_are_settled_in_batches(self):
+        users = [self.create_user('user{i}'.format(i=i), loan=Decimal(100)) for i in range(5)]
+        with mock.patch('accounts.models.SETTLEMENT_BATCH_SIZE', 2):
+            settlement = Settlement.objects.settle('loan', user_ids=[user.pk for user in users])
+        self.assertEqual(settlement.rows, 5)
+        self.assertEqual([self.cash(user) for user in users], [Decimal(9900)] * 5)
+        self.assertEqual(self.cash(self.user), Decimal(10000))  # not selected
+
+
+@mock.patch('accounts.models.wake_outbox_worker')  # the activation emails stay queued
+@mock.patch('django.db.transaction.on_commit', lambda callback: callback())
+class PageVersionTests(AccountsTestCase):
+
+    def test_registration_bumps_the_page_version(self, wake_outbox_worker):
+        version = get_page_version()
+        self.create_user('newcomer')
+        self.assertGreater(get_page_version(), version)
+
+    @mock.patch('accounts.views.trading_calendar.closed_reason', return_value=None)
+    def test_loan_bumps_the_page_version(self, closed_reason, wake_outbox_worker):
+        user = self.create_user('borrower')
+        self.client.force_login(user)
+        version = get_page_version()
+        self.client.post(reverse('account:loan'), {'mode': 'issue'})
+        self.assertGreater(get_page_version(), version)
+        self.assertEqual(UserNetWorth.objects.get(user=user).net_worth, Decimal(10000) + DEFAULT_LOAN_AMOUNT)
+
+
+class CoefficientOfVariationTests(AccountsTestCase):
+    samples = [10000.0, 10450.5, 9800.25, 12000.0, 11999.99, 8000.0]
+
+    def two_pass(self, samples):
+        mean = sum(samples) / len(samples)
+        return math.sqrt(sum((value - mean) ** 2 for value in samples) / len(samples)) / mean
+
+    def test_running_statistics_match_the_two_pass_formula(self):
+        stats = (0, 0.0, 0.0)
+        for value in self.samples:
+            stats = welford_update(*stats, value)
+        self.assertAlmostEqual(float(coefficient_of_variation(*stats)), self.two_pass(self.samples), places=12)
+        self.assertEqual(coefficient_of_variation(0, 0.0, 0.0), Decimal(0.00))
+
+    def test_update_cv_keeps_the_statistics_on_the_user(self):
+        user = self.create_user('trader')
+        for value in self.samples:
+            User.objects.get(pk=user.pk).update_cv(Decimal(str(value)))
+        user = User.objects.get(pk=user.pk)
+        self.assertEqual(user.net_worth_count, len(self.samples))
+        self.assertAlmostEqual(float(user.coeff_of_variation), self.two_pass(self.samples), places=2)
+
+
+class NewsCountTests(AccountsTestCase):
+
+    def test_cached_count_is_invalidated_on_save_and_delete(self):
+        News.objects.create(title='Open', content='Market opens at 10')
+        self.assertEqual(News.objects.active_count(), 1)
+        with self.assertNumQueries(1):  # the cache read, no COUNT
+            self.assertEqual(News.objects.active_count(), 1)
+        news = News.objects.create(title='Halt', content='Trading halted')
+        self.assertEqual(News.objects.active_count(), 2)
+        news.is_active = False
+        news.save()
+        self.assertEqual(News.objects.active_count(), 1)
+        News.objects.all().delete()
+        self.assertEqual(News.objects.active_count(), 0)
+
+
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.email = OutgoingEmail.objects.enqueue('Subject', 'Body', 'from@example.com', ['to@example.com'])
+
+    def test_queued_email_is_sent(self):
+        self.assertEqual(send_queued(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(OutgoingEmail.objects.get(pk=self.email.pk).status, 'sent')
+        self.assertEqual(send_queued(), (0, 0))
+
+    @mock.patch('accounts.outbox.EmailMultiAlternatives.send', side_effect=OSError('connection reset'))
+    def test_failed_email_is_retried_with_backoff(self, send):
+        start = timezone.now()
+        with self.assertLogs('accounts.outbox', level='WARNING'):
+            self.assertEqual(send_queued(), (0, 1))
+        email = OutgoingEmail.objects.get(pk=self.email.pk)
+        self.assertEqual((email.status, email.attempts), ('queued', 1))
+        self.assertGreaterEqual(email.next_attempt, start + retry_delay(1))
+        self.assertEqual(send_queued(), (0, 0))  # not due yet
+
+        with self.assertLogs('accounts.outbox', level='WARNING'):
+            for _ in range(OUTBOX_MAX_ATTEMPTS - 1):
+                OutgoingEmail.objects.filter(pk=email.pk).update(next_attempt=timezone.now())
+                send_queued()
+        email = OutgoingEmail.objects.get(pk=self.email.pk)
+        self.assertEqual((email.status, email.attempts), ('failed', OUTBOX_MAX_ATTEMPTS))
+        self.assertIn('connection reset', email.last_error)
+
+    def test_retry_delay_doubles_up_to_the_cap(self):
+        self.assertEqual(retry_delay(2), 2 * retry_delay(1))
+        self.assertEqual(retry_delay(100).total_seconds(), OUTBOX_MAX_RETRY_DELAY)
+
+
+class ActivationKeyTests(AccountsTestCase):
+
+    def setUp(self):
+        self.user = self.create_user('newcomer')
+        EmailActivation.objects.filter(user=self.user).update(key='taken')
+
+    def test_key_collision_is_retried_with_a_new_key(self):
+        with mock.patch('accounts.models.secure_key_generator', side_effect=['taken', 'fresh']):
+            activation = EmailActivation.objects.create(user=self.user, email=self.user.email)
+        self.assertEqual(EmailActivation.objects.get(pk=activation.pk).key, 'fresh')
 
-# Create your tests here.
+    def test_insert_gives_up_after_the_attempts(self):
+        with mock.patch('accounts.models.secure_key_generator', return_value='taken') as generator:
+            with self.assertRaises(IntegrityError):
+                EmailActivation.objects.create(user=self.user, email=self.user.email)
+        self.assertEqual(generator.call_count, KEY_INSERT_ATTEMPTS)
+        self.assertEqual(EmailActivation.objects.filter(user=self.user).count(), 1)
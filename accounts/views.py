@@ -1,20 +1,16 @@
-from datetime import datetime
-
-from django.conf import settings
 from django.shortcuts import render, redirect
-from django.http import Http404, HttpResponse
+from django.http import HttpResponse
 from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
 from django.views.generic import ListView, DetailView, FormView, CreateView, View
 from django.views.generic.edit import FormMixin
 from django.utils.safestring import mark_safe
-from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.urls import reverse
 
 from .forms import LoginForm, RegisterForm, ReactivateEmailForm
-from .models import EmailActivation, News
+from .models import EmailActivation, News, Settlement, SettlementConflict
 from stock_bridge.mixins import (
     AnonymousRequiredMixin,
     RequestFormAttachMixin,
@@ -22,38 +18,49 @@ from stock_bridge.mixins import (
     LoginRequiredMixin,
     CountNewsMixin
 )
-from market.models import InvestmentRecord
+from market.models import UserNetWorth
+from market.holdings import get_holdings
+from market.trading_hours import trading_calendar
+from stock_bridge.cache import cache_page_for_anonymous
 
 
 User = get_user_model()
 
-START_TIME = timezone.make_aware(getattr(settings, 'START_TIME'))
-STOP_TIME = timezone.make_aware(getattr(settings, 'STOP_TIME'))
+
+def settle(request, kind, msg):
+    """ Run a settlement of the superuser's request, a run id already used by another kind is a conflict """
+    try:
+        settlement = Settlement.objects.settle(kind, run_id=request.GET.get('run'))
+    except SettlementConflict as e:
+        return HttpResponse(str(e), status=409)
+    return settlement_response(settlement, msg)
+
+
+def settlement_response(settlement, msg):
+    return HttpResponse('{msg}: run {run_id}, {rows} rows in {elapsed:.4f}s'.format(
+        msg=msg, run_id=settlement.run_id, rows=settlement.rows, elapsed=settlement.elapsed or 0
+    ), status=200)
 
 
 @login_required
 def cancel_loan(request):
-    """ Deduct entire loan amount from user's balance """
+    """ Deduct entire loan amount from user's balance (?run=<id> makes the request idempotent) """
     if request.user.is_superuser:
-        for user in User.objects.all():
-            user.cancel_loan()
-        return HttpResponse('Loan Deducted', status=200)
+        return settle(request, 'loan', 'Loan Deducted')
     return redirect('home')
 
 
 @login_required
 def deduct_interest(request):
-    """ Deduct interest from user's balance """
+    """ Deduct interest from user's balance (?run=<id> makes the request idempotent) """
     if request.user.is_superuser:
-        for user in User.objects.all():
-            user.deduct_interest()
-        return HttpResponse('Interest Deducted', status=200)
+        return settle(request, 'interest', 'Interest Deducted')
     return redirect('home')
 
 
 class NewsView(LoginRequiredMixin, CountNewsMixin, ListView):
     template_name = 'accounts/news.html'
-    queryset = News.objects.filter(is_active=True)
+    queryset = News.objects.active()
 
 
 class LoanView(LoginRequiredMixin, CountNewsMixin, View):
@@ -64,8 +71,8 @@ class LoanView(LoginRequiredMixin, CountNewsMixin, View):
         })
 
     def post(self, request, *args, **kwargs):
-        current_time = timezone.make_aware(datetime.now())
-        if current_time >= START_TIME and current_time <= STOP_TIME:  # transaction has to be within game time
+        closed_reason = trading_calendar.closed_reason()
+        if closed_reason is None:  # transaction has to be within game time
             mode = request.POST.get('mode')
             user = request.user
             if mode == 'issue':
@@ -81,13 +88,9 @@ class LoanView(LoginRequiredMixin, CountNewsMixin, View):
                         request,
                         'Minimum installment amount has to be INR 5,000 and you should have sufficient balance.'
                     )
+            UserNetWorth.objects.refresh(users=[user])
         else:
-            # msg = 'The market will be live from {start} to {stop}'.format(
-            #     start=START_TIME.strftime('%H:%M'),
-            #     stop=STOP_TIME.strftime('%H:%M')
-            # )
-            msg = 'The market is closed!'
-            messages.info(request, msg)
+            messages.info(request, closed_reason)
         return redirect('account:loan')
 
 
@@ -101,32 +104,25 @@ class ProfileView(LoginRequiredMixin, CountNewsMixin, DetailView):
         return super(ProfileView, self).dispatch(request, *args, **kwargs)
 
     def get_object(self, *args, **kwargs):
-        username = self.kwargs.get('username')
-        instance = User.objects.filter(username=username).first()
-        if instance is None:
-            raise Http404('User not found')
-        return instance
+        return self.request.user  # dispatch() only lets the user see their own profile
 
     def get_context_data(self, *args, **kwargs):
         context = super(ProfileView, self).get_context_data(*args, **kwargs)
-        qs = InvestmentRecord.objects.filter(user=self.request.user)
-        if qs.count() >= 1:
-            context['net_worth'] = InvestmentRecord.objects.calculate_net_worth(self.request.user)
-            context['investments'] = qs
+        holdings = get_holdings(self.request.user)
+        context['net_worth'] = holdings.net_worth(self.request.user.cash)
+        context['holdings'] = holdings
+        context['investments'] = holdings.positions
         return context
 
 
-class LeaderBoardView(CountNewsMixin, View):
+@method_decorator(cache_page_for_anonymous, name='dispatch')
+class LeaderBoardView(CountNewsMixin, ListView):
     template_name = 'accounts/leaderboard.html'
+    context_object_name = 'data'
+    paginate_by = 50
 
-    def get(self, request, *args, **kwargs):
-        data = []
-        user_qs = User.objects.all()
-        for user in user_qs:
-            net_worth = InvestmentRecord.objects.calculate_net_worth(user)
-            data.append((user.username, user.full_name, net_worth, user.coeff_of_variation))
-        data = sorted(data, key=lambda d: (-d[2], d[3]))
-        return render(request, 'accounts/leaderboard.html', {'data': data})
+    def get_queryset(self, *args, **kwargs):
+        return UserNetWorth.objects.ranked()
 
 
 class AccountEmailActivateView(FormMixin, View):
@@ -137,7 +133,7 @@ class AccountEmailActivateView(FormMixin, View):
     def get(self, request, key=None, *args, **kwargs):
         self.key = key
         if key is not None:
-            qs = EmailActivation.objects.filter(key__iexact=key)
+            qs = EmailActivation.objects.filter(key=key)
             confirm_qs = qs.confirmable()
             if confirm_qs.count() == 1:  # Not confirmed but confirmable
                 obj = confirm_qs.first()
@@ -1,9 +1,36 @@
 from django.contrib import admin
 
-from .models import Company, InvestmentRecord, CompanyCMPRecord, Transaction
+from .models import (
+    Company, InvestmentRecord, CompanyCMPRecord, CompanyCandle, Transaction, UserNetWorth, JournalCheckpoint,
+    LimitOrder, TradingSession, TradingHalt
+)
+
+
+class TransactionAdmin(admin.ModelAdmin):
+    list_select_related = ('user', 'company')  # used by Transaction.__str__
+
+
+class LimitOrderAdmin(admin.ModelAdmin):
+    list_display = ('user', 'company', 'mode', 'price', 'quantity', 'remaining', 'timestamp')
+    list_select_related = ('user', 'company')
+
+
+class TradingSessionAdmin(admin.ModelAdmin):
+    list_display = ('name', 'start', 'stop')
+
+
+class TradingHaltAdmin(admin.ModelAdmin):
+    list_display = ('company', 'reason', 'start', 'stop')
+    list_select_related = ('company',)
 
 
 admin.site.register(Company)
-admin.site.register(Transaction)
+admin.site.register(Transaction, TransactionAdmin)
 admin.site.register(InvestmentRecord)
 admin.site.register(CompanyCMPRecord)
+admin.site.register(UserNetWorth)
+admin.site.register(JournalCheckpoint)
+admin.site.register(CompanyCandle)
+admin.site.register(LimitOrder, LimitOrderAdmin)
+admin.site.register(TradingSession, TradingSessionAdmin)
+admin.site.register(TradingHalt, TradingHaltAdmin)
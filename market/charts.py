@@ -0,0 +1,135 @@
+"""
+Ring buffer of the latest CMP points of every company, used by the chart APIs.
+
+The points live in the shared cache (so that every worker sees the same data) and a copy is kept in process
+memory. A global version number is bumped whenever a price changes, so a poll costs a single cache read
+of the version when nothing moved.
+"""
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import localtime
+
+
+CMP_HISTORY_SIZE = getattr(settings, 'CMP_HISTORY_SIZE', 15)  # number of points shown in the charts
+CMP_HISTORY_TIMEOUT = getattr(settings, 'CMP_HISTORY_TIMEOUT', 60 * 60 * 24)
+
+VERSION_KEY = 'market:cmp_chart:version'
+ENTRY_KEY = 'market:cmp_chart:{code}'
+
+_local_charts = {}  # code -> (version, chart data)
+
+
+def _entry_key(code):
+    return ENTRY_KEY.format(code=code)
+
+
+def _label(timestamp):
+    return localtime(timestamp).strftime('%H:%M')
+
+
+def get_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, 1, None)
+        version = cache.get(VERSION_KEY, 1)
+    return version
+
+
+def _bump_version():
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:  # key expired or was never set
+        cache.set(VERSION_KEY, 1, None)
+        return 1
+
+
+def _build_entry(code):
+    """ Load the ring buffer of a company from the database """
+    from .models import Company, CompanyCMPRecord
+
+    company = Company.objects.filter(code=code).values_list('pk', 'cmp', 'updated').first()
+    if company is None:
+        return None
+    pk, cmp, updated = company
+    records = CompanyCMPRecord.objects.filter(company_id=pk).values_list('timestamp', 'cmp')[:CMP_HISTORY_SIZE]
+    points = deque(((_label(timestamp), value) for timestamp, value in reversed(records)), maxlen=CMP_HISTORY_SIZE)
+    return {'points': points, 'cmp': (_label(updated), cmp)}
+
+
+def _chart_data(entry):
+    """ Chart.js data of an entry: the ring buffer plus the current price if it moved after the last tick """
+    labels = [label for label, _ in entry['points']]
+    cmp_data = [value for _, value in entry['points']]
+    label, current_cmp = entry['cmp']
+    if not cmp_data or cmp_data[-1] != current_cmp:
+        labels.append(label)
+        cmp_data.append(current_cmp)
+    return {
+        'labels': labels,
+        'cmp_data': cmp_data,
+    }
+
+
+def get_charts(codes, version=None):
+    """
+    Chart data of the given company codes: {code: data}. Unknown codes are left out.
+    'version' is the chart version when the caller already read it.
+    """
+    if version is None:
+        version = get_version()
+    charts = {}
+    missing = []
+    for code in codes:
+        local = _local_charts.get(code)
+        if local is not None and local[0] == version:
+            charts[code] = local[1]
+        else:
+            missing.append(code)
+    if missing:
+        entries = cache.get_many([_entry_key(code) for code in missing])
+        for code in missing:
+            entry = entries.get(_entry_key(code))
+            if entry is None:
+                entry = _build_entry(code)
+                if entry is None:
+                    continue
+                cache.set(_entry_key(code), entry, CMP_HISTORY_TIMEOUT)
+            data = _chart_data(entry)
+            _local_charts[code] = (version, data)
+            charts[code] = data
+    return charts
+
+
+def get_chart(code, version=None):
+    return get_charts([code], version).get(code)
+
+
+def push_cmp_points(points, timestamp):
+    """
+    Append the CMP of a market tick to the ring buffers.
+    'points' is a list of (company code, new cmp).
+    """
+    label = _label(timestamp)
+    keys = [_entry_key(code) for code, _ in points]
+    entries = cache.get_many(keys)
+    updated = {}
+    for key, (code, cmp) in zip(keys, points):
+        entry = entries.get(key)
+        if entry is None:  # rebuilt lazily from the database on the next read
+            continue
+        entry['points'].append((label, cmp))
+        entry['cmp'] = (label, cmp)
+        updated[key] = entry
+    cache.set_many(updated, CMP_HISTORY_TIMEOUT)
+    _bump_version()
+
+
+def note_price_change(code, cmp, timestamp):
+    """ Record a price change that happened outside of a market tick (e.g. set by the admin) """
+    entry = cache.get(_entry_key(code))
+    if entry is not None:
+        entry['cmp'] = (_label(timestamp), cmp)
+        cache.set(_entry_key(code), entry, CMP_HISTORY_TIMEOUT)
+    _bump_version()
@@ -0,0 +1,118 @@
+"""
+Live price feed. Every market tick and admin price change publishes a compact diff of the companies whose
+cmp/change moved; the trading pages poll for them every few seconds with the last seq they received.
+The feed never blocks a worker, a poll only reads the events published since that seq.
+
+The broker is chosen with the PRICE_FEED_BROKER setting:
+    'market.feed.CacheBroker' (default) - events are kept in the shared cache (CACHES), seen by every worker.
+    'market.feed.LocalBroker' - in-process stand-in broker, for runserver and local testing.
+"""
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+
+PRICE_FEED_BROKER = getattr(settings, 'PRICE_FEED_BROKER', 'market.feed.CacheBroker')
+PRICE_FEED_EVENT_TIMEOUT = getattr(settings, 'PRICE_FEED_EVENT_TIMEOUT', 60 * 10)  # how long events are kept
+PRICE_FEED_MAX_EVENTS = getattr(settings, 'PRICE_FEED_MAX_EVENTS', 100)  # clients further behind get a snapshot
+PRICE_FEED_POLL_INTERVAL = getattr(settings, 'PRICE_FEED_POLL_INTERVAL', 5)  # seconds between client polls
+
+
+class CacheBroker(object):
+    """ Keeps a sequence number and the last events in the shared cache """
+    max_events = PRICE_FEED_MAX_EVENTS
+    seq_key = 'market:feed:seq'
+    event_key = 'market:feed:event:{seq}'
+
+    def latest(self):
+        return cache.get(self.seq_key, 0)
+
+    def publish(self, changes):
+        try:
+            seq = cache.incr(self.seq_key)
+        except ValueError:  # first event or the key expired
+            cache.add(self.seq_key, 0, None)
+            seq = cache.incr(self.seq_key)
+        cache.set(self.event_key.format(seq=seq), changes, PRICE_FEED_EVENT_TIMEOUT)
+        return seq
+
+    def events_since(self, seq):
+        """ Returns (latest seq, {seq: changes}), or (latest seq, None) if some events already expired """
+        latest = self.latest()
+        if latest <= seq:
+            return latest, {}
+        if latest - seq > self.max_events:  # 'since' comes from the client, never read an unbounded range
+            return latest, None
+        keys = {self.event_key.format(seq=n): n for n in range(seq + 1, latest + 1)}
+        events = cache.get_many(list(keys))
+        if len(events) != len(keys):
+            return latest, None
+        return latest, {keys[key]: changes for key, changes in events.items()}
+
+
+class LocalBroker(object):
+    """ In-process broker: events are only seen by the process that published them """
+    max_events = PRICE_FEED_MAX_EVENTS
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.events = {}
+
+    def latest(self):
+        return self.seq
+
+    def publish(self, changes):
+        with self.lock:
+            self.seq += 1
+            self.events[self.seq] = changes
+            self.events.pop(self.seq - self.max_events, None)
+            return self.seq
+
+    def events_since(self, seq):
+        with self.lock:
+            if self.seq <= seq:
+                return self.seq, {}
+            if seq + 1 not in self.events:
+                return self.seq, None
+            return self.seq, {n: self.events[n] for n in range(seq + 1, self.seq + 1)}
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = import_string(PRICE_FEED_BROKER)()
+    return _broker
+
+
+def snapshot():
+    """ Current cmp/change of every company, sent to clients that missed events """
+    from .models import Company
+
+    return {
+        code: {'cmp': cmp, 'change': change}
+        for code, cmp, change in Company.objects.values_list('code', 'cmp', 'change')
+    }
+
+
+def publish_prices(changes):
+    """ Broadcast {code: {'cmp': ..., 'change': ...}} to every subscriber """
+    if changes:
+        return get_broker().publish(changes)
+
+
+def changes_since(seq):
+    """ (latest seq, merged changes since seq, True if the changes are a full snapshot) """
+    broker = get_broker()
+    latest, events = broker.events_since(seq)
+    if events is None:
+        return latest, snapshot(), True
+    changes = {}
+    for n in sorted(events):
+        changes.update(events[n])
+    return latest, changes, False
@@ -14,6 +14,16 @@ class StockTransactionForm(forms.Form):
     }))
 
 
+class LimitOrderForm(StockTransactionForm):
+    """ Stocks transaction form with a limit price, used when LIMIT_ORDER_MODE is enabled """
+    price = forms.CharField(required=True, widget=forms.TextInput(attrs={
+        'class': 'form-control',
+        'pattern': '[0-9]+(\\.[0-9]{1,2})?',
+        'title': 'Enter a price with at most 2 decimal places',
+        'placeholder': 'Limit price'
+    }))
+
+
 class CompanyChangeForm(forms.Form):
     """ Form for admin to change company's CMP """
     price = forms.CharField(required=True, widget=forms.TextInput(attrs={
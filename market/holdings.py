@@ -0,0 +1,109 @@
+"""
+Cached holdings snapshot of a user, used by the profile page.
+
+A snapshot holds the user's positions with their market value and profit/loss, built in one joined query.
+The P&L comes from the average price and realized P&L kept on every InvestmentRecord at trade time.
+It is stored in the shared cache together with the chart version of market.charts (bumped by every price
+change), so a tick makes every snapshot stale, and a per-user generation number is bumped whenever the
+user's holdings or trades change. Both live in the shared cache (CACHES) so that every worker sees them and
+are read with the snapshot in a single get_many. A missing generation starts over at the current time in
+microseconds, so a snapshot stamped before the key was evicted never matches again.
+Cash is not part of the snapshot: the net worth is the snapshot's holdings value plus the user's cash.
+The stocks left in each company are shown as of the last build of the snapshot.
+"""
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .charts import VERSION_KEY, get_version
+
+
+TWO_PLACES = Decimal('0.01')
+HOLDINGS_TIMEOUT = getattr(settings, 'HOLDINGS_TIMEOUT', 60 * 60)
+HOLDINGS_KEY = 'market:holdings:{user}'
+GENERATION_KEY = 'market:holdings:{user}:generation'  # bumped whenever the user's holdings change
+
+
+def _holdings_key(user_id):
+    return HOLDINGS_KEY.format(user=user_id)
+
+
+def _generation_key(user_id):
+    return GENERATION_KEY.format(user=user_id)
+
+
+def _new_generation():
+    return int(time.time() * 10 ** 6)
+
+
+class HoldingsSnapshot(object):
+
+    def __init__(self, positions):
+        self.positions = positions
+        self.holdings_value = sum((position['value'] for position in positions), Decimal(0.00))
+        self.pnl = sum((position['pnl'] for position in positions), Decimal(0.00))
+
+    def net_worth(self, cash):
+        return self.holdings_value + cash
+
+
+def build_holdings(user_id):
+    """
+    Open positions of a user in one query (over the partial index of the active holdings), from the cost basis
+    kept on every InvestmentRecord.
+    """
+    from .models import InvestmentRecord
+
+    rows = InvestmentRecord.objects.filter(user_id=user_id).active().order_by('company__name').values_list(
+        'company__code', 'company__name', 'company__cmp', 'company__change', 'company__stocks_remaining',
+        'stocks', 'average_price', 'realized_pnl'
+    )
+    positions = []
+    for code, name, cmp, change, stocks_remaining, stocks, average_price, realized_pnl in rows:
+        value = cmp * Decimal(stocks)
+        unrealized_pnl = ((cmp - average_price) * Decimal(stocks)).quantize(TWO_PLACES)
+        positions.append({
+            'code': code,
+            'name': name,
+            'cmp': cmp,
+            'change': change,
+            'stocks_remaining': stocks_remaining,
+            'stocks': stocks,
+            'average_price': average_price.quantize(TWO_PLACES),
+            'value': value,
+            'unrealized_pnl': unrealized_pnl,
+            'realized_pnl': realized_pnl,
+            'pnl': unrealized_pnl + realized_pnl,
+        })
+    return HoldingsSnapshot(positions)
+
+
+def get_holdings(user):
+    """ Holdings snapshot of a user, from the cache while no price and none of the user's holdings changed """
+    key, generation_key = _holdings_key(user.pk), _generation_key(user.pk)
+    cached = cache.get_many([VERSION_KEY, generation_key, key])
+    version = cached.get(VERSION_KEY)
+    if version is None:
+        version = get_version()
+    generation = cached.get(generation_key)
+    if generation is None:
+        cache.add(generation_key, _new_generation(), None)
+        generation = cache.get(generation_key)
+    stamp = (version, generation)
+    entry = cached.get(key)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+    # the stamp is read before building, so a change made meanwhile leaves the stored snapshot stale
+    snapshot = build_holdings(user.pk)
+    cache.set(key, (stamp, snapshot), HOLDINGS_TIMEOUT)
+    return snapshot
+
+
+def invalidate_holdings(*user_ids):
+    for user_id in user_ids:
+        try:
+            cache.incr(_generation_key(user_id))
+        except ValueError:  # first change or the key was evicted
+            cache.set(_generation_key(user_id), _new_generation(), None)
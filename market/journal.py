@@ -0,0 +1,254 @@
+"""
+Write-ahead trade journal (enabled with the TRADE_JOURNAL_DIR setting).
+
+The trading view appends each validated order to an append-only journal file and returns after a single
+fsync; a background applier thread executes the journalled orders against the database in group commits
+(one database transaction per batch). Every process writes its own file, 'trades-<pid>.log', made of
+JSON lines:
+
+    {"seq": 12, "user": 3, "company": 7, "mode": "buy", "quantity": 10, "price": "120.50", "time": "..."}
+
+The last applied seq of every file is stored in JournalCheckpoint inside the same database transaction as
+the batch, so an order is applied exactly once. After a crash, 'manage.py replay_trade_journal' applies
+whatever is left in the files of the dead processes (a new process that reuses the pid of a dead one
+applies the orders left in its file by itself). Orders that can no longer be filled when applied
+(e.g. the cash was spent in the meantime) are skipped and logged. Each order is applied in its own savepoint:
+an order that raises an error is rolled back alone, logged and appended to the 'deadletters.log' file of the
+journal directory, and the rest of the batch is committed, so one bad order cannot block the journal. The
+created Transactions are stamped with the time the order was journalled.
+"""
+import glob
+import json
+import logging
+import os
+import threading
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction, OperationalError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+TRADE_JOURNAL_DIR = getattr(settings, 'TRADE_JOURNAL_DIR', None)
+TRADE_JOURNAL_BATCH_SIZE = getattr(settings, 'TRADE_JOURNAL_BATCH_SIZE', 200)  # orders per group commit
+TRADE_JOURNAL_FLUSH_INTERVAL = getattr(settings, 'TRADE_JOURNAL_FLUSH_INTERVAL', 0.2)  # seconds
+DEAD_LETTER_FILE = 'deadletters.log'
+
+_dead_letter_lock = threading.Lock()
+
+
+def read_entries(path, after=0):
+    """ Journal entries of a file with a seq greater than 'after'. A torn last line (crash) is ignored. """
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path) as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry['seq'] > after:
+                entries.append(entry)
+    return entries
+
+
+def dead_letter(directory, name, entries):
+    """ Append the journal entries that failed with an error to the dead letter file of the directory """
+    with _dead_letter_lock, open(os.path.join(directory, DEAD_LETTER_FILE), 'a') as dead_letters:
+        for entry, error in entries:
+            dead_letters.write(json.dumps({'journal': name, 'entry': entry, 'error': error}) + '\n')
+
+
+def apply_entries(name, entries, directory=TRADE_JOURNAL_DIR):
+    """
+    Execute journal entries in one database transaction and move the checkpoint of journal 'name' past
+    them. Entries at or below the checkpoint were already applied and are skipped. Every entry runs in a
+    savepoint; the ones failing with an error (other than an OperationalError, which fails the whole batch
+    so that it is retried) are dead-lettered in 'directory' once the batch is committed.
+    Returns (number of orders executed, number of orders rejected or dead-lettered).
+    """
+    from .models import Company, Transaction, JournalCheckpoint
+
+    executed = rejected = 0
+    with transaction.atomic():
+        checkpoint, created = JournalCheckpoint.objects.select_for_update().get_or_create(name=name)
+        entries = [entry for entry in entries if entry['seq'] > checkpoint.seq]
+        if not entries:
+            return executed, rejected
+        users = User.objects.in_bulk({entry['user'] for entry in entries})
+        companies = Company.objects.in_bulk({entry['company'] for entry in entries})
+        failed = []
+        for entry in entries:
+            user, company = users.get(entry['user']), companies.get(entry['company'])
+            obj = None
+            try:
+                with transaction.atomic():
+                    if user is not None and company is not None:
+                        obj = Transaction.objects.execute(
+                            user, company, entry['mode'], entry['quantity'], Decimal(entry['price']),
+                            timestamp=parse_datetime(entry['time'])
+                        )
+            except OperationalError:
+                raise
+            except Exception as error:
+                rejected += 1
+                logger.exception('Journalled order %s:%s failed: %r', name, entry['seq'], entry)
+                failed.append((entry, repr(error)))
+                continue
+            if obj is None:
+                rejected += 1
+                logger.warning('Journalled order %s:%s could not be filled: %r', name, entry['seq'], entry)
+            else:
+                executed += 1
+        checkpoint.seq = entries[-1]['seq']
+        checkpoint.save()
+        if failed and directory:
+            transaction.on_commit(lambda: dead_letter(directory, name, failed))
+    return executed, rejected
+
+
+class TradeJournal(object):
+    """ The journal file of the current process and its applier thread """
+
+    def __init__(self, directory, batch_size=TRADE_JOURNAL_BATCH_SIZE, interval=TRADE_JOURNAL_FLUSH_INTERVAL):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = 'trades-{pid}.log'.format(pid=os.getpid())
+        self.path = os.path.join(directory, self.name)
+        self.batch_size = batch_size
+        self.interval = interval
+        existing = read_entries(self.path)
+        self.seq = existing[-1]['seq'] if existing else 0  # last written seq
+        self.synced = self.seq  # last seq known to be on disk
+        self.file = open(self.path, 'a')
+        self.write_lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        # a file left by a crashed process that had the same pid: its orders past the checkpoint were
+        # acknowledged but never applied, they are applied before (and in the same batches as) the new ones
+        self.pending = self.unapplied(existing)
+        if self.pending:
+            self._start()
+            self.wakeup.set()
+
+    def unapplied(self, entries):
+        from .models import JournalCheckpoint
+
+        if not entries:
+            return []
+        applied = JournalCheckpoint.objects.filter(name=self.name).values_list('seq', flat=True).first() or 0
+        return [entry for entry in entries if entry['seq'] > applied]
+
+    def append(self, user, company, mode, quantity, price):
+        """ Durably journal an order and schedule it to be applied. Returns its seq. """
+        with self.write_lock:
+            self.seq += 1
+            entry = {
+                'seq': self.seq,
+                'user': user.pk,
+                'company': company.pk,
+                'mode': mode,
+                'quantity': quantity,
+                'price': str(price),
+                'time': timezone.now().isoformat(),
+            }
+            self.file.write(json.dumps(entry) + '\n')
+        self._sync(entry['seq'])
+        with self.write_lock:
+            self.pending.append(entry)
+        self._start()
+        self.wakeup.set()
+        return entry['seq']
+
+    def _sync(self, seq):
+        """
+        Group commit of the file: the thread holding sync_lock fsyncs everything written so far, so the
+        orders appended while it waited are made durable by the same fsync.
+        """
+        with self.sync_lock:
+            if self.synced >= seq:
+                return
+            with self.write_lock:
+                target = self.seq
+                self.file.flush()
+            os.fsync(self.file.fileno())
+            self.synced = target
+
+    def _start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name='trade-journal-applier', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:  # the orders stay pending and are retried on the next round
+                logger.exception('Could not apply the trade journal %s', self.name)
+
+    def flush(self):
+        """ Apply the pending orders in group commits. Returns the number of orders applied. """
+        with self.write_lock:
+            entries = sorted(self.pending, key=lambda entry: entry['seq'])
+        applied = 0
+        for i in range(0, len(entries), self.batch_size):
+            batch = entries[i:i + self.batch_size]
+            apply_entries(self.name, batch, self.directory)
+            with self.write_lock:
+                done = {entry['seq'] for entry in batch}
+                self.pending = [entry for entry in self.pending if entry['seq'] not in done]
+            applied += len(batch)
+        return applied
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """ Journal of the current process, or None if the journal is disabled """
+    global _journal
+    if not TRADE_JOURNAL_DIR:
+        return None
+    with _journal_lock:
+        if _journal is None or _journal.name != 'trades-{pid}.log'.format(pid=os.getpid()):  # forked
+            _journal = TradeJournal(TRADE_JOURNAL_DIR)
+    return _journal
+
+
+def replay(directory=TRADE_JOURNAL_DIR, batch_size=TRADE_JOURNAL_BATCH_SIZE, remove=False):
+    """
+    Apply every journal file of 'directory' past its checkpoint. With 'remove', the files that are fully
+    applied are deleted, except the journal of the current process.
+    Returns {file name: (executed, rejected)}.
+    """
+    from .models import JournalCheckpoint
+
+    results = {}
+    if not directory:
+        return results
+    own = _journal.name if _journal is not None else None
+    checkpoints = dict(JournalCheckpoint.objects.values_list('name', 'seq'))
+    for path in sorted(glob.glob(os.path.join(directory, 'trades-*.log'))):
+        name = os.path.basename(path)
+        entries = read_entries(path, after=checkpoints.get(name, 0))
+        executed = rejected = 0
+        for i in range(0, len(entries), batch_size):
+            done, failed = apply_entries(name, entries[i:i + batch_size], directory)
+            executed += done
+            rejected += failed
+        results[name] = (executed, rejected)
+        if remove and name != own:
+            os.remove(path)
+            JournalCheckpoint.objects.filter(name=name).delete()
+    return results
@@ -0,0 +1,113 @@
+"""
+Limit order mode (enabled with the LIMIT_ORDER_MODE setting).
+
+Users trade with each other through the in-process MatchingEngine instead of buying from the company's
+stock pool at cmp. The cash (buy) or stocks (sell) of an order are held in escrow when it is placed, so
+fills can always be settled; unfilled quantity is refunded when the order is cancelled, or when the order
+would trade with an order of the same user (self-trade prevention, see market.orderbook).
+Every order is saved as a LimitOrder row whose remaining quantity follows the fills and cancellations, and
+the books are rebuilt from the open rows the first time the engine is used after a restart, so the escrow
+of resting orders is never lost. The books themselves live in process memory, so this mode must run with
+a single worker process.
+"""
+import threading
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+
+from .models import InvestmentRecord, LimitOrder, Transaction, UserNetWorth
+from .orderbook import MatchingEngine, Order
+
+
+User = get_user_model()
+
+LIMIT_ORDER_MODE = getattr(settings, 'LIMIT_ORDER_MODE', False)
+FILL_BATCH_SIZE = getattr(settings, 'FILL_BATCH_SIZE', 500)
+
+
+def settle_fills(fills):
+    """
+    Settle the fills and record them on the orders in one transaction. The orders are updated first so the
+    net worths computed by record_fills no longer count the filled quantity as escrow.
+    """
+    with transaction.atomic():
+        LimitOrder.objects.apply_fills(fills)
+        Transaction.objects.record_fills(fills)
+
+
+engine = MatchingEngine(on_fills=settle_fills, batch_size=FILL_BATCH_SIZE)
+_restored = False
+_restore_lock = threading.Lock()
+
+
+def get_engine():
+    """ The matching engine, with the open orders saved before the last restart back in its books """
+    global _restored
+    if not _restored:
+        with _restore_lock:
+            if not _restored:
+                engine.restore(
+                    Order(order.pk, order.company_id, order.user_id, order.mode, order.price, order.quantity,
+                          remaining=order.remaining)
+                    for order in LimitOrder.objects.open()
+                )
+                _restored = True
+    return engine
+
+
+def refund(user, company, side, quantity, price):
+    if side == 'buy':
+        User.objects.filter(pk=user.pk).update(cash=F('cash') + Decimal(quantity) * price)
+    else:
+        InvestmentRecord.objects.add_stocks(user, company, quantity)
+
+
+def place_limit_order(user, company, mode, quantity, price):
+    """
+    Escrow the order's cash/stocks, match it and persist the resulting fills.
+    Returns (order, fills), or (None, []) if the user cannot cover the order.
+    """
+    engine = get_engine()
+    with transaction.atomic():
+        if mode == 'buy':
+            escrowed = User.objects.filter(pk=user.pk, cash__gte=Decimal(quantity) * price).update(
+                cash=F('cash') - Decimal(quantity) * price
+            )
+        elif mode == 'sell':
+            escrowed = InvestmentRecord.objects.reduce_stocks(user, company, quantity)
+        else:
+            escrowed = False
+        if escrowed:
+            saved = LimitOrder.objects.create(
+                user=user, company=company, mode=mode, price=price, quantity=quantity, remaining=quantity
+            )
+        UserNetWorth.objects.refresh(users=[user])
+    if not escrowed:
+        return None, []
+    order, fills = engine.submit(company.pk, user.pk, mode, price, quantity, order_id=saved.pk)
+    if order.cancelled:
+        with transaction.atomic():
+            LimitOrder.objects.reduce_remaining({order.id: order.cancelled})
+            refund(user, company, mode, order.cancelled, price)
+            UserNetWorth.objects.refresh(users=[user])
+    engine.flush()
+    return order, fills
+
+
+def cancel_limit_order(user, company, order_id):
+    """ Cancel a resting order of the user and refund its unfilled escrow. Returns the refunded quantity. """
+    order, remaining = get_engine().cancel(company.pk, order_id, user_id=user.pk)
+    if order is None or not remaining:
+        return 0
+    with transaction.atomic():
+        LimitOrder.objects.reduce_remaining({order.id: remaining})
+        refund(user, company, order.side, remaining, order.price)
+        UserNetWorth.objects.refresh(users=[user])
+    return remaining
+
+
+def open_orders(user, company):
+    return get_engine().open_orders(company.pk, user.pk)
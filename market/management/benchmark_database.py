@@ -0,0 +1,28 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.db import connections
+from django.test.utils import setup_databases, teardown_databases
+
+
+@contextmanager
+def benchmark_database(verbosity=1):
+    """
+    Run the block against throwaway test databases (migrated like the test runner does), so that benchmarks
+    never read or write the configured database. SQLite test databases are files instead of in-memory
+    databases, so that every thread of a benchmark sees the same data.
+    """
+    directory = tempfile.mkdtemp(prefix='stock-bridge-benchmark-')
+    for connection in connections.all():
+        if connection.vendor == 'sqlite' and not connection.settings_dict['TEST'].get('NAME'):
+            connection.settings_dict['TEST']['NAME'] = os.path.join(
+                directory, '{alias}.sqlite3'.format(alias=connection.alias)
+            )
+    old_config = setup_databases(verbosity, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity)
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,275 @@
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from market.management.benchmark_database import benchmark_database
+from market.models import Company, CompanyCMPRecord, InvestmentRecord, Transaction, UserNetWorth
+from market.trading_hours import trading_calendar
+
+
+User = get_user_model()
+
+
+def percentile(values, percent):
+    """ Nearest-rank percentile of a sorted list """
+    if not values:
+        return 0.0
+    index = max(int(round(percent / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a synthetic market and drive the trading, leaderboard, chart and market update endpoints with '
+        'concurrent test clients. Reports throughput, p50/p95/p99 latency and queries per request, and writes '
+        'them to a JSON file that can be compared with a previous run (--baseline). Runs in a throwaway test '
+        'database, the configured database is never touched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--companies', type=int, default=200)
+        parser.add_argument('--holdings', type=int, default=10, help='Holdings of every synthetic user')
+        parser.add_argument('--ticks', type=int, default=50, help='Market ticks of history per company')
+        parser.add_argument('--history', type=int, default=5, help='Past transactions of every synthetic user')
+        parser.add_argument('--clients', type=int, default=8, help='Concurrent clients (threads)')
+        parser.add_argument('--requests', type=int, default=50, help='Requests sent by each client')
+        parser.add_argument('--ticks-run', type=int, default=10, help='update_market calls (by a single client)')
+        parser.add_argument('--scenarios', default='trade,leaderboard,chart,update_market')
+        parser.add_argument('--host', help='Host header (default: the first plain host of ALLOWED_HOSTS)')
+        parser.add_argument('--output', help='JSON results file (default: benchmark-results/endpoints-<time>.json)')
+        parser.add_argument('--baseline', help='Previous JSON results to compare with')
+        parser.add_argument('--tolerance', type=float, default=20.0, help='Allowed p95 and throughput regression in percent')
+
+    def handle(self, *args, **options):
+        self.options = options
+        if not options['host']:
+            hosts = [host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')]
+            options['host'] = hosts[0] if hosts else 'localhost'
+        with benchmark_database(verbosity=options['verbosity']):
+            results = self.benchmark()
+        self.write(results)
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def benchmark(self):
+        options = self.options
+        start = time.perf_counter()
+        self.seed()
+        self.stdout.write('Seeded the synthetic market in {elapsed:.1f}s'.format(elapsed=time.perf_counter() - start))
+
+        scenarios = {
+            'trade': self.trade,
+            'leaderboard': self.leaderboard,
+            'chart': self.chart,
+            'update_market': self.update_market,
+        }
+        results = {
+            'timestamp': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'config': {key: options[key] for key in (
+                'users', 'companies', 'holdings', 'ticks', 'history', 'clients', 'requests', 'ticks_run'
+            )},
+            'scenarios': {},
+        }
+        # the market must be open for the trades
+        with mock.patch.object(trading_calendar, 'closed_reason', return_value=None):
+            for name in options['scenarios'].split(','):
+                if name == 'update_market':
+                    stats = self.run(scenarios[name], clients=1, requests=options['ticks_run'], admin=True)
+                else:
+                    stats = self.run(scenarios[name], options['clients'], options['requests'])
+                results['scenarios'][name] = stats
+                self.report(name, stats)
+        return results
+
+    # seeding
+
+    def seed(self):
+        """
+        bulk_create skips the signals: sparse holdings, no activation emails. The seeded rows are the ones
+        created after the last existing pk (the test database may contain rows added by data migrations).
+        """
+        options = self.options
+        last_company = Company.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        last_user = User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        companies = [
+            Company(
+                code='BN{i}'.format(i=i), name='Bench Company {i}'.format(i=i), cmp=random.randint(50, 500),
+                stocks_offered=10 ** 7, stocks_remaining=10 ** 7, cap_type=random.choice(['small', 'mid', 'large'])
+            )
+            for i in range(options['companies'])
+        ]
+        Company.objects.bulk_create(companies)
+        company_ids = list(Company.objects.filter(pk__gt=last_company).values_list('pk', flat=True))
+
+        User.objects.bulk_create([
+            User(
+                username='bench{i}'.format(i=i), email='bench{i}@example.com'.format(i=i),
+                full_name='Bench User {i}'.format(i=i), password='!', cash=10 ** 6
+            )
+            for i in range(options['users'])
+        ] + [
+            User(
+                username='benchadmin', email='benchadmin@example.com',
+                full_name='Bench Admin', password='!', staff=True, is_superuser=True
+            )
+        ])
+        user_ids = list(User.objects.filter(pk__gt=last_user).values_list('pk', flat=True))
+
+        records = []
+        history = []
+        for user_id in user_ids:
+            for company_id in random.sample(company_ids, min(options['holdings'], len(company_ids))):
+                records.append(InvestmentRecord(
+                    user_id=user_id, company_id=company_id, stocks=random.randint(1, 100),
+                    average_price=random.randint(50, 500)
+                ))
+            for _ in range(options['history']):
+                history.append(Transaction(
+                    user_id=user_id, company_id=random.choice(company_ids), num_stocks=random.randint(1, 10),
+                    price=random.randint(50, 500), mode=random.choice(['buy', 'sell']), user_net_worth=10 ** 6
+                ))
+        with transaction.atomic():
+            InvestmentRecord.objects.bulk_create(records)
+            Transaction.objects.bulk_create(history)
+            CompanyCMPRecord.objects.bulk_create([
+                CompanyCMPRecord(company_id=company_id, cmp=random.randint(50, 500))
+                for company_id in company_ids for _ in range(options['ticks'])
+            ])
+            UserNetWorth.objects.bulk_create([UserNetWorth(user_id=user_id) for user_id in user_ids])
+            UserNetWorth.objects.refresh(users=user_ids)
+        self.users = list(User.objects.filter(pk__in=user_ids, is_superuser=False).values_list('pk', flat=True))
+        self.codes = list(Company.objects.filter(pk__in=company_ids).values_list('code', flat=True))
+        self.admin = User.objects.get(pk__in=user_ids, is_superuser=True)
+
+    # scenarios, each one sends a request with the given client and returns the response
+
+    def trade(self, client, user_id):
+        return client.post(reverse('market:transaction', kwargs={'code': random.choice(self.codes)}), {
+            'mode': random.choice(['buy', 'sell']), 'quantity': random.randint(1, 5)
+        })
+
+    def leaderboard(self, client, user_id):
+        pages = max(len(self.users) // 50, 1)
+        return client.get(reverse('leaderboard'), {'page': random.randint(1, pages)})
+
+    def chart(self, client, user_id):
+        return client.get(reverse('market:cmp_api_data', kwargs={'code': random.choice(self.codes)}))
+
+    def update_market(self, client, user_id):
+        return client.get(reverse('market:update'))
+
+    # driver
+
+    def run(self, scenario, clients, requests, admin=False):
+        latencies = []
+        queries = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            user = self.admin if admin else User.objects.get(pk=random.choice(self.users))
+            client = Client(HTTP_HOST=self.options['host'])
+            client.force_login(user)
+            own_latencies, own_queries, own_errors = [], [], 0
+            try:
+                for _ in range(requests):
+                    with CaptureQueriesContext(connection) as captured:
+                        start = time.perf_counter()
+                        try:
+                            response = scenario(client, user.pk)
+                            failed = response.status_code >= 400
+                        except Exception:
+                            failed = True
+                        own_latencies.append(time.perf_counter() - start)
+                    own_queries.append(len(captured.captured_queries))
+                    own_errors += failed
+            finally:
+                connection.close()
+            with lock:
+                latencies.extend(own_latencies)
+                queries.extend(own_queries)
+                errors.append(own_errors)
+
+        threads = [threading.Thread(target=worker) for _ in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        return {
+            'requests': len(latencies),
+            'errors': sum(errors),
+            'clients': clients,
+            'elapsed': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'queries_per_request': sum(queries) / len(queries) if queries else 0.0,
+            'max_queries': max(queries) if queries else 0,
+        }
+
+    # reporting
+
+    def report(self, name, stats):
+        self.stdout.write(
+            '{name}: {requests} requests ({errors} errors) in {elapsed:.2f}s, {throughput:.1f} req/s, '
+            'p50 {p50_ms:.1f}ms, p95 {p95_ms:.1f}ms, p99 {p99_ms:.1f}ms, '
+            '{queries_per_request:.1f} queries/request (max {max_queries})'.format(name=name, **stats)
+        )
+
+    def write(self, results):
+        path = self.options['output']
+        if not path:
+            directory = os.path.join(settings.BASE_DIR, 'benchmark-results')
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, 'endpoints-{time}.json'.format(
+                time=datetime.now().strftime('%Y%m%d-%H%M%S')
+            ))
+        with open(path, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+        self.stdout.write('Results written to {path}'.format(path=path))
+
+    def compare(self, results, baseline_path, tolerance):
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = 0
+        for name, stats in results['scenarios'].items():
+            previous = baseline.get('scenarios', {}).get(name)
+            if not previous or not previous['p95_ms'] or not previous['throughput']:
+                continue
+            change = (stats['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] * 100
+            throughput_change = (stats['throughput'] - previous['throughput']) / previous['throughput'] * 100
+            regressed = change > tolerance or throughput_change < -tolerance
+            regressions += regressed
+            self.stdout.write(
+                '{flag} {name}: p95 {previous:.1f}ms -> {current:.1f}ms ({change:+.0f}%), throughput '
+                '{previous_throughput:.1f} -> {throughput:.1f} req/s ({throughput_change:+.0f}%), queries/request '
+                '{previous_queries:.1f} -> {queries:.1f}'.format(
+                    flag='REGRESSION' if regressed else 'ok', name=name, previous=previous['p95_ms'],
+                    current=stats['p95_ms'], change=change, previous_throughput=previous['throughput'],
+                    throughput=stats['throughput'], throughput_change=throughput_change,
+                    previous_queries=previous['queries_per_request'], queries=stats['queries_per_request']
+                )
+            )
+        if regressions:
+            self.stderr.write('{num} scenarios regressed compared to {path}'.format(num=regressions, path=baseline_path))
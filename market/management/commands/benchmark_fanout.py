@@ -0,0 +1,69 @@
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from market.management.benchmark_database import benchmark_database
+from market.models import Company, InvestmentRecord
+
+
+User = get_user_model()
+
+
+def legacy_company_fanout(company):
+    """ The old post_save_company_receiver: one get_or_create per user """
+    for user in User.objects.all():
+        InvestmentRecord.objects.get_or_create(user=user, company=company)
+
+
+def legacy_user_fanout(user):
+    """ The old post_save_user_create_receiver: one create per company """
+    for company in Company.objects.all():
+        InvestmentRecord.objects.create(user=user, company=company)
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the InvestmentRecord fan-out done on company onboarding and user registration. Runs in a '
+        'throwaway test database, the configured database is never touched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000, help='Synthetic users to create')
+        parser.add_argument('--companies', type=int, default=50, help='Synthetic companies to create')
+
+    def handle(self, *args, **options):
+        with benchmark_database(verbosity=options['verbosity']):
+            self.benchmark(options)
+
+    def benchmark(self, options):
+        tag = uuid.uuid4().hex[:6]
+        # bulk_create skips the signals, the fan-outs are run explicitly below
+        User.objects.bulk_create([
+            User(username='fanout_{tag}_{i}'.format(tag=tag, i=i), email='fanout_{tag}_{i}@example.com'.format(
+                tag=tag, i=i
+            ), password='!') for i in range(options['users'])
+        ])
+        Company.objects.bulk_create([
+            Company(
+                code='F{tag}{i}'.format(tag=tag, i=i), name='Fanout {tag} {i}'.format(tag=tag, i=i),
+                stocks_remaining=0
+            )
+            for i in range(options['companies'])
+        ])
+        users = User.objects.filter(username__startswith='fanout_{tag}_'.format(tag=tag))
+        companies = Company.objects.filter(code__startswith='F{tag}'.format(tag=tag))
+        self.time('user registration', 'legacy', legacy_user_fanout, users[0])
+        self.time('user registration', 'bulk', InvestmentRecord.objects.create_for_user, users[1])
+        self.time('company onboarding', 'legacy', legacy_company_fanout, companies[0])
+        self.time('company onboarding', 'bulk', InvestmentRecord.objects.create_for_company, companies[1])
+
+    def time(self, action, name, func, obj):
+        start = time.perf_counter()
+        with transaction.atomic():
+            func(obj)
+        self.stdout.write('{action} ({name}): {elapsed:.3f}s'.format(
+            action=action, name=name, elapsed=time.perf_counter() - start
+        ))
@@ -0,0 +1,149 @@
+import random
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from market.management.benchmark_database import benchmark_database
+from market.models import Company, CompanyCMPRecord, Transaction
+
+
+User = get_user_model()
+
+INSERT_BATCH_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the chart and transaction history queries on a synthetic history, without and with the '
+        '(company, timestamp) / (user, timestamp) indexes. Runs in a throwaway test database, as it drops the '
+        'indexes and inserts millions of rows.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ticks', type=int, default=2000000, help='Synthetic CompanyCMPRecord rows')
+        parser.add_argument('--transactions', type=int, default=1000000, help='Synthetic Transaction rows')
+        parser.add_argument('--companies', type=int, default=50)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--days', type=int, default=30, help='The history is spread over this many days')
+        parser.add_argument('--repeat', type=int, default=50, help='Runs of each query')
+
+    def handle(self, *args, **options):
+        with benchmark_database(verbosity=options['verbosity']):
+            self.benchmark(options)
+
+    def benchmark(self, options):
+        tag = uuid.uuid4().hex[:6]
+        companies, users = self.seed(tag, options)
+        self.stdout.write('seeding history...')
+        start = time.perf_counter()
+        self.seed_history(companies, users, options)
+        self.stdout.write('seeded in {elapsed:.1f}s'.format(elapsed=time.perf_counter() - start))
+
+        queries = {
+            'chart (last 15 ticks of a company)': lambda: list(
+                CompanyCMPRecord.objects.filter(company_id=random.choice(companies))
+                .values_list('timestamp', 'cmp')[:15]
+            ),
+            'user history (last 50 transactions)': lambda: list(
+                Transaction.objects.filter(user_id=random.choice(users)).values_list('pk', 'timestamp')[:50]
+            ),
+            'company trades (last 50 transactions)': lambda: list(
+                Transaction.objects.filter(company_id=random.choice(companies)).values_list('pk', 'timestamp')[:50]
+            ),
+        }
+        indexes = [(model, index) for model in (CompanyCMPRecord, Transaction) for index in model._meta.indexes]
+        with connection.schema_editor() as editor:
+            for model, index in indexes:
+                editor.remove_index(model, index)
+        try:
+            before = self.run(queries, options['repeat'])
+        finally:
+            with connection.schema_editor() as editor:
+                for model, index in indexes:
+                    editor.add_index(model, index)
+        after = self.run(queries, options['repeat'])
+        for name in queries:
+            self.stdout.write('{name}: {before:.2f}ms -> {after:.2f}ms ({speedup:.1f}x)'.format(
+                name=name, before=before[name] * 1000, after=after[name] * 1000,
+                speedup=before[name] / after[name] if after[name] else 0
+            ))
+
+    def seed(self, tag, options):
+        Company.objects.bulk_create([
+            Company(
+                code='H{tag}{i}'.format(tag=tag, i=i), name='History {tag} {i}'.format(tag=tag, i=i),
+                stocks_remaining=0
+            )
+            for i in range(options['companies'])
+        ])
+        User.objects.bulk_create([
+            User(username='history_{tag}_{i}'.format(tag=tag, i=i), email='history_{tag}_{i}@example.com'.format(
+                tag=tag, i=i
+            ), password='!') for i in range(options['users'])
+        ])
+        companies = list(Company.objects.filter(code__startswith='H{tag}'.format(tag=tag)).values_list('pk', flat=True))
+        users = list(User.objects.filter(username__startswith='history_{tag}_'.format(tag=tag)).values_list(
+            'pk', flat=True
+        ))
+        return companies, users
+
+    def seed_history(self, companies, users, options):
+        """ Raw inserts, as bulk_create would overwrite the auto_now_add timestamps """
+        ops = connection.ops
+        now = timezone.now()
+        span = options['days'] * 24 * 60 * 60
+
+        def timestamp(i, total):
+            return ops.adapt_datetimefield_value(now - timedelta(seconds=span * (total - i) / total))
+
+        def price():
+            return ops.adapt_decimalfield_value(Decimal(random.randint(1000, 100000)) / 100, 20, 2)
+
+        ticks = options['ticks']
+        self.insert(CompanyCMPRecord, ('company_id', 'cmp', 'timestamp', 'updated'), (
+            (companies[i % len(companies)], price(), stamp, stamp)
+            for i, stamp in ((i, timestamp(i, ticks)) for i in range(ticks))
+        ))
+        trades = options['transactions']
+        self.insert(Transaction, (
+            'user_id', 'company_id', 'num_stocks', 'price', 'mode', 'user_net_worth', 'timestamp', 'updated'
+        ), (
+            (random.choice(users), random.choice(companies), 10, price(), 'buy', price(), stamp, stamp)
+            for stamp in (timestamp(i, trades) for i in range(trades))
+        ))
+
+    def insert(self, model, columns, rows):
+        sql = 'INSERT INTO {table} ({columns}) VALUES ({params})'.format(
+            table=connection.ops.quote_name(model._meta.db_table),
+            columns=', '.join(connection.ops.quote_name(column) for column in columns),
+            params=', '.join(['%s'] * len(columns))
+        )
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == INSERT_BATCH_SIZE:
+                self.insert_batch(sql, batch)
+                batch = []
+        if batch:
+            self.insert_batch(sql, batch)
+
+    def insert_batch(self, sql, batch):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(sql, batch)
+
+    def run(self, queries, repeat):
+        """ Mean time of each query """
+        results = {}
+        for name, query in queries.items():
+            query()  # warm up
+            start = time.perf_counter()
+            for _ in range(repeat):
+                query()
+            results[name] = (time.perf_counter() - start) / repeat
+        return results
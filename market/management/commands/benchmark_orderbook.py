@@ -0,0 +1,53 @@
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from market.orderbook import MatchingEngine
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the limit order matching engine offline (no database): orders/sec and match latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=200000, help='Number of orders to submit')
+        parser.add_argument('--companies', type=int, default=20, help='Number of order books')
+        parser.add_argument('--users', type=int, default=5000, help='Number of distinct users')
+        parser.add_argument('--seed', type=int, default=2018, help='Random seed')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        prices = [Decimal(p) / 100 for p in range(9000, 11001)]  # 90.00 to 110.00
+        orders = [
+            (
+                rng.randrange(options['companies']),
+                rng.randrange(options['users']),
+                rng.choice(('buy', 'sell')),
+                rng.choice(prices),
+                rng.randint(1, 100)
+            ) for _ in range(options['orders'])
+        ]
+
+        engine = MatchingEngine()
+        latencies = []
+        fills = 0
+        start = time.perf_counter()
+        for company, user_id, side, price, quantity in orders:
+            t = time.perf_counter()
+            order, order_fills = engine.submit(company, user_id, side, price, quantity)
+            latencies.append(time.perf_counter() - t)
+            fills += len(order_fills)
+        elapsed = time.perf_counter() - start
+        engine.flush()
+
+        latencies.sort()
+        percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 10 ** 6
+        resting = sum(len(book.orders) for book in engine.books.values())
+        self.stdout.write(
+            '{orders} orders in {elapsed:.3f}s: {rate:.0f} orders/sec, {fills} fills, {resting} resting orders\n'
+            'match latency: p50 {p50:.1f}us, p99 {p99:.1f}us, max {max:.1f}us'.format(
+                orders=len(orders), elapsed=elapsed, rate=len(orders) / elapsed, fills=fills, resting=resting,
+                p50=percentile(0.50), p99=percentile(0.99), max=latencies[-1] * 10 ** 6
+            )
+        )
@@ -0,0 +1,122 @@
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from market.management.benchmark_database import benchmark_database
+from market.models import Company, InvestmentRecord, Transaction
+
+
+User = get_user_model()
+
+PRICE = Decimal(10.00)
+INITIAL_CASH = Decimal(10000000.00)
+
+
+def legacy_buy(user_pk, company_pk, quantity):
+    """
+    The old order path: net worth computed by the view and again by the Transaction pre_save signal, then
+    read-modify-write of User, Company and InvestmentRecord with one save() each
+    """
+    user = User.objects.get(pk=user_pk)
+    company = Company.objects.get(pk=company_pk)
+    InvestmentRecord.objects.calculate_net_worth(user)
+    net_worth = InvestmentRecord.objects.calculate_net_worth(user)
+    investment_obj, created = InvestmentRecord.objects.get_or_create(user=user, company=company)
+    user.buy_stocks(quantity, PRICE)
+    company.user_buy_stocks(quantity)
+    investment_obj.add_stocks(quantity)
+    Transaction.objects.create(
+        user=user, company=company, num_stocks=quantity, price=PRICE, mode='buy', user_net_worth=net_worth
+    )
+
+
+def atomic_buy(user_pk, company_pk, quantity):
+    """ The order execution path used by CompanyTransactionView """
+    user = User.objects.get(pk=user_pk)
+    company = Company.objects.get(pk=company_pk)
+    Transaction.objects.execute(user, company, 'buy', quantity, PRICE)
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark concurrent buy orders on the legacy and the atomic order path and check for lost updates. '
+        'Runs in a throwaway test database, the configured database is never touched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=8, help='Number of parallel clients (threads)')
+        parser.add_argument('--trades', type=int, default=50, help='Orders placed by each client')
+        parser.add_argument('--users', type=int, default=4, help='Users shared by the clients')
+
+    def handle(self, *args, **options):
+        with benchmark_database(verbosity=options['verbosity']):
+            for name, func in (('legacy', legacy_buy), ('atomic', atomic_buy)):
+                users, company = self.seed(options['users'])
+                elapsed, errors = self.run(func, users, company, options['clients'], options['trades'])
+                self.report(name, users, company, elapsed, errors, options['clients'] * options['trades'])
+
+    def seed(self, num_users):
+        tag = uuid.uuid4().hex[:8]
+        # bulk_create skips the user signals, so no activation mails or holdings fan-out are triggered
+        User.objects.bulk_create([
+            User(
+                username='bench_{tag}_{i}'.format(tag=tag, i=i),
+                email='bench_{tag}_{i}@example.com'.format(tag=tag, i=i),
+                password='!',
+                cash=INITIAL_CASH
+            ) for i in range(num_users)
+        ])
+        users = list(User.objects.filter(username__startswith='bench_{tag}_'.format(tag=tag)))
+        company = Company.objects.create(
+            code='B{tag}'.format(tag=tag[:7]), name='Bench {tag}'.format(tag=tag), cmp=PRICE,
+            stocks_offered=10 ** 9, stocks_remaining=10 ** 9
+        )
+        return users, company
+
+    def run(self, func, users, company, clients, trades):
+        errors = []
+
+        def client(index):
+            user = users[index % len(users)]
+            try:
+                for _ in range(trades):
+                    try:
+                        func(user.pk, company.pk, 1)
+                    except Exception as e:  # e.g. "database is locked" on sqlite
+                        errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=client, args=(i, )) for i in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start, errors
+
+    def report(self, name, users, company, elapsed, errors, orders):
+        company.refresh_from_db()
+        sold = company.stocks_offered - company.stocks_remaining
+        held = sum(InvestmentRecord.objects.filter(company=company).values_list('stocks', flat=True))
+        spent = sum(
+            INITIAL_CASH - cash for cash in User.objects.filter(pk__in=[u.pk for u in users]).values_list(
+                'cash', flat=True
+            )
+        )
+        filled = orders - len(errors)
+        self.stdout.write(
+            '{name}: {filled}/{orders} orders in {elapsed:.3f}s ({tps:.1f} trades/sec), '
+            'inventory sold {sold}, holdings {held}, cash spent for {paid} stocks, '
+            'lost updates: {lost}'.format(
+                name=name, filled=filled, orders=orders, elapsed=elapsed, tps=filled / elapsed,
+                sold=sold, held=held, paid=int(spent / PRICE),
+                lost=max(abs(filled - sold), abs(filled - held), abs(filled - int(spent / PRICE)))
+            )
+        )
+
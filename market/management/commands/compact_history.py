@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from market.retention import (
+    compact_history,
+    CMP_RECORD_RETENTION_DAYS,
+    TRANSACTION_RETENTION_DAYS,
+    TRANSACTION_ARCHIVE_DIR,
+    RETENTION_BATCH_SIZE
+)
+
+
+class Command(BaseCommand):
+    help = 'Compact old market ticks into candles and archive old transactions to gzipped JSON-lines files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cmp-days', type=int, default=CMP_RECORD_RETENTION_DAYS,
+                            help='Market ticks younger than this are kept')
+        parser.add_argument('--transaction-days', type=int, default=TRANSACTION_RETENTION_DAYS,
+                            help='Transactions younger than this are kept')
+        parser.add_argument('--archive-dir', default=TRANSACTION_ARCHIVE_DIR)
+        parser.add_argument('--batch-size', type=int, default=RETENTION_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        results = compact_history(
+            options['cmp_days'], options['transaction_days'], options['archive_dir'], options['batch_size']
+        )
+        if 'cmp_records' in results:
+            self.stdout.write('{0} market ticks compacted, {1} candles created'.format(*results['cmp_records']))
+        if 'transactions' in results:
+            archived, path = results['transactions']
+            if path is None:
+                self.stdout.write('No transactions to archive')
+            else:
+                self.stdout.write('{archived} transactions archived to {path}'.format(archived=archived, path=path))
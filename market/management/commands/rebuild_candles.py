@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from market.models import CompanyCMPRecord, CompanyCandle
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the OHLC candles of every company from the stored market ticks (CompanyCMPRecord).'
+
+    def handle(self, *args, **options):
+        records = CompanyCMPRecord.objects.order_by('timestamp', 'pk').values_list('company_id', 'cmp', 'timestamp')
+        candles = CompanyCandle.objects.from_ticks(records.iterator())
+        with transaction.atomic():
+            CompanyCandle.objects.all().delete()
+            CompanyCandle.objects.bulk_create(list(candles.values()), batch_size=500)
+        self.stdout.write('{num} candles built'.format(num=len(candles)))
@@ -0,0 +1,54 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.db.models import Case, When, Value
+
+from market.models import InvestmentRecord, Transaction, BULK_UPDATE_BATCH_SIZE, TWO_PLACES, FOUR_PLACES
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the average price and realized P&L of every holding from the transaction history. '
+        'Transactions already archived by compact_history are not replayed.'
+    )
+
+    def handle(self, *args, **options):
+        basis = {}  # (user, company) -> [stocks, average price, realized P&L]
+        history = Transaction.objects.order_by('timestamp', 'id').values_list(
+            'user_id', 'company_id', 'mode', 'num_stocks', 'price'
+        )
+        for user_id, company_id, mode, num_stocks, price in history.iterator():  # single pass over the history
+            holding = basis.setdefault((user_id, company_id), [0, Decimal(0.00), Decimal(0.00)])
+            stocks, average_price, realized_pnl = holding
+            if mode == 'buy':
+                holding[1] = ((average_price * stocks + price * num_stocks) / (stocks + num_stocks)).quantize(
+                    FOUR_PLACES
+                )
+                holding[0] = stocks + num_stocks
+            elif mode == 'sell':
+                holding[2] = (realized_pnl + (price - average_price) * num_stocks).quantize(TWO_PLACES)
+                holding[0] = max(stocks - num_stocks, 0)
+
+        ids = dict(
+            ((user_id, company_id), pk) for pk, user_id, company_id in InvestmentRecord.objects.filter(
+                user_id__in={user_id for user_id, _ in basis}
+            ).values_list('pk', 'user_id', 'company_id')
+        )
+        rows = [(ids[key], average_price, realized_pnl) for key, (_, average_price, realized_pnl) in basis.items()
+                if key in ids]
+        with transaction.atomic():
+            InvestmentRecord.objects.update(average_price=0, realized_pnl=0)
+            for i in range(0, len(rows), BULK_UPDATE_BATCH_SIZE):
+                batch = rows[i:i + BULK_UPDATE_BATCH_SIZE]
+                InvestmentRecord.objects.filter(pk__in=[pk for pk, _, _ in batch]).update(
+                    average_price=Case(
+                        *[When(pk=pk, then=Value(average_price)) for pk, average_price, _ in batch],
+                        output_field=models.DecimalField()
+                    ),
+                    realized_pnl=Case(
+                        *[When(pk=pk, then=Value(realized_pnl)) for pk, _, realized_pnl in batch],
+                        output_field=models.DecimalField()
+                    )
+                )
+        self.stdout.write('Rebuilt the cost basis of {holdings} holdings'.format(holdings=len(rows)))
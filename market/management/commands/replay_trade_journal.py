@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from market.journal import replay, TRADE_JOURNAL_DIR, TRADE_JOURNAL_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        'Apply the orders left in the trade journal files (e.g. after a crash). Run it while no web process '
+        'is running, --remove deletes the journal files once they are applied.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=TRADE_JOURNAL_DIR, help='Journal directory (TRADE_JOURNAL_DIR)')
+        parser.add_argument('--batch-size', type=int, default=TRADE_JOURNAL_BATCH_SIZE)
+        parser.add_argument('--remove', action='store_true', help='Delete the journal files once applied')
+
+    def handle(self, *args, **options):
+        if not options['dir']:
+            raise CommandError('The trade journal is disabled, set TRADE_JOURNAL_DIR or pass --dir.')
+        results = replay(options['dir'], batch_size=options['batch_size'], remove=options['remove'])
+        for name, (executed, rejected) in results.items():
+            self.stdout.write('{name}: {executed} orders applied, {rejected} rejected'.format(
+                name=name, executed=executed, rejected=rejected
+            ))
+        self.stdout.write('{num} journal files replayed'.format(num=len(results)))
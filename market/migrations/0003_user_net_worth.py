@@ -0,0 +1,47 @@
+# Generated by Django 2.0.2 on 2026-10-18 16:29
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_net_worth(apps, schema_editor):
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    InvestmentRecord = apps.get_model('market', 'InvestmentRecord')
+    UserNetWorth = apps.get_model('market', 'UserNetWorth')
+    records = []
+    for user in User.objects.all():
+        net_worth = user.cash
+        for inv in InvestmentRecord.objects.filter(user=user, stocks__gt=0).select_related('company'):
+            net_worth += inv.stocks * inv.company.cmp
+        records.append(UserNetWorth(user=user, net_worth=net_worth, coeff_of_variation=user.coeff_of_variation))
+    UserNetWorth.objects.bulk_create(records)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('market', '0002_auto_20180512_1727'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserNetWorth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('net_worth', models.DecimalField(decimal_places=2, default=0.0, max_digits=20)),
+                ('coeff_of_variation', models.DecimalField(decimal_places=2, default=0.0, max_digits=20)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='net_worth_record', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-net_worth', 'coeff_of_variation'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='usernetworth',
+            index=models.Index(fields=['-net_worth', 'coeff_of_variation'], name='market_networth_rank_idx'),
+        ),
+        migrations.RunPython(populate_net_worth, migrations.RunPython.noop),
+    ]
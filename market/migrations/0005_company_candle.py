@@ -0,0 +1,35 @@
+# Generated by Django 2.0.2 on 2026-10-18 16:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0004_trade_journal_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompanyCandle',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interval', models.PositiveIntegerField(choices=[(60, '1 minute'), (300, '5 minutes'), (3600, '1 hour')])),
+                ('start', models.DateTimeField()),
+                ('open', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('high', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('low', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('close', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('ticks', models.PositiveIntegerField(default=0)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='candles', to='market.Company')),
+            ],
+            options={
+                'ordering': ['-start'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='companycandle',
+            unique_together={('company', 'interval', 'start')},
+        ),
+    ]
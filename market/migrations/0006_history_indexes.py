@@ -0,0 +1,29 @@
+# Generated by Django 2.0.2 on 2026-10-18 16:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0005_company_candle'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='companycmprecord',
+            index=models.Index(fields=['company', '-timestamp'], name='market_cmp_company_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='companycmprecord',
+            index=models.Index(fields=['timestamp'], name='market_cmp_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user', '-timestamp'], name='market_txn_user_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['company', '-timestamp'], name='market_txn_company_ts_idx'),
+        ),
+    ]
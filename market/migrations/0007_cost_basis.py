@@ -0,0 +1,23 @@
+# Generated by Django 2.0.2 on 2026-10-18 16:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0006_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='investmentrecord',
+            name='average_price',
+            field=models.DecimalField(decimal_places=4, default=0.0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='investmentrecord',
+            name='realized_pnl',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=20),
+        ),
+    ]
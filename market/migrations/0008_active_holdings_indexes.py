@@ -0,0 +1,26 @@
+from django.db import migrations
+
+
+# Partial indexes over the holdings that contain stocks (InvestmentRecordQuerySet.active()), a small part of
+# the users x companies rows. Django 2.0 indexes have no condition, hence the SQL (valid on SQLite and PostgreSQL).
+ACTIVE_HOLDINGS_INDEXES = (
+    ('market_inv_active_user_idx', 'user_id, company_id, stocks'),
+    ('market_inv_active_company_idx', 'company_id, user_id, stocks'),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0007_cost_basis'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=['CREATE INDEX {name} ON market_investmentrecord ({columns}) WHERE stocks > 0'.format(
+                name=name, columns=columns
+            )],
+            reverse_sql=['DROP INDEX {name}'.format(name=name)],
+        )
+        for name, columns in ACTIVE_HOLDINGS_INDEXES
+    ]
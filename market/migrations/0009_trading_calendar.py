@@ -0,0 +1,41 @@
+# Generated by Django 2.0.2 on 2026-10-18 17:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0008_active_holdings_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TradingHalt',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reason', models.CharField(blank=True, max_length=255)),
+                ('start', models.DateTimeField(default=django.utils.timezone.now)),
+                ('stop', models.DateTimeField(blank=True, null=True)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('company', models.ForeignKey(blank=True, help_text='Leave empty to halt the whole market', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='halts', to='market.Company')),
+            ],
+            options={
+                'ordering': ['-start'],
+            },
+        ),
+        migrations.CreateModel(
+            name='TradingSession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=120)),
+                ('start', models.DateTimeField()),
+                ('stop', models.DateTimeField()),
+            ],
+            options={
+                'ordering': ['start'],
+            },
+        ),
+    ]
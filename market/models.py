@@ -1,12 +1,27 @@
+import logging
+import time
+from datetime import datetime
 from decimal import Decimal
 
-from django.db import models
-from django.db.models.signals import pre_save, post_save
+from django.db import models, transaction, IntegrityError
+from django.db.models import Case, When, Value, F, Q, Sum, OuterRef, Subquery, ExpressionWrapper
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.contrib.auth import get_user_model
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.timezone import utc
+
+from .charts import push_cmp_points, note_price_change
+from .feed import publish_prices
+from .holdings import invalidate_holdings
+from .trading_hours import invalidate_trading_calendar
+from stock_bridge.cache import bump_page_version
 
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
 
 TRANSACTION_MODES = (
     ('buy', 'BUY'),
@@ -19,6 +34,112 @@ CAP_TYPES = (
     ('large', 'Large Cap')
 )
 
+BULK_UPDATE_BATCH_SIZE = 100  # companies per UPDATE statement (keeps sqlite under its variable limit)
+FANOUT_BATCH_SIZE = 500  # InvestmentRecord rows per INSERT when a user or a company is created
+MIN_CMP = Decimal('0.01')
+CANDLE_INTERVALS = (
+    (60, '1 minute'),
+    (300, '5 minutes'),
+    (3600, '1 hour')
+)
+TWO_PLACES = Decimal('0.01')
+FOUR_PLACES = Decimal('0.0001')
+
+
+def money_field():
+    """ Output field for money computed in the database, so that results come back as 2 place Decimals """
+    return models.DecimalField(max_digits=20, decimal_places=2)
+
+
+def bulk_case(values, output_field=None):
+    """ CASE expression setting each row (by pk) to its own value, to update many rows with one statement """
+    if output_field is None:
+        output_field = models.IntegerField() if all(isinstance(value, int) for value in values.values()) \
+            else models.DecimalField()
+    return Case(*[When(pk=pk, then=Value(value)) for pk, value in values.items()], output_field=output_field)
+
+
+class CompanyQuerySet(models.query.QuerySet):
+
+    def update_cmp(self):
+        """
+        Set-based version of Company.update_cmp() for every company in the queryset. The new cmp, change and
+        the reset of temp_stocks_bought/sold are computed in one pass and written back with a single UPDATE per
+        batch, then the CompanyCMPRecord rows are inserted with bulk_create, all inside one transaction.
+        Returns the timings (in seconds) of each phase of the tick.
+        """
+        timings = {}
+        start = time.perf_counter()
+        with transaction.atomic():
+            # locked by pk, the order used by every transaction that locks several companies
+            rows = list(self.select_for_update().order_by('pk').values_list(
+                'pk', 'code', 'cmp', 'change', 'stocks_offered', 'temp_stocks_bought', 'temp_stocks_sold'
+            ))
+            timings['fetch'] = time.perf_counter() - start
+
+            new_values = []
+            price_deltas = {}
+            chart_points = []
+            price_changes = {}
+            for pk, code, cmp, old_change, stocks_offered, bought, sold in rows:
+                if stocks_offered:
+                    new_cmp = cmp + (cmp * Decimal(bought) - cmp * Decimal(sold)) / Decimal(stocks_offered)
+                else:
+                    new_cmp = cmp
+                change = (((new_cmp - cmp) / cmp) * Decimal(100.00)).quantize(TWO_PLACES)
+                new_cmp = max(new_cmp, MIN_CMP).quantize(TWO_PLACES)
+                new_values.append((pk, new_cmp, change))
+                chart_points.append((code, new_cmp))
+                if new_cmp != cmp or change != old_change:
+                    price_changes[code] = {'cmp': new_cmp, 'change': change}
+                if new_cmp != cmp:
+                    price_deltas[pk] = new_cmp - cmp
+            timings['compute'] = time.perf_counter() - start - timings['fetch']
+
+            now = timezone.now()
+            for i in range(0, len(new_values), BULK_UPDATE_BATCH_SIZE):
+                batch = new_values[i:i + BULK_UPDATE_BATCH_SIZE]
+                self.model.objects.filter(pk__in=[pk for pk, _, _ in batch]).update(
+                    cmp=Case(
+                        *[When(pk=pk, then=Value(cmp)) for pk, cmp, _ in batch],
+                        output_field=models.DecimalField()
+                    ),
+                    change=Case(
+                        *[When(pk=pk, then=Value(change)) for pk, _, change in batch],
+                        output_field=models.DecimalField()
+                    ),
+                    temp_stocks_bought=0,
+                    temp_stocks_sold=0,
+                    updated=now
+                )
+            timings['update'] = time.perf_counter() - start - timings['fetch'] - timings['compute']
+
+            CompanyCMPRecord.objects.bulk_create([
+                CompanyCMPRecord(company_id=pk, cmp=cmp) for pk, cmp, _ in new_values
+            ])
+            CompanyCandle.objects.record_ticks([(pk, cmp) for pk, cmp, _ in new_values], now)
+            timings['records'] = time.perf_counter() - start - timings['fetch'] - timings['compute'] - \
+                timings['update']
+
+            UserNetWorth.objects.apply_price_changes(price_deltas)
+            transaction.on_commit(lambda: push_cmp_points(chart_points, now))
+            transaction.on_commit(lambda: publish_prices(price_changes))
+            transaction.on_commit(bump_page_version)
+        timings['total'] = time.perf_counter() - start
+        timings['net_worth'] = timings['total'] - timings['fetch'] - timings['compute'] - timings['update'] - \
+            timings['records']
+        timings['companies'] = len(new_values)
+        return timings
+
+
+class CompanyManager(models.Manager):
+
+    def get_queryset(self):
+        return CompanyQuerySet(self.model, using=self._db)
+
+    def update_cmp(self):
+        return self.get_queryset().update_cmp()
+
 
 class Company(models.Model):
     code = models.CharField(max_length=10, unique=True)
@@ -35,6 +156,8 @@ class Company(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    objects = CompanyManager()
+
     class Meta:
         ordering = ['cap_type', 'code']
 
@@ -59,9 +182,8 @@ class Company(models.Model):
 
     def calculate_change(self, old_price):
         """ Calculate CMP change """
-        print('old', old_price)
         self.change = ((self.cmp - old_price) / old_price) * Decimal(100.00)
-        print(self.change)
+        logger.debug('%s: cmp %s -> %s (%s%%)', self.code, old_price, self.cmp, self.change)
         self.save()
 
     def update_cmp(self):
@@ -100,11 +222,12 @@ pre_save.connect(pre_save_company_receiver, sender=Company)
 
 def post_save_company_receiver(sender, instance, created, *args, **kwargs):
     if created:
-        user_qs = User.objects.all()
-        for user in user_qs:
-            obj, create = InvestmentRecord.objects.get_or_create(user=user, company=instance)
+        InvestmentRecord.objects.create_for_company(instance)
+    transaction.on_commit(lambda: note_price_change(instance.code, instance.cmp, instance.updated))
+    transaction.on_commit(bump_page_version)
 
 post_save.connect(post_save_company_receiver, sender=Company)
+post_delete.connect(bump_page_version, sender=Company)
 
 
 class TransactionQuerySet(models.query.QuerySet):
@@ -118,12 +241,171 @@ class TransactionQuerySet(models.query.QuerySet):
     def get_by_user_and_company(self, user, company):
         return self.get_by_user(user).get_by_company(company)
 
+    def before(self, timestamp, pk):
+        """ Keyset page: the transactions older than (timestamp, pk), newest first """
+        return self.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, pk__lt=pk)
+        ).order_by('-timestamp', '-pk')
+
 
 class TransactionManager(models.Manager):
 
     def get_queryset(self):
         return TransactionQuerySet(self.model, using=self._db)
 
+    def execute(self, user, company, mode, quantity, price=None, timestamp=None):
+        """
+        Execute a buy/sell order of 'quantity' stocks at 'price' (the company's cmp by default), placed at
+        'timestamp' (now by default).
+        The user's cash, the company's inventory and the user's holding are changed with conditional F()
+        updates inside one transaction, so concurrent orders can neither overdraw nor lose updates. Both modes
+        lock the rows in the same order (user, company, holding), so concurrent orders cannot deadlock.
+        Returns the created Transaction, or None if the order could not be filled.
+        """
+        if price is None:
+            price = company.cmp
+        amount = Decimal(quantity) * price
+        with transaction.atomic():
+            if mode == 'buy':
+                filled = (
+                    User.objects.filter(pk=user.pk, cash__gte=amount).update(cash=F('cash') - amount) and
+                    Company.objects.filter(pk=company.pk, stocks_remaining__gte=quantity).update(
+                        stocks_remaining=F('stocks_remaining') - quantity,
+                        temp_stocks_bought=F('temp_stocks_bought') + quantity
+                    ) and
+                    InvestmentRecord.objects.add_stocks(user, company, quantity, price)
+                )
+            elif mode == 'sell':
+                # same row lock order as a purchase, the updates are rolled back if the user owns too few stocks
+                filled = (
+                    User.objects.filter(pk=user.pk).update(cash=F('cash') + amount) and
+                    Company.objects.filter(pk=company.pk, stocks_offered__gte=quantity).update(
+                        stocks_remaining=F('stocks_remaining') + quantity,
+                        temp_stocks_sold=F('temp_stocks_sold') + quantity
+                    ) and
+                    InvestmentRecord.objects.reduce_stocks(user, company, quantity, price)
+                )
+            else:
+                filled = False
+            if not filled:
+                transaction.set_rollback(True)
+                return None
+            user.refresh_from_db(fields=['cash'])
+            obj = self.create(
+                user=user,
+                company=company,
+                num_stocks=quantity,
+                price=price,
+                mode=mode,
+                user_net_worth=InvestmentRecord.objects.calculate_net_worth(user)
+            )
+            if timestamp is not None:  # auto_now_add ignores the value given to create()
+                self.filter(pk=obj.pk).update(timestamp=timestamp)
+                obj.timestamp = timestamp
+            return obj
+
+    def execute_basket(self, user, legs):
+        """
+        Execute a basket of orders [(company, mode, quantity), ...] at the companies' cmp, all of them or none.
+        The user, the companies and the user's holdings are locked and the legs are checked together, sales
+        first, so the proceeds of a sale can pay for a purchase of the same basket. Each table is then written
+        with a single statement.
+        Returns (transactions, errors): the created Transactions, or None and the (leg index, message) errors.
+        """
+        company_ids = sorted({company.pk for company, _, _ in legs})
+        # sales first, in submission order otherwise
+        ordered = sorted(enumerate(legs), key=lambda leg: (leg[1][1] != 'sell', leg[0]))
+        with transaction.atomic():
+            # lock order of execute(): the user, then the companies by pk (like update_cmp()), then the holdings
+            cash = User.objects.select_for_update().filter(pk=user.pk).values_list('cash', flat=True).get()
+            companies = {
+                company.pk: company
+                for company in Company.objects.select_for_update().filter(pk__in=company_ids).order_by('pk')
+            }
+            holdings = self._lock_holdings(user, company_ids)
+
+            errors = []
+            remaining = {pk: company.stocks_remaining for pk, company in companies.items()}
+            bought = dict.fromkeys(company_ids, 0)
+            sold = dict.fromkeys(company_ids, 0)
+            basis = {pk: [record.stocks, record.average_price, record.realized_pnl] for pk, record in holdings.items()}
+            for index, (company, mode, quantity) in ordered:
+                pk, price = company.pk, companies[company.pk].cmp
+                amount = Decimal(quantity) * price
+                stocks, average_price, realized_pnl = basis[pk]
+                if mode == 'sell':
+                    if quantity > stocks or quantity > companies[pk].stocks_offered:
+                        errors.append((index, 'You do not own that many stocks of {code}!'.format(code=company.code)))
+                        continue
+                    basis[pk] = [stocks - quantity, average_price, (
+                        realized_pnl + (price - average_price) * Decimal(quantity)
+                    ).quantize(TWO_PLACES)]
+                    remaining[pk] += quantity
+                    sold[pk] += quantity
+                    cash += amount
+                elif mode == 'buy':
+                    if quantity > remaining[pk]:
+                        errors.append((index, 'The company {code} does not have that many stocks left!'.format(
+                            code=company.code
+                        )))
+                        continue
+                    if amount > cash:
+                        errors.append((index, 'Insufficient Balance for this transaction!'))
+                        continue
+                    basis[pk] = [stocks + quantity, (
+                        (average_price * stocks + amount) / (stocks + quantity)
+                    ).quantize(FOUR_PLACES), realized_pnl]
+                    remaining[pk] -= quantity
+                    bought[pk] += quantity
+                    cash -= amount
+                else:
+                    errors.append((index, 'Please enter a valid mode!'))
+            if errors:
+                transaction.set_rollback(True)
+                return None, sorted(errors)
+
+            User.objects.filter(pk=user.pk).update(cash=cash)
+            Company.objects.filter(pk__in=company_ids).update(
+                stocks_remaining=bulk_case({pk: remaining[pk] for pk in company_ids}),
+                temp_stocks_bought=F('temp_stocks_bought') + bulk_case(bought),
+                temp_stocks_sold=F('temp_stocks_sold') + bulk_case(sold)
+            )
+            records = {holdings[pk].pk: values for pk, values in basis.items()}
+            InvestmentRecord.objects.filter(pk__in=list(records)).update(
+                stocks=bulk_case({pk: stocks for pk, (stocks, _, _) in records.items()}),
+                average_price=bulk_case({pk: average_price for pk, (_, average_price, _) in records.items()}),
+                realized_pnl=bulk_case({pk: realized_pnl for pk, (_, _, realized_pnl) in records.items()})
+            )
+
+            user.refresh_from_db(fields=['cash'])
+            net_worth = InvestmentRecord.objects.calculate_net_worth(user)
+            transactions = [
+                self.model(
+                    user=user, company=company, num_stocks=quantity, price=companies[company.pk].cmp, mode=mode,
+                    user_net_worth=net_worth
+                )
+                for _, (company, mode, quantity) in ordered
+            ]
+            self.bulk_create(transactions)  # post_save is not sent, the CV and net worth are updated here
+            for _ in transactions:
+                user.update_cv(net_worth)
+            UserNetWorth.objects.refresh(users=[user])
+            transaction.on_commit(lambda: invalidate_holdings(user.pk))
+        return transactions, []
+
+    def _lock_holdings(self, user, company_ids):
+        """ The user's holdings in the companies, locked, creating the missing ones """
+        holdings = InvestmentRecord.objects.select_for_update().filter(
+            user=user, company_id__in=company_ids
+        ).order_by('company_id')
+        records = {record.company_id: record for record in holdings}
+        if len(records) < len(company_ids):
+            InvestmentRecord.objects._bulk_create_chunked([
+                InvestmentRecord(user=user, company_id=pk) for pk in company_ids if pk not in records
+            ])
+            records = {record.company_id: record for record in holdings.all()}
+        return records
+
     def get_by_user(self, user):
         return self.get_queryset().get_by_user(user)
 
@@ -133,6 +415,81 @@ class TransactionManager(models.Manager):
     def get_by_user_and_company(self, user, company):
         return self.get_queryset().get_by_user_and_company(user, company)
 
+    def record_fills(self, fills):
+        """
+        Settle a batch of limit order fills (see market.limit_orders) in one transaction: buyers receive the
+        stocks plus the refund of any price improvement on their escrow, sellers receive the cash, one
+        Transaction row per side is bulk inserted and each traded company's cmp moves to its last fill price.
+        """
+        if not fills:
+            return []
+        cash_deltas = {}
+        purchases = {}  # (buyer, company) -> (stocks, cost)
+        sales = {}  # (seller, company) -> (stocks, proceeds), the stocks already left the holding in escrow
+        last_prices = {}
+        for fill in fills:
+            buyer, seller = fill.buy_order.user_id, fill.sell_order.user_id
+            amount = fill.price * Decimal(fill.quantity)
+            refund = (fill.buy_order.price - fill.price) * Decimal(fill.quantity)
+            cash_deltas[buyer] = cash_deltas.get(buyer, Decimal(0.00)) + refund
+            cash_deltas[seller] = cash_deltas.get(seller, Decimal(0.00)) + amount
+            stocks, cost = purchases.get((buyer, fill.company), (0, Decimal(0.00)))
+            purchases[(buyer, fill.company)] = (stocks + fill.quantity, cost + amount)
+            stocks, proceeds = sales.get((seller, fill.company), (0, Decimal(0.00)))
+            sales[(seller, fill.company)] = (stocks + fill.quantity, proceeds + amount)
+            last_prices[fill.company] = fill.price
+
+        with transaction.atomic():
+            # rows are locked in the order of execute(): users, companies, holdings, each by pk
+            for user_id in sorted(cash_deltas):
+                if cash_deltas[user_id]:
+                    User.objects.filter(pk=user_id).update(cash=F('cash') + cash_deltas[user_id])
+
+            old_prices = dict(Company.objects.filter(pk__in=list(last_prices)).values_list('pk', 'cmp'))
+            for company_id in sorted(last_prices):
+                price, old_price = last_prices[company_id], old_prices[company_id]
+                Company.objects.filter(pk=company_id).update(
+                    cmp=price, change=((price - old_price) / old_price) * Decimal(100.00), updated=timezone.now()
+                )
+
+            for (user_id, company_id), (num_stocks, cost) in sorted(purchases.items()):
+                InvestmentRecord.objects.add_stocks(user_id, company_id, num_stocks, cost / Decimal(num_stocks))
+            for (user_id, company_id), (num_stocks, proceeds) in sorted(sales.items()):
+                InvestmentRecord.objects.filter(user_id=user_id, company_id=company_id).update(
+                    realized_pnl=InvestmentRecord.objects.realized_pnl_after_sale(
+                        num_stocks, proceeds / Decimal(num_stocks)
+                    )
+                )
+            UserNetWorth.objects.apply_price_changes({
+                company_id: price - old_prices[company_id] for company_id, price in last_prices.items()
+                if price != old_prices[company_id]
+            })
+
+            users = User.objects.in_bulk(list(cash_deltas))
+            net_worths = InvestmentRecord.objects.calculate_net_worths(User.objects.filter(pk__in=list(users)))
+            transactions = []
+            for fill in fills:
+                for user_id, mode in ((fill.buy_order.user_id, 'buy'), (fill.sell_order.user_id, 'sell')):
+                    transactions.append(self.model(
+                        user_id=user_id, company_id=fill.company, num_stocks=fill.quantity, price=fill.price,
+                        mode=mode, user_net_worth=net_worths[user_id]
+                    ))
+            self.bulk_create(transactions)  # post_save is not sent, the CV and net worth are updated here
+            for record in transactions:
+                users[record.user_id].update_cv(record.user_net_worth)
+            UserNetWorth.objects.refresh(users=list(users))
+            transaction.on_commit(lambda: invalidate_holdings(*users))
+
+            for company in Company.objects.filter(pk__in=list(last_prices)):
+                transaction.on_commit(
+                    lambda company=company: note_price_change(company.code, company.cmp, company.updated)
+                )
+            transaction.on_commit(lambda: publish_prices({
+                company.code: {'cmp': company.cmp, 'change': company.change}
+                for company in Company.objects.filter(pk__in=list(last_prices))
+            }))
+        return transactions
+
 
 class Transaction(models.Model):
     user = models.ForeignKey(User, on_delete=True)
@@ -148,6 +505,10 @@ class Transaction(models.Model):
 
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['user', '-timestamp'], name='market_txn_user_ts_idx'),
+            models.Index(fields=['company', '-timestamp'], name='market_txn_company_ts_idx')
+        ]
 
     def __str__(self):
         return '{user}: {company} - {time}'.format(
@@ -155,33 +516,12 @@ class Transaction(models.Model):
         )
 
 
-def pre_save_transaction_receiver(sender, instance, *args, **kwargs):
-    amount = InvestmentRecord.objects.calculate_net_worth(instance.user)
-    instance.user_net_worth = amount
-
-    # transaction completion reflection in other models
-    investment_obj, obj_created = InvestmentRecord.objects.get_or_create(
-        user=instance.user, company=instance.company
-    )
-    if instance.mode == 'buy':
-        instance.user.buy_stocks(instance.num_stocks, instance.price)
-        instance.company.user_buy_stocks(instance.num_stocks)
-        investment_obj.add_stocks(instance.num_stocks)
-    elif instance.mode == 'sell':
-        instance.user.sell_stocks(instance.num_stocks, instance.price)
-        instance.company.user_sell_stocks(instance.num_stocks)
-        investment_obj.reduce_stocks(instance.num_stocks)
-
-pre_save.connect(pre_save_transaction_receiver, sender=Transaction)
-
-
 def post_save_transaction_create_receiver(sender, instance, created, *args, **kwargs):
     if created:
         # changes to user model
-        net_worth_list = [
-            transaction.user_net_worth for transaction in Transaction.objects.filter(user=instance.user)
-        ]
-        instance.user.update_cv(net_worth_list)
+        instance.user.update_cv(instance.user_net_worth)
+        UserNetWorth.objects.refresh(users=[instance.user])
+        transaction.on_commit(lambda: invalidate_holdings(instance.user_id))
 
 post_save.connect(post_save_transaction_create_receiver, sender=Transaction)
 
@@ -194,6 +534,20 @@ class InvestmentRecordQuerySet(models.query.QuerySet):
     def get_by_company(self, company):
         return self.filter(company=company)
 
+    def active(self):
+        """
+        Holdings that actually contain stocks, served by the partial indexes of migration 0008. The 0 is written
+        in the SQL: SQLite ignores a partial index when its condition is compared to a bound parameter.
+        """
+        return self.filter(stocks__gt=RawSQL('0', []))
+
+    def holdings_value(self):
+        """ Market value (stocks * cmp) of all the holdings in the queryset, summed in the database """
+        total = self.active().aggregate(
+            total=Sum(F('stocks') * F('company__cmp'), output_field=money_field())
+        )['total']
+        return total if total is not None else Decimal(0.00)
+
 
 class InvestmentRecordManager(models.Manager):
 
@@ -206,24 +560,103 @@ class InvestmentRecordManager(models.Manager):
     def get_by_company(self, company):
         return self.get_queryset().get_by_company(company=company)
 
+    def create_for_user(self, user):
+        """ Create the (empty) holdings of a new user in every company """
+        company_ids = Company.objects.exclude(investmentrecord__user=user).values_list('pk', flat=True)
+        return self._bulk_create_chunked([self.model(user=user, company_id=pk) for pk in company_ids.iterator()])
+
+    def create_for_company(self, company):
+        """ Create the (empty) holdings of every user in a new company """
+        user_ids = User.objects.exclude(investmentrecord__company=company).values_list('pk', flat=True)
+        return self._bulk_create_chunked([self.model(user_id=pk, company=company) for pk in user_ids.iterator()])
+
+    def _bulk_create_chunked(self, records):
+        """ bulk_create in chunks, falling back to get_or_create for chunks hit by a concurrent insert """
+        for i in range(0, len(records), FANOUT_BATCH_SIZE):
+            batch = records[i:i + FANOUT_BATCH_SIZE]
+            try:
+                with transaction.atomic():
+                    self.bulk_create(batch)
+            except IntegrityError:
+                for record in batch:
+                    self.get_or_create(user_id=record.user_id, company_id=record.company_id)
+        return len(records)
+
+    def add_stocks(self, user, company, num_stocks, price=None):
+        """
+        Atomically add stocks to the user's holding, creating the holding if needed (accepts objects or pks).
+        Stocks bought at 'price' move the holding's average price, stocks given back (price=None) do not.
+        """
+        holding = {'user_id': getattr(user, 'pk', user), 'company_id': getattr(company, 'pk', company)}
+        changes = {'stocks': F('stocks') + num_stocks}
+        if price is not None:
+            changes['average_price'] = ExpressionWrapper(
+                (F('average_price') * F('stocks') + Value(price * Decimal(num_stocks))) / (F('stocks') + num_stocks),
+                output_field=self.model._meta.get_field('average_price')
+            )
+        updated = self.filter(**holding).update(**changes)
+        if not updated:
+            self.get_or_create(**holding)
+            updated = self.filter(**holding).update(**changes)
+        transaction.on_commit(lambda: invalidate_holdings(holding['user_id']))
+        return updated
+
+    def reduce_stocks(self, user, company, num_stocks, price=None):
+        """
+        Atomically remove stocks from the user's holding, only if the user owns enough of them.
+        Stocks sold at 'price' add their gain over the average price to the realized P&L.
+        """
+        changes = {'stocks': F('stocks') - num_stocks}
+        if price is not None:
+            changes['realized_pnl'] = self.realized_pnl_after_sale(num_stocks, price)
+        updated = self.filter(user=user, company=company, stocks__gte=num_stocks).update(**changes)
+        if updated:
+            transaction.on_commit(lambda: invalidate_holdings(getattr(user, 'pk', user)))
+        return updated
+
+    def realized_pnl_after_sale(self, num_stocks, price):
+        """ Expression of a holding's realized P&L once 'num_stocks' of it are sold at 'price' """
+        return ExpressionWrapper(
+            F('realized_pnl') + (Value(price) - F('average_price')) * Value(num_stocks),
+            output_field=money_field()
+        )
+
     def calculate_net_worth(self, user):
-        qs = self.get_by_user(user)
-        amount = Decimal(0.00)
-        for inv in qs:
-            amount += Decimal(inv.stocks) * inv.company.cmp
-        return amount + user.cash
+        """ Net worth of a single user (cash + market value of holdings + escrow of the open orders) """
+        return self.get_by_user(user).holdings_value() + LimitOrder.objects.escrow_value(user) + user.cash
+
+    def annotate_net_worth(self, user_qs):
+        """ Annotate every user of the queryset with its net worth, all of them computed in one query """
+        holdings = self.get_queryset().filter(user=OuterRef('pk')).active().values('user').annotate(
+            total=Sum(F('stocks') * F('company__cmp'), output_field=money_field())
+        ).values('total')
+        escrow = LimitOrder.objects.open().filter(user=OuterRef('pk')).order_by().values('user').annotate(
+            total=Sum(LimitOrder.objects.escrowed(), output_field=money_field())
+        ).values('total')
+        return user_qs.annotate(net_worth=ExpressionWrapper(
+            Coalesce(Subquery(holdings, output_field=money_field()), Value(0)) +
+            Coalesce(Subquery(escrow, output_field=money_field()), Value(0)) + F('cash'),
+            output_field=money_field()
+        ))
+
+    def calculate_net_worths(self, user_qs):
+        """ Map of user pk to net worth for a whole queryset of users """
+        return dict(self.annotate_net_worth(user_qs).values_list('pk', 'net_worth'))
 
 
 class InvestmentRecord(models.Model):
     user = models.ForeignKey(User, on_delete=True)
     company = models.ForeignKey(Company, on_delete=True)
     stocks = models.IntegerField(default=0)
+    average_price = models.DecimalField(max_digits=20, decimal_places=4, default=0.00)  # cost basis per stock
+    realized_pnl = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
     updated = models.DateTimeField(auto_now=True)
 
     objects = InvestmentRecordManager()
 
     class Meta:
         unique_together = ('user', 'company')
+        # plus partial indexes over the rows with stocks (migration 0008), used through active()
 
     def __str__(self):
         return self.user.username + ' - ' + self.company.code
@@ -238,10 +671,19 @@ class InvestmentRecord(models.Model):
             self.save()
 
 
+def post_save_investment_record_receiver(sender, instance, *args, **kwargs):
+    transaction.on_commit(lambda: invalidate_holdings(instance.user_id))
+
+post_save.connect(post_save_investment_record_receiver, sender=InvestmentRecord)
+
+
 def post_save_user_create_receiver(sender, instance, created, *args, **kwargs):
     if created:
-        for company in Company.objects.all():
-            obj = InvestmentRecord.objects.create(user=instance, company=company)
+        InvestmentRecord.objects.create_for_user(instance)
+        UserNetWorth.objects.create(
+            user=instance, net_worth=instance.cash, coeff_of_variation=instance.coeff_of_variation
+        )
+        transaction.on_commit(bump_page_version)  # a new user on the leaderboard
 
 post_save.connect(post_save_user_create_receiver, sender=User)
 
@@ -255,6 +697,317 @@ class CompanyCMPRecord(models.Model):
 
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['company', '-timestamp'], name='market_cmp_company_ts_idx'),
+            models.Index(fields=['timestamp'], name='market_cmp_ts_idx')  # retention scans
+        ]
 
     def __str__(self):
         return self.company.code
+
+
+def candle_start(timestamp, interval):
+    """ Start of the 'interval' seconds long bucket containing timestamp """
+    seconds = int(timestamp.timestamp())
+    return datetime.fromtimestamp(seconds - seconds % interval, tz=utc)
+
+
+class CompanyCandleManager(models.Manager):
+
+    def record_ticks(self, ticks, timestamp):
+        """
+        Roll the cmp of a market tick into the open candle of every interval.
+        'ticks' is a list of (company pk, cmp). The candles that already exist are updated with one UPDATE
+        per batch and interval, the new ones are bulk inserted.
+        """
+        if not ticks:
+            return
+        company_ids = [pk for pk, _ in ticks]
+        starts = {interval: candle_start(timestamp, interval) for interval, _ in CANDLE_INTERVALS}
+        lookup = Q()
+        for interval, start in starts.items():
+            lookup |= Q(interval=interval, start=start)
+        existing = {
+            (company_id, interval): (pk, high, low, num_ticks)
+            for pk, company_id, interval, high, low, num_ticks in self.filter(lookup, company_id__in=company_ids)
+            .values_list('pk', 'company_id', 'interval', 'high', 'low', 'ticks')
+        }
+        new_candles = []
+        for interval, start in starts.items():
+            updates = []
+            for company_id, cmp in ticks:
+                candle = existing.get((company_id, interval))
+                if candle is None:
+                    new_candles.append(self.model(
+                        company_id=company_id, interval=interval, start=start,
+                        open=cmp, high=cmp, low=cmp, close=cmp, ticks=1
+                    ))
+                else:
+                    pk, high, low, num_ticks = candle
+                    updates.append((pk, max(high, cmp), min(low, cmp), cmp, num_ticks + 1))
+            for i in range(0, len(updates), BULK_UPDATE_BATCH_SIZE):
+                batch = updates[i:i + BULK_UPDATE_BATCH_SIZE]
+                self.filter(pk__in=[row[0] for row in batch]).update(**{
+                    field: Case(
+                        *[When(pk=row[0], then=Value(row[index])) for row in batch],
+                        output_field=self.model._meta.get_field(field)
+                    )
+                    for index, field in enumerate(('high', 'low', 'close', 'ticks'), 1)
+                })
+        self.bulk_create(new_candles, batch_size=FANOUT_BATCH_SIZE)
+
+    def from_ticks(self, ticks):
+        """
+        Unsaved candles of every interval built from (company pk, cmp, timestamp) ticks in time order.
+        Returns {(company pk, interval, start): candle}.
+        """
+        candles = {}
+        for company_id, cmp, timestamp in ticks:
+            for interval, _ in CANDLE_INTERVALS:
+                key = (company_id, interval, candle_start(timestamp, interval))
+                candle = candles.get(key)
+                if candle is None:
+                    candles[key] = self.model(
+                        company_id=company_id, interval=interval, start=key[2],
+                        open=cmp, high=cmp, low=cmp, close=cmp, ticks=1
+                    )
+                else:
+                    candle.high = max(candle.high, cmp)
+                    candle.low = min(candle.low, cmp)
+                    candle.close = cmp
+                    candle.ticks += 1
+        return candles
+
+    def window(self, company, interval, limit):
+        """ The last 'limit' candles of a company as (start, open, high, low, close) tuples, oldest first """
+        candles = self.filter(company=company, interval=interval).order_by('-start').values_list(
+            'start', 'open', 'high', 'low', 'close'
+        )[:limit]
+        return list(reversed(candles))
+
+
+class CompanyCandle(models.Model):
+    """ Open/high/low/close of the market ticks (CompanyCMPRecord) of a company over one time bucket """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='candles')
+    interval = models.PositiveIntegerField(choices=CANDLE_INTERVALS)  # bucket length in seconds
+    start = models.DateTimeField()
+    open = models.DecimalField(max_digits=20, decimal_places=2)
+    high = models.DecimalField(max_digits=20, decimal_places=2)
+    low = models.DecimalField(max_digits=20, decimal_places=2)
+    close = models.DecimalField(max_digits=20, decimal_places=2)
+    ticks = models.PositiveIntegerField(default=0)
+
+    objects = CompanyCandleManager()
+
+    class Meta:
+        ordering = ['-start']
+        unique_together = ('company', 'interval', 'start')
+
+    def __str__(self):
+        return '{code} {interval}s {start}'.format(code=self.company.code, interval=self.interval, start=self.start)
+
+
+class UserNetWorthQuerySet(models.query.QuerySet):
+
+    def ranked(self):
+        """ Leaderboard order: highest net worth first, lower coefficient of variation breaks ties """
+        return self.select_related('user').order_by('-net_worth', 'coeff_of_variation', 'user__username')
+
+
+class UserNetWorthManager(models.Manager):
+
+    def get_queryset(self):
+        return UserNetWorthQuerySet(self.model, using=self._db)
+
+    def ranked(self):
+        return self.get_queryset().ranked()
+
+    def refresh(self, users=None):
+        """
+        Recompute net worth (cash + market value of holdings + escrow of the open orders) and copy the tie breaker for the given users,
+        or for every user when users is None, with a single UPDATE. Missing rows are created first and the cached
+        pages are made stale on commit.
+        """
+        user_qs = User.objects.all()
+        if users is not None:
+            user_qs = user_qs.filter(pk__in=[getattr(user, 'pk', user) for user in users])
+        missing = user_qs.exclude(pk__in=self.values('user_id')).values_list('pk', flat=True)
+        self.bulk_create([self.model(user_id=pk) for pk in missing])
+
+        user_values = InvestmentRecord.objects.annotate_net_worth(User.objects.filter(pk=OuterRef('user')))
+        qs = self.get_queryset()
+        if users is not None:
+            qs = qs.filter(user__in=user_qs)
+        transaction.on_commit(bump_page_version)  # the leaderboard changed
+        return qs.update(
+            net_worth=Subquery(user_values.values('net_worth'), output_field=money_field()),
+            coeff_of_variation=Subquery(
+                user_values.values('coeff_of_variation'), output_field=models.DecimalField()
+            )
+        )
+
+    def apply_price_changes(self, price_deltas):
+        """
+        Shift every holder's net worth by stocks * (new cmp - old cmp) for the companies whose price moved,
+        the stocks escrowed by open sell orders included. price_deltas maps company pk to the price difference
+        of the tick.
+        """
+        if not price_deltas:
+            return 0
+        delta = Case(
+            *[When(company_id=pk, then=Value(diff)) for pk, diff in price_deltas.items()],
+            output_field=models.DecimalField()
+        )
+        holdings = InvestmentRecord.objects.filter(
+            user=OuterRef('user'), company_id__in=list(price_deltas)
+        ).active().values('user').annotate(
+            total=Sum(F('stocks') * delta, output_field=money_field())
+        ).values('total')
+        holders = InvestmentRecord.objects.filter(company_id__in=list(price_deltas)).active().values('user_id')
+        updated = self.filter(user_id__in=holders).update(
+            net_worth=F('net_worth') + Subquery(holdings, output_field=money_field())
+        )
+        sell_orders = LimitOrder.objects.open().filter(mode='sell', company_id__in=list(price_deltas)).order_by()
+        escrow = sell_orders.filter(user=OuterRef('user')).values('user').annotate(
+            total=Sum(F('remaining') * delta, output_field=money_field())
+        ).values('total')
+        self.filter(user_id__in=sell_orders.values('user_id')).update(
+            net_worth=F('net_worth') + Subquery(escrow, output_field=money_field())
+        )
+        return updated
+
+
+class UserNetWorth(models.Model):
+    """ Materialized net worth of every user, kept up to date on trades, market ticks and cash changes """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='net_worth_record')
+    net_worth = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
+    coeff_of_variation = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)  # leaderboard tie breaker
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = UserNetWorthManager()
+
+    class Meta:
+        ordering = ['-net_worth', 'coeff_of_variation']
+        indexes = [
+            models.Index(fields=['-net_worth', 'coeff_of_variation'], name='market_networth_rank_idx')
+        ]
+
+    def __str__(self):
+        return '{user} - {net_worth}'.format(user=self.user.username, net_worth=self.net_worth)
+
+
+class JournalCheckpoint(models.Model):
+    """ Last applied seq of a trade journal file (see market.journal) """
+    name = models.CharField(max_length=120, unique=True)
+    seq = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{name} - {seq}'.format(name=self.name, seq=self.seq)
+
+
+class LimitOrderManager(models.Manager):
+
+    def open(self):
+        """ Orders still resting in the order book, in arrival order """
+        return self.get_queryset().filter(remaining__gt=0).order_by('pk')
+
+    def reduce_remaining(self, quantities):
+        """ Subtract {order pk: quantity} filled or cancelled from the remaining quantity of the orders """
+        if quantities:
+            self.get_queryset().filter(pk__in=list(quantities)).update(
+                remaining=F('remaining') - bulk_case(quantities)
+            )
+
+    def apply_fills(self, fills):
+        """ Record the quantity traded by both orders of every fill (see market.orderbook.Fill) """
+        quantities = {}
+        for fill in fills:
+            for order in (fill.buy_order, fill.sell_order):
+                quantities[order.id] = quantities.get(order.id, 0) + fill.quantity
+        self.reduce_remaining(quantities)
+
+    def escrowed(self):
+        """ Expression of the value an order holds in escrow: cash at its limit price, or stocks at the cmp """
+        return Case(
+            When(mode='buy', then=F('remaining') * F('price')),
+            default=F('remaining') * F('company__cmp'),
+            output_field=money_field()
+        )
+
+    def escrow_value(self, user):
+        """ Value held in escrow by the open orders of the user """
+        total = self.open().filter(user=user).order_by().aggregate(
+            total=Sum(self.escrowed(), output_field=money_field())
+        )['total']
+        return total or Decimal(0.00)
+
+
+class LimitOrder(models.Model):
+    """
+    Order of the order book (see market.limit_orders). 'remaining' is the quantity that is neither filled nor
+    cancelled, its cash or stocks are held in escrow; the resting orders are reloaded from these rows when the
+    process starts.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='limit_orders')
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='limit_orders')
+    mode = models.CharField(max_length=10, choices=TRANSACTION_MODES)
+    price = models.DecimalField(max_digits=20, decimal_places=2)
+    quantity = models.PositiveIntegerField()
+    remaining = models.PositiveIntegerField()
+    timestamp = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = LimitOrderManager()
+
+    class Meta:
+        ordering = ['-timestamp']
+
+    def __str__(self):
+        return '{user} {mode} {remaining}/{quantity} {company} @ {price}'.format(
+            user=self.user.username, mode=self.mode, remaining=self.remaining, quantity=self.quantity,
+            company=self.company.code, price=self.price
+        )
+
+
+class TradingSession(models.Model):
+    """
+    Period during which the market is open, from start to stop included (see market.trading_hours); the market
+    is closed between sessions
+    """
+    name = models.CharField(max_length=120, blank=True)
+    start = models.DateTimeField()
+    stop = models.DateTimeField()
+
+    class Meta:
+        ordering = ['start']
+
+    def __str__(self):
+        return '{name} {start} - {stop}'.format(name=self.name, start=self.start, stop=self.stop).strip()
+
+
+class TradingHalt(models.Model):
+    """ Pause of the whole market, or suspension of one company, from start until stop (or until it is deleted) """
+    company = models.ForeignKey(
+        Company, on_delete=models.CASCADE, blank=True, null=True, related_name='halts',
+        help_text='Leave empty to halt the whole market'
+    )
+    reason = models.CharField(max_length=255, blank=True)
+    start = models.DateTimeField(default=timezone.now)
+    stop = models.DateTimeField(blank=True, null=True)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-start']
+
+    def __str__(self):
+        return '{scope} halted from {start}'.format(scope=self.company or 'Market', start=self.start)
+
+
+def trading_calendar_change_receiver(sender, instance, *args, **kwargs):
+    transaction.on_commit(invalidate_trading_calendar)
+
+post_save.connect(trading_calendar_change_receiver, sender=TradingSession)
+post_delete.connect(trading_calendar_change_receiver, sender=TradingSession)
+post_save.connect(trading_calendar_change_receiver, sender=TradingHalt)
+post_delete.connect(trading_calendar_change_receiver, sender=TradingHalt)
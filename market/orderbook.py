@@ -0,0 +1,176 @@
+"""
+Price-time priority order book and matching engine for limit orders.
+
+This module is plain Python (no database access), so the matching can be benchmarked offline. Each side of
+a book is a heap keyed on (price, arrival sequence); cancelled orders are removed lazily when they reach
+the top of their heap.
+
+Self-trade prevention: an incoming order that would trade with a resting order of the same user stops
+matching there, and its unfilled quantity is cancelled instead of resting (order.cancelled).
+"""
+import heapq
+import itertools
+import threading
+from collections import namedtuple
+
+
+Fill = namedtuple('Fill', ['company', 'buy_order', 'sell_order', 'price', 'quantity'])
+
+
+class Order(object):
+    __slots__ = ('id', 'company', 'user_id', 'side', 'price', 'quantity', 'remaining', 'cancelled', 'seq')
+
+    def __init__(self, id, company, user_id, side, price, quantity, remaining=None):
+        self.id = id
+        self.company = company
+        self.user_id = user_id
+        self.side = side  # 'buy' or 'sell'
+        self.price = price  # limit price
+        self.quantity = quantity
+        self.remaining = quantity if remaining is None else remaining
+        self.cancelled = 0  # quantity cancelled by the self-trade prevention
+        self.seq = None
+
+    def __repr__(self):
+        return '<Order {id}: {side} {remaining}/{quantity} @ {price}>'.format(
+            id=self.id, side=self.side, remaining=self.remaining, quantity=self.quantity, price=self.price
+        )
+
+
+class OrderBook(object):
+    """ Order book of a single company """
+
+    def __init__(self, company):
+        self.company = company
+        self.bids = []  # heap of (-price, seq, order): highest price first
+        self.asks = []  # heap of (price, seq, order): lowest price first
+        self.orders = {}  # resting orders by id
+        self._seq = itertools.count()
+
+    def submit(self, order):
+        """ Match an incoming order against the opposite side and rest what is left. Returns the fills. """
+        order.seq = next(self._seq)
+        fills = []
+        if order.side == 'buy':
+            opposite = self.asks
+            crosses = lambda resting: resting.price <= order.price
+        else:
+            opposite = self.bids
+            crosses = lambda resting: resting.price >= order.price
+
+        while order.remaining and opposite:
+            resting = opposite[0][2]
+            if not resting.remaining:  # cancelled
+                heapq.heappop(opposite)
+                continue
+            if not crosses(resting):
+                break
+            if resting.user_id == order.user_id:
+                order.cancelled, order.remaining = order.remaining, 0
+                break
+            quantity = min(order.remaining, resting.remaining)
+            order.remaining -= quantity
+            resting.remaining -= quantity
+            if order.side == 'buy':
+                fills.append(Fill(self.company, order, resting, resting.price, quantity))
+            else:
+                fills.append(Fill(self.company, resting, order, resting.price, quantity))
+            if not resting.remaining:
+                heapq.heappop(opposite)
+                del self.orders[resting.id]
+
+        if order.remaining:
+            self.rest(order)
+        return fills
+
+    def rest(self, order):
+        """ Add an order to its side of the book without matching it """
+        if order.seq is None:
+            order.seq = next(self._seq)
+        if order.side == 'buy':
+            heapq.heappush(self.bids, (-order.price, order.seq, order))
+        else:
+            heapq.heappush(self.asks, (order.price, order.seq, order))
+        self.orders[order.id] = order
+
+    def cancel(self, order_id):
+        """ Cancel a resting order. Returns the order and its unfilled quantity, or (None, 0). """
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return None, 0
+        remaining, order.remaining = order.remaining, 0
+        return order, remaining
+
+    def _best(self, side):
+        while side and not side[0][2].remaining:
+            heapq.heappop(side)
+        return side[0][2].price if side else None
+
+    def best_bid(self):
+        return self._best(self.bids)
+
+    def best_ask(self):
+        return self._best(self.asks)
+
+
+class MatchingEngine(object):
+    """
+    Order books of every company. Fills are queued and handed to 'on_fills' in batches of 'batch_size'
+    when flush() is called.
+    """
+
+    def __init__(self, on_fills=None, batch_size=500):
+        self.books = {}
+        self.pending = []
+        self.on_fills = on_fills
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def book(self, company):
+        book = self.books.get(company)
+        if book is None:
+            book = self.books[company] = OrderBook(company)
+        return book
+
+    def submit(self, company, user_id, side, price, quantity, order_id=None):
+        with self.lock:
+            order = Order(order_id or next(self._ids), company, user_id, side, price, quantity)
+            fills = self.book(company).submit(order)
+            self.pending.extend(fills)
+        return order, fills
+
+    def restore(self, orders):
+        """ Rest orders saved before a restart, in arrival order, without matching them again """
+        with self.lock:
+            for order in orders:
+                self.book(order.company).rest(order)
+
+    def cancel(self, company, order_id, user_id=None):
+        with self.lock:
+            book = self.book(company)
+            order = book.orders.get(order_id)
+            if order is None or (user_id is not None and order.user_id != user_id):
+                return None, 0
+            return book.cancel(order_id)
+
+    def open_orders(self, company, user_id):
+        with self.lock:
+            return sorted(
+                (order for order in self.book(company).orders.values() if order.user_id == user_id),
+                key=lambda order: order.seq
+            )
+
+    def flush(self):
+        """ Hand the queued fills to on_fills in batches. Returns the number of fills flushed. """
+        with self.lock:
+            fills, self.pending = self.pending, []
+        if self.on_fills is not None:
+            for i in range(0, len(fills), self.batch_size):
+                try:
+                    self.on_fills(fills[i:i + self.batch_size])
+                except Exception:
+                    with self.lock:  # keep the fills that were not persisted for the next flush
+                        self.pending[:0] = fills[i:]
+                    raise
+        return len(fills)
@@ -0,0 +1,108 @@
+"""
+Retention of the market history.
+
+Market ticks (CompanyCMPRecord) older than CMP_RECORD_RETENTION_DAYS are compacted into candles (only the
+buckets that have no candle yet, the live rollup is kept as is) and deleted, one UTC day at a time. The cutoff
+is rounded down to the start of the longest candle interval, so a bucket is never compacted from part of its
+ticks.
+Transactions older than TRANSACTION_RETENTION_DAYS are written to a gzipped JSON-lines archive in
+TRANSACTION_ARCHIVE_DIR and deleted once the archive is on disk. Run with 'manage.py compact_history'.
+"""
+import gzip
+import json
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import CANDLE_INTERVALS, CompanyCMPRecord, CompanyCandle, Transaction, candle_start
+
+
+CMP_RECORD_RETENTION_DAYS = getattr(settings, 'CMP_RECORD_RETENTION_DAYS', 7)
+TRANSACTION_RETENTION_DAYS = getattr(settings, 'TRANSACTION_RETENTION_DAYS', 90)
+TRANSACTION_ARCHIVE_DIR = getattr(settings, 'TRANSACTION_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'archive'))
+RETENTION_BATCH_SIZE = getattr(settings, 'RETENTION_BATCH_SIZE', 5000)
+
+
+def delete_in_batches(queryset, batch_size=RETENTION_BATCH_SIZE):
+    """ Delete the rows of a queryset by batches of primary keys, so that no statement runs for long """
+    model = queryset.model
+    deleted = 0
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        with transaction.atomic():
+            deleted += model.objects.filter(pk__in=pks).delete()[0]
+
+
+def compact_cmp_records(cutoff, batch_size=RETENTION_BATCH_SIZE):
+    """
+    Fold the ticks older than cutoff (rounded down to a bucket boundary of every candle interval) into candles
+    and delete them. Returns (ticks deleted, candles created).
+    """
+    cutoff = candle_start(cutoff, max(interval for interval, _ in CANDLE_INTERVALS))
+    first = CompanyCMPRecord.objects.filter(timestamp__lt=cutoff).order_by('timestamp').values_list(
+        'timestamp', flat=True
+    ).first()
+    deleted = created = 0
+    day = candle_start(first, 60 * 60 * 24) if first is not None else cutoff
+    while day < cutoff:
+        end = min(day + timedelta(days=1), cutoff)
+        ticks = CompanyCMPRecord.objects.filter(timestamp__gte=day, timestamp__lt=end)
+        candles = CompanyCandle.objects.from_ticks(
+            ticks.order_by('timestamp', 'pk').values_list('company_id', 'cmp', 'timestamp').iterator()
+        )
+        existing = set(CompanyCandle.objects.filter(start__gte=day, start__lt=end).values_list(
+            'company_id', 'interval', 'start'
+        ))
+        with transaction.atomic():
+            missing = [candle for key, candle in candles.items() if key not in existing]
+            CompanyCandle.objects.bulk_create(missing, batch_size=500)
+        created += len(missing)
+        deleted += delete_in_batches(ticks, batch_size)
+        day = end
+    return deleted, created
+
+
+def archive_transactions(cutoff, directory=TRANSACTION_ARCHIVE_DIR, batch_size=RETENTION_BATCH_SIZE):
+    """
+    Write the transactions older than cutoff to '<directory>/transactions-<cutoff>.jsonl.gz', then delete
+    them. Returns (rows archived, archive path), the path is None if there was nothing to archive.
+    """
+    old = Transaction.objects.filter(timestamp__lt=cutoff).order_by('pk')
+    last_pk = old.values_list('pk', flat=True).last()
+    if last_pk is None:
+        return 0, None
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'transactions-{cutoff}.jsonl.gz'.format(cutoff=cutoff.strftime('%Y%m%d%H%M%S')))
+    fields = ('pk', 'user_id', 'company_id', 'num_stocks', 'price', 'mode', 'user_net_worth', 'timestamp')
+    archived = 0
+    with open(path, 'ab') as raw, gzip.GzipFile(fileobj=raw, mode='ab') as archive:
+        rows = old.filter(pk__lte=last_pk).values_list(*fields).iterator()
+        for row in rows:
+            record = dict(zip(fields, row))
+            record['price'] = str(record['price'])
+            record['user_net_worth'] = str(record['user_net_worth'])
+            record['timestamp'] = record['timestamp'].isoformat()
+            archive.write((json.dumps(record) + '\n').encode())
+            archived += 1
+        archive.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    delete_in_batches(old.filter(pk__lte=last_pk), batch_size)
+    return archived, path
+
+
+def compact_history(cmp_days=CMP_RECORD_RETENTION_DAYS, transaction_days=TRANSACTION_RETENTION_DAYS,
+                    directory=TRANSACTION_ARCHIVE_DIR, batch_size=RETENTION_BATCH_SIZE):
+    """ Run both retention jobs, a retention of None keeps that history forever """
+    now = timezone.now()
+    results = {}
+    if cmp_days is not None:
+        results['cmp_records'] = compact_cmp_records(now - timedelta(days=cmp_days), batch_size)
+    if transaction_days is not None:
+        results['transactions'] = archive_transactions(now - timedelta(days=transaction_days), directory, batch_size)
+    return results
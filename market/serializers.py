@@ -0,0 +1,30 @@
+from django.conf import settings
+from rest_framework import serializers
+
+from .models import Company, TRANSACTION_MODES
+
+
+MAX_BASKET_LEGS = getattr(settings, 'MAX_BASKET_LEGS', 50)
+
+
+class OrderLegSerializer(serializers.Serializer):
+    """ One buy/sell order of a basket, the company is given by its code """
+    company = serializers.CharField(max_length=10)
+    mode = serializers.ChoiceField(choices=TRANSACTION_MODES)
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class BasketOrderSerializer(serializers.Serializer):
+    """ Orders executed together by Transaction.objects.execute_basket() """
+    legs = OrderLegSerializer(many=True, allow_empty=False)
+
+    def validate_legs(self, legs):
+        if len(legs) > MAX_BASKET_LEGS:
+            raise serializers.ValidationError('A basket cannot have more than {num} legs.'.format(num=MAX_BASKET_LEGS))
+        companies = Company.objects.in_bulk({leg['company'] for leg in legs}, field_name='code')
+        unknown = sorted({leg['company'] for leg in legs} - set(companies))
+        if unknown:
+            raise serializers.ValidationError('Unknown companies: {codes}'.format(codes=', '.join(unknown)))
+        for leg in legs:
+            leg['company'] = companies[leg['company']]
+        return legs
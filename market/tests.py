@@ -1,3 +1,688 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils.timezone import utc
+
+from . import limit_orders
+from .feed import CacheBroker, changes_since, publish_prices
+from .holdings import GENERATION_KEY, get_holdings
+from .journal import DEAD_LETTER_FILE, TradeJournal, apply_entries
+from .models import (
+    Company, CompanyCandle, CompanyCMPRecord, InvestmentRecord, JournalCheckpoint, LimitOrder, TradingHalt,
+    TradingSession, Transaction, UserNetWorth
+)
+from .orderbook import MatchingEngine, Order, OrderBook
+from .retention import compact_cmp_records
+from .trading_hours import TradingCalendar, trading_calendar
+
+
+User = get_user_model()
+
+
+class OrderBookTests(SimpleTestCase):
+
+    def setUp(self):
+        self.book = OrderBook(1)
+        self.ids = iter(range(1, 100))
+
+    def submit(self, user_id, side, price, quantity):
+        order = Order(next(self.ids), 1, user_id, side, Decimal(price), quantity)
+        return order, self.book.submit(order)
+
+    def test_orders_that_do_not_cross_rest(self):
+        buy, fills = self.submit(1, 'buy', 99, 10)
+        sell, more_fills = self.submit(2, 'sell', 101, 10)
+        self.assertEqual(fills + more_fills, [])
+        self.assertEqual(self.book.best_bid(), Decimal(99))
+        self.assertEqual(self.book.best_ask(), Decimal(101))
+
+    def test_fill_at_resting_price_with_price_time_priority(self):
+        first, _ = self.submit(1, 'sell', 100, 5)
+        second, _ = self.submit(2, 'sell', 100, 5)
+        cheaper, _ = self.submit(3, 'sell', 99, 5)
+        buy, fills = self.submit(4, 'buy', 101, 12)
+        self.assertEqual(
+            [(fill.sell_order, fill.price, fill.quantity) for fill in fills],
+            [(cheaper, Decimal(99), 5), (first, Decimal(100), 5), (second, Decimal(100), 2)]
+        )
+        self.assertEqual(buy.remaining, 0)
+        self.assertEqual(second.remaining, 3)
+        self.assertEqual(list(self.book.orders), [second.id])
+
+    def test_partial_fill_rests_the_rest(self):
+        self.submit(1, 'buy', 100, 4)
+        sell, fills = self.submit(2, 'sell', 100, 10)
+        self.assertEqual(sum(fill.quantity for fill in fills), 4)
+        self.assertEqual(sell.remaining, 6)
+        self.assertEqual(self.book.best_ask(), Decimal(100))
+        self.assertIsNone(self.book.best_bid())
+
+    def test_cancelled_order_is_skipped(self):
+        resting, _ = self.submit(1, 'sell', 100, 5)
+        self.assertEqual(self.book.cancel(resting.id), (resting, 5))
+        self.assertEqual(self.book.cancel(resting.id), (None, 0))
+        buy, fills = self.submit(2, 'buy', 100, 5)
+        self.assertEqual(fills, [])
+        self.assertEqual(buy.remaining, 5)
+
+    def test_self_trade_is_cancelled(self):
+        other, _ = self.submit(2, 'sell', 99, 3)
+        own, _ = self.submit(1, 'sell', 100, 5)
+        behind, _ = self.submit(3, 'sell', 100, 5)
+        buy, fills = self.submit(1, 'buy', 101, 10)
+        self.assertEqual([(fill.sell_order, fill.quantity) for fill in fills], [(other, 3)])
+        self.assertEqual((buy.remaining, buy.cancelled), (0, 7))
+        self.assertNotIn(buy.id, self.book.orders)
+        self.assertEqual((own.remaining, behind.remaining), (5, 5))
+
+    def test_own_order_that_does_not_cross_is_not_cancelled(self):
+        self.submit(1, 'sell', 105, 5)
+        buy, fills = self.submit(1, 'buy', 100, 5)
+        self.assertEqual((buy.remaining, buy.cancelled), (5, 0))
+
+    def test_restored_orders_keep_their_priority(self):
+        engine = MatchingEngine()
+        first = Order(7, 1, 1, 'sell', Decimal(100), 10, remaining=4)
+        second = Order(8, 1, 2, 'sell', Decimal(100), 10)
+        engine.restore([first, second])
+        order, fills = engine.submit(1, 3, 'buy', Decimal(100), 6)
+        self.assertEqual([(fill.sell_order.id, fill.quantity) for fill in fills], [(7, 4), (8, 2)])
+
+
+class MatchingEngineTests(SimpleTestCase):
+
+    def test_cancel_only_own_orders(self):
+        engine = MatchingEngine()
+        order, _ = engine.submit(1, 1, 'buy', Decimal(100), 5)
+        self.assertEqual(engine.cancel(1, order.id, user_id=2), (None, 0))
+        self.assertEqual(engine.open_orders(1, 1), [order])
+        self.assertEqual(engine.cancel(1, order.id, user_id=1), (order, 5))
+        self.assertEqual(engine.open_orders(1, 1), [])
+
+    def test_failed_flush_keeps_the_fills(self):
+        batches = []
+
+        def on_fills(fills):
+            batches.append(fills)
+            if len(batches) == 1:
+                raise RuntimeError
+
+        engine = MatchingEngine(on_fills=on_fills, batch_size=1)
+        engine.submit(1, 1, 'sell', Decimal(100), 2)
+        engine.submit(1, 2, 'buy', Decimal(100), 1)
+        engine.submit(1, 3, 'buy', Decimal(100), 1)
+        with self.assertRaises(RuntimeError):
+            engine.flush()
+        self.assertEqual(engine.flush(), 2)
+        self.assertEqual(len(batches), 3)
+
+
+class MarketTestCase(TestCase):
+
+    def create_user(self, username, cash=Decimal(10000)):
+        user = User.objects.create_user(username, '{name}@example.com'.format(name=username), password='pass')
+        User.objects.filter(pk=user.pk).update(cash=cash)
+        return User.objects.get(pk=user.pk)
+
+    def create_company(self, code, cmp=Decimal(100), stocks=1000):
+        return Company.objects.create(
+            code=code, name='Company {code}'.format(code=code), cmp=cmp, stocks_offered=stocks,
+            stocks_remaining=stocks, cap_type='small'
+        )
+
+
+class TransactionExecuteTests(MarketTestCase):
+
+    def setUp(self):
+        self.company = self.create_company('TX', cmp=Decimal(100), stocks=100)
+        self.user = self.create_user('trader', cash=Decimal(1000))
+
+    def holding(self):
+        return InvestmentRecord.objects.get(user=self.user, company=self.company)
+
+    def test_buy_moves_cash_stocks_and_inventory(self):
+        transaction = Transaction.objects.execute(self.user, self.company, 'buy', 4)
+        self.assertEqual((transaction.num_stocks, transaction.price), (4, Decimal(100)))
+        self.assertEqual(User.objects.get(pk=self.user.pk).cash, Decimal(600))
+        self.assertEqual(self.holding().stocks, 4)
+        company = Company.objects.get(pk=self.company.pk)
+        self.assertEqual((company.stocks_remaining, company.temp_stocks_bought), (96, 4))
+
+    def test_buy_cannot_overdraw(self):
+        self.assertIsNone(Transaction.objects.execute(self.user, self.company, 'buy', 11))
+        self.assertEqual(User.objects.get(pk=self.user.pk).cash, Decimal(1000))
+        self.assertEqual(self.holding().stocks, 0)
+        self.assertEqual(Company.objects.get(pk=self.company.pk).stocks_remaining, 100)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_buy_cannot_exceed_the_stocks_left(self):
+        rich = self.create_user('rich', cash=Decimal(10 ** 6))
+        self.assertIsNone(Transaction.objects.execute(rich, self.company, 'buy', 101))
+        self.assertEqual(User.objects.get(pk=rich.pk).cash, Decimal(10 ** 6))
+
+    def test_sell_needs_the_stocks(self):
+        Transaction.objects.execute(self.user, self.company, 'buy', 2)
+        self.assertIsNone(Transaction.objects.execute(self.user, self.company, 'sell', 3))
+        self.assertEqual(User.objects.get(pk=self.user.pk).cash, Decimal(800))
+        self.assertEqual(self.holding().stocks, 2)
+        self.assertEqual(Company.objects.get(pk=self.company.pk).stocks_remaining, 98)
+
+    def test_sell_realizes_pnl_on_the_average_price(self):
+        Transaction.objects.execute(self.user, self.company, 'buy', 2)
+        Transaction.objects.execute(self.user, self.company, 'buy', 2, price=Decimal(110))
+        self.assertEqual(self.holding().average_price, Decimal(105))
+        Transaction.objects.execute(self.user, self.company, 'sell', 3, price=Decimal(120))
+        holding = self.holding()
+        self.assertEqual((holding.stocks, holding.average_price, holding.realized_pnl), (1, Decimal(105), Decimal(45)))
+        self.assertEqual(User.objects.get(pk=self.user.pk).cash, Decimal(1000 - 420 + 360))
+
+    def test_updates_do_not_use_stale_objects(self):
+        """ Two orders placed with the same stale user and company objects, as two concurrent requests would """
+        user = User.objects.get(pk=self.user.pk)
+        company = Company.objects.get(pk=self.company.pk)
+        stale_user = User.objects.get(pk=self.user.pk)
+        Transaction.objects.execute(user, company, 'buy', 6)
+        self.assertIsNone(Transaction.objects.execute(stale_user, company, 'buy', 6))
+        Transaction.objects.execute(stale_user, company, 'buy', 4)
+        self.assertEqual(User.objects.get(pk=self.user.pk).cash, Decimal(0))
+        self.assertEqual(stale_user.cash, Decimal(0))
+        self.assertEqual(self.holding().stocks, 10)
+        self.assertEqual(Company.objects.get(pk=self.company.pk).stocks_remaining, 90)
+
+
+class BasketOrderTests(MarketTestCase):
+
+    def setUp(self):
+        self.first = self.create_company('B1', cmp=Decimal(100), stocks=100)
+        self.second = self.create_company('B2', cmp=Decimal(50), stocks=100)
+        self.user = self.create_user('basket', cash=Decimal(100))
+        InvestmentRecord.objects.filter(user=self.user, company=self.first).update(stocks=5, average_price=80)
+
+    def holding(self, company):
+        return InvestmentRecord.objects.get(user=self.user, company=company)
+
+    def test_sale_pays_for_a_purchase_of_the_same_basket(self):
+        transactions, errors = Transaction.objects.execute_basket(
+            self.user, [(self.second, 'buy', 6), (self.first, 'sell', 3)]
+        )
+        self.assertEqual(errors, [])
+        self.assertEqual([(t.mode, t.num_stocks) for t in transactions], [('sell', 3), ('buy', 6)])
+        self.assertEqual(User.objects.get(pk=self.user.pk).cash, Decimal(100 + 300 - 300))
+        first, second = self.holding(self.first), self.holding(self.second)
+        self.assertEqual((first.stocks, first.realized_pnl), (2, Decimal(60)))
+        self.assertEqual((second.stocks, second.average_price), (6, Decimal(50)))
+        self.assertEqual(Company.objects.get(pk=self.first.pk).stocks_remaining, 103)
+        self.assertEqual(Company.objects.get(pk=self.second.pk).temp_stocks_bought, 6)
+
+    def test_basket_is_all_or_nothing(self):
+        transactions, errors = Transaction.objects.execute_basket(
+            self.user, [(self.first, 'sell', 1), (self.second, 'buy', 10), (self.first, 'sell', 10)]
+        )
+        self.assertIsNone(transactions)
+        self.assertEqual([index for index, _ in errors], [1, 2])
+        self.assertEqual(User.objects.get(pk=self.user.pk).cash, Decimal(100))
+        self.assertEqual(self.holding(self.first).stocks, 5)
+        self.assertEqual(self.holding(self.second).stocks, 0)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_basket_api(self):
+        self.client.force_login(self.user)
+        url = reverse('market:basket')
+        legs = [{'company': 'B1', 'mode': 'sell', 'quantity': 2}, {'company': 'B2', 'mode': 'buy', 'quantity': 2}]
+        with mock.patch.object(trading_calendar, 'closed_reason', return_value=None):
+            response = self.client.post(url, json.dumps({'legs': legs}), content_type='application/json')
+            self.assertEqual(response.status_code, 201, response.content)
+            self.assertEqual(len(response.json()['transactions']), 2)
+            unknown = [{'company': 'XX', 'mode': 'buy', 'quantity': 1}]
+            response = self.client.post(url, json.dumps({'legs': unknown}), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, json.dumps({'legs': legs}), content_type='application/json')
+        self.assertEqual(response.status_code, 403)  # the market is closed
+
+
+class TradeJournalTests(MarketTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.company = self.create_company('TJ')
+        self.user = self.create_user('journal', cash=Decimal(1000))
+
+    def entry(self, seq, price='100', time='2018-03-01T10:00:00+00:00'):
+        return {
+            'seq': seq, 'user': self.user.pk, 'company': self.company.pk, 'mode': 'buy', 'quantity': 1,
+            'price': price, 'time': time
+        }
+
+    def test_failing_entry_is_dead_lettered_alone(self):
+        entries = [self.entry(1), self.entry(2, price='not a price'), self.entry(3, price='10000'), self.entry(4)]
+        # TestCase never commits, the dead letters are written by an on_commit callback
+        with mock.patch('django.db.transaction.on_commit', lambda callback: callback()), \
+                self.assertLogs('market.journal', 'WARNING') as logs:
+            self.assertEqual(apply_entries('trades-1.log', entries, self.directory), (2, 2))
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(Transaction.objects.count(), 2)
+        self.assertEqual(JournalCheckpoint.objects.get(name='trades-1.log').seq, 4)
+        with open(os.path.join(self.directory, DEAD_LETTER_FILE)) as dead_letters:
+            lines = [json.loads(line) for line in dead_letters]
+        self.assertEqual([line['entry']['seq'] for line in lines], [2])
+        self.assertEqual(apply_entries('trades-1.log', entries, self.directory), (0, 0))
+
+    def test_orders_left_by_a_crashed_process_with_the_same_pid_are_applied(self):
+        name = 'trades-{pid}.log'.format(pid=os.getpid())
+        with open(os.path.join(self.directory, name), 'w') as journal_file:
+            for seq in (1, 2, 3):
+                journal_file.write(json.dumps(self.entry(seq)) + '\n')
+        apply_entries(name, [self.entry(1)], self.directory)
+
+        with mock.patch.object(TradeJournal, '_start'):  # applied below, in the test's transaction
+            journal = TradeJournal(self.directory)
+            self.assertEqual([entry['seq'] for entry in journal.pending], [2, 3])
+            self.assertEqual(journal.append(self.user, self.company, 'buy', 1, Decimal(100)), 4)
+            self.assertEqual(journal.flush(), 3)
+        journal.file.close()
+        self.assertEqual(Transaction.objects.count(), 4)
+        self.assertEqual(JournalCheckpoint.objects.get(name=name).seq, 4)
+
+    def test_transactions_are_stamped_with_the_journal_time(self):
+        apply_entries('trades-1.log', [self.entry(1, time='2018-03-01T10:00:00+00:00')], self.directory)
+        self.assertEqual(Transaction.objects.get().timestamp, datetime(2018, 3, 1, 10, tzinfo=utc))
+
+
+class LimitOrderTests(MarketTestCase):
+
+    def setUp(self):
+        engine = MatchingEngine(on_fills=limit_orders.settle_fills)
+        for name, value in (('engine', engine), ('_restored', False)):
+            patcher = mock.patch.object(limit_orders, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.company = self.create_company('LO')
+        self.buyer = self.create_user('buyer')
+        self.seller = self.create_user('seller')
+        InvestmentRecord.objects.filter(user=self.seller, company=self.company).update(stocks=50)
+
+    def cash(self, user):
+        return User.objects.get(pk=user.pk).cash
+
+    def stocks(self, user):
+        return InvestmentRecord.objects.get(user=user, company=self.company).stocks
+
+    def test_fill_settles_and_records_the_orders(self):
+        sell, _ = limit_orders.place_limit_order(self.seller, self.company, 'sell', 10, Decimal(100))
+        buy, fills = limit_orders.place_limit_order(self.buyer, self.company, 'buy', 4, Decimal(110))
+        self.assertEqual(len(fills), 1)
+        self.assertEqual(self.cash(self.buyer), Decimal(10000 - 400))  # the price improvement is refunded
+        self.assertEqual(self.cash(self.seller), Decimal(10000 + 400))
+        self.assertEqual((self.stocks(self.buyer), self.stocks(self.seller)), (4, 40))
+        self.assertEqual(LimitOrder.objects.get(pk=sell.id).remaining, 6)
+        self.assertEqual(LimitOrder.objects.get(pk=buy.id).remaining, 0)
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_uncovered_order_is_rejected(self):
+        order, fills = limit_orders.place_limit_order(self.buyer, self.company, 'buy', 1000, Decimal(100))
+        self.assertIsNone(order)
+        self.assertFalse(LimitOrder.objects.exists())
+        self.assertEqual(self.cash(self.buyer), Decimal(10000))
+
+    def test_cancel_refunds_the_escrow(self):
+        order, _ = limit_orders.place_limit_order(self.buyer, self.company, 'buy', 10, Decimal(90))
+        self.assertEqual(self.cash(self.buyer), Decimal(10000 - 900))
+        self.assertEqual(limit_orders.cancel_limit_order(self.seller, self.company, order.id), 0)
+        self.assertEqual(limit_orders.cancel_limit_order(self.buyer, self.company, order.id), 10)
+        self.assertEqual(self.cash(self.buyer), Decimal(10000))
+        self.assertEqual(LimitOrder.objects.get(pk=order.id).remaining, 0)
+
+    def test_self_trade_refunds_the_cancelled_quantity(self):
+        InvestmentRecord.objects.filter(user=self.buyer, company=self.company).update(stocks=5)
+        limit_orders.place_limit_order(self.buyer, self.company, 'sell', 5, Decimal(100))
+        order, fills = limit_orders.place_limit_order(self.buyer, self.company, 'buy', 5, Decimal(100))
+        self.assertEqual((fills, order.cancelled), ([], 5))
+        self.assertEqual(self.cash(self.buyer), Decimal(10000))
+        self.assertEqual(LimitOrder.objects.get(pk=order.id).remaining, 0)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_open_orders_survive_a_restart(self):
+        sell, _ = limit_orders.place_limit_order(self.seller, self.company, 'sell', 10, Decimal(100))
+        limit_orders.place_limit_order(self.buyer, self.company, 'buy', 3, Decimal(100))
+        limit_orders.engine = MatchingEngine(on_fills=limit_orders.settle_fills)
+        limit_orders._restored = False
+
+        restored = limit_orders.open_orders(self.seller, self.company)
+        self.assertEqual([(order.id, order.remaining) for order in restored], [(sell.id, 7)])
+        buy, fills = limit_orders.place_limit_order(self.buyer, self.company, 'buy', 7, Decimal(100))
+        self.assertEqual(sum(fill.quantity for fill in fills), 7)
+        self.assertEqual(self.stocks(self.buyer), 10)
+        self.assertFalse(LimitOrder.objects.open().exists())
+
+    def test_resting_orders_keep_the_net_worth(self):
+        UserNetWorth.objects.refresh()
+        before = dict(UserNetWorth.objects.values_list('user_id', 'net_worth'))
+        limit_orders.place_limit_order(self.buyer, self.company, 'buy', 10, Decimal(90))
+        limit_orders.place_limit_order(self.seller, self.company, 'sell', 20, Decimal(120))
+        after = dict(UserNetWorth.objects.values_list('user_id', 'net_worth'))
+        self.assertEqual(after, before)
+        self.assertEqual(InvestmentRecord.objects.calculate_net_worth(self.seller), before[self.seller.pk])
+
+    def test_price_change_moves_the_escrowed_stocks(self):
+        UserNetWorth.objects.refresh()
+        limit_orders.place_limit_order(self.seller, self.company, 'sell', 20, Decimal(120))
+        Company.objects.filter(pk=self.company.pk).update(cmp=Decimal(110))
+        UserNetWorth.objects.apply_price_changes({self.company.pk: Decimal(10)})
+        shifted = UserNetWorth.objects.get(user=self.seller).net_worth
+        UserNetWorth.objects.refresh(users=[self.seller])
+        self.assertEqual(shifted, UserNetWorth.objects.get(user=self.seller).net_worth)
+        self.assertEqual(shifted, Decimal(10000 + 50 * 110))
+
+
+class RetentionTests(MarketTestCase):
+
+    def test_cutoff_is_aligned_on_a_bucket_boundary(self):
+        company = self.create_company('RT')
+        hour = datetime(2018, 3, 1, 10, tzinfo=utc)
+        stamps = [hour - timedelta(minutes=10), hour + timedelta(minutes=10), hour + timedelta(minutes=40)]
+        CompanyCMPRecord.objects.all().delete()
+        CompanyCMPRecord.objects.bulk_create([CompanyCMPRecord(company=company, cmp=100) for _ in stamps])
+        for pk, stamp in zip(CompanyCMPRecord.objects.order_by('pk').values_list('pk', flat=True), stamps):
+            CompanyCMPRecord.objects.filter(pk=pk).update(timestamp=stamp)
+
+        deleted, created = compact_cmp_records(hour + timedelta(minutes=30))
+        self.assertEqual(deleted, 1)
+        self.assertEqual(sorted(CompanyCMPRecord.objects.values_list('timestamp', flat=True)), stamps[1:])
+        self.assertFalse(CompanyCandle.objects.filter(start__gte=hour).exists())
+        self.assertTrue(CompanyCandle.objects.filter(interval=3600, start=hour - timedelta(hours=1)).exists())
+
+
+class TradingCalendarTests(MarketTestCase):
+
+    def setUp(self):
+        self.start = datetime(2018, 3, 1, 9, tzinfo=utc)
+        self.stop = datetime(2018, 3, 1, 17, tzinfo=utc)
+        TradingSession.objects.create(start=self.start, stop=self.stop)
+        self.calendar = TradingCalendar()
+
+    def test_session_includes_its_start_and_stop(self):
+        self.assertFalse(self.calendar.is_open(now=self.start - timedelta(microseconds=1)))
+        self.assertTrue(self.calendar.is_open(now=self.start))
+        self.assertTrue(self.calendar.is_open(now=self.stop))
+        self.assertFalse(self.calendar.is_open(now=self.stop + timedelta(microseconds=1)))
+
+    def test_company_halt(self):
+        company = self.create_company('HL')
+        other = self.create_company('OK')
+        TradingHalt.objects.create(company=company, start=self.start + timedelta(hours=1), stop=self.stop)
+        now = self.start + timedelta(hours=2)
+        self.assertEqual(self.calendar.closed_reason(company, now=now), 'Trading in Company HL is suspended!')
+        self.assertIsNone(self.calendar.closed_reason(other, now=now))
+        self.assertIsNone(self.calendar.closed_reason(company, now=self.stop))
+
+
+class PriceFeedTests(MarketTestCase):
+
+    def setUp(self):
+        self.company = self.create_company('PF')
+        patcher = mock.patch('market.feed._broker', CacheBroker())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_changes_are_merged_since_the_client_seq(self):
+        seq = publish_prices({'PF': {'cmp': '101.00', 'change': '1.00'}})
+        publish_prices({'PF': {'cmp': '102.00', 'change': '0.99'}})
+        latest, changes, full = changes_since(seq - 1)
+        self.assertEqual((latest, changes, full), (seq + 1, {'PF': {'cmp': '102.00', 'change': '0.99'}}, False))
+        self.assertEqual(changes_since(latest), (latest, {}, False))
+
+    def test_client_too_far_behind_gets_a_snapshot_without_reading_the_events(self):
+        broker = CacheBroker()
+        with mock.patch.object(broker, 'latest', return_value=10 ** 6), \
+                mock.patch('market.feed.cache.get_many') as get_many:
+            self.assertEqual(broker.events_since(0), (10 ** 6, None))
+        get_many.assert_not_called()
+        latest, changes, full = changes_since(-5)
+        self.assertTrue(full)
+        self.assertIn('PF', changes)
+
+    def test_feed_view(self):
+        self.client.force_login(self.create_user('feed'))
+        seq = self.client.get(reverse('market:price_feed')).json()['seq']
+        publish_prices({'PF': {'cmp': '99.00', 'change': '-1.00'}})
+        data = self.client.get(reverse('market:price_feed'), {'since': seq}).json()
+        self.assertEqual(data['changes'], {'PF': {'cmp': '99.00', 'change': '-1.00'}})
+
+
+class ChartTests(MarketTestCase):
+
+    def test_chart_version_is_read_once_per_request(self):
+        self.create_company('CH')
+        url = reverse('market:cmp_api_batch_data')
+        with mock.patch('market.views.get_version', return_value=7) as view_version, \
+                mock.patch('market.charts.get_version') as chart_version:
+            response = self.client.get(url, {'codes': 'CH'})
+            self.assertEqual(view_version.call_count, 1)
+            chart_version.assert_not_called()
+            self.assertIn('CH', response.json())
+            etag = response['ETag']
+            self.assertEqual(self.client.get(url, {'codes': 'CH'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class HoldingsTests(MarketTestCase):
+
+    def setUp(self):
+        self.company = self.create_company('HD')
+        self.user = self.create_user('holder')
+        InvestmentRecord.objects.filter(user=self.user, company=self.company).update(stocks=5)
+
+    def test_cached_snapshot_costs_a_single_cache_read(self):
+        self.assertEqual([position['stocks'] for position in get_holdings(self.user).positions], [5])
+        with self.assertNumQueries(1):
+            get_holdings(self.user)
+
+    def test_evicted_generation_makes_the_snapshot_stale(self):
+        get_holdings(self.user)
+        InvestmentRecord.objects.filter(user=self.user, company=self.company).update(stocks=8)
+        cache.delete(GENERATION_KEY.format(user=self.user.pk))
+        self.assertEqual([position['stocks'] for position in get_holdings(self.user).positions], [8])
+
+    def test_closed_positions_are_left_out(self):
+        InvestmentRecord.objects.filter(user=self.user, company=self.company).update(stocks=0, realized_pnl=50)
+        self.assertEqual(get_holdings(self.user).positions, [])
+
+
+class UpdateCmpTests(MarketTestCase):
+
+    def test_bulk_tick_matches_the_per_company_formula(self):
+        orders = [(Decimal('100.00'), 1000, 30, 5), (Decimal('57.35'), 400, 0, 90), (Decimal('12.10'), 250, 7, 7)]
+        for i, (cmp, stocks, bought, sold) in enumerate(orders):
+            for prefix in ('A', 'B'):
+                company = self.create_company('{prefix}{i}'.format(prefix=prefix, i=i), cmp=cmp, stocks=stocks)
+                Company.objects.filter(pk=company.pk).update(temp_stocks_bought=bought, temp_stocks_sold=sold)
+        for company in Company.objects.filter(code__startswith='A'):
+            company.update_cmp()
+        timings = Company.objects.filter(code__startswith='B').update_cmp()
+        self.assertIn('total', timings)
+
+        for i in range(len(orders)):
+            expected = Company.objects.get(code='A{i}'.format(i=i))
+            company = Company.objects.get(code='B{i}'.format(i=i))
+            self.assertEqual((company.cmp, company.change), (expected.cmp, expected.change.quantize(Decimal('0.01'))))
+            self.assertEqual((company.temp_stocks_bought, company.temp_stocks_sold), (0, 0))
+        self.assertEqual(CompanyCMPRecord.objects.filter(company__code__startswith='B').count(), len(orders))
+
+
+class NetWorthTests(MarketTestCase):
+
+    def setUp(self):
+        self.companies = [self.create_company('NW{i}'.format(i=i), cmp=Decimal(50 + 10 * i)) for i in range(3)]
+        self.users = [self.create_user('investor{i}'.format(i=i), cash=Decimal(1000 * (i + 1))) for i in range(3)]
+        for i, user in enumerate(self.users):
+            for j, company in enumerate(self.companies):
+                InvestmentRecord.objects.filter(user=user, company=company).update(stocks=(i + 1) * j)
+        UserNetWorth.objects.refresh()
+
+    def net_worths(self):
+        return dict(UserNetWorth.objects.values_list('user_id', 'net_worth'))
+
+    def test_tick_keeps_the_incremental_net_worth_equal_to_a_full_recompute(self):
+        Company.objects.filter(pk=self.companies[1].pk).update(temp_stocks_bought=100)
+        Company.objects.filter(pk=self.companies[2].pk).update(temp_stocks_sold=40)
+        Company.objects.update_cmp()
+        incremental = self.net_worths()
+        UserNetWorth.objects.refresh()
+        self.assertEqual(incremental, self.net_worths())
+
+    def test_leaderboard_breaks_ties_on_the_coefficient_of_variation(self):
+        first, second = self.users[:2]
+        UserNetWorth.objects.filter(user__in=[first, second]).update(net_worth=Decimal(5000))
+        UserNetWorth.objects.filter(user=first).update(coeff_of_variation=Decimal('0.50'))
+        UserNetWorth.objects.filter(user=second).update(coeff_of_variation=Decimal('0.10'))
+        ranked = [record.user for record in UserNetWorth.objects.ranked().filter(net_worth=Decimal(5000))]
+        self.assertEqual(ranked, [second, first])
+
+    def test_aggregate_net_worth_matches_the_holdings(self):
+        user = self.users[2]
+        expected = user.cash + sum(
+            (record.company.cmp * record.stocks for record in InvestmentRecord.objects.filter(user=user)),
+            Decimal(0)
+        )
+        with self.assertNumQueries(2):  # holdings aggregate and open orders escrow
+            self.assertEqual(InvestmentRecord.objects.calculate_net_worth(user), expected)
+        net_worths = InvestmentRecord.objects.calculate_net_worths(User.objects.filter(pk__in=[user.pk]))
+        self.assertEqual(net_worths, {user.pk: expected})
+
+
+class CandleTests(MarketTestCase):
+
+    def setUp(self):
+        self.company = self.create_company('CD')
+        self.minute = datetime(2018, 3, 1, 10, 0, tzinfo=utc)
+        self.ticks = [
+            (self.minute + timedelta(seconds=5), Decimal('100.00')),
+            (self.minute + timedelta(seconds=20), Decimal('104.50')),
+            (self.minute + timedelta(seconds=40), Decimal('98.25')),
+            (self.minute + timedelta(seconds=70), Decimal('101.00')),
+        ]
+        CompanyCandle.objects.all().delete()
+
+    def test_ticks_are_rolled_into_the_open_candles(self):
+        for timestamp, cmp in self.ticks:
+            CompanyCandle.objects.record_ticks([(self.company.pk, cmp)], timestamp)
+        minute = CompanyCandle.objects.get(company=self.company, interval=60, start=self.minute)
+        self.assertEqual(
+            (minute.open, minute.high, minute.low, minute.close, minute.ticks),
+            (Decimal('100.00'), Decimal('104.50'), Decimal('98.25'), Decimal('98.25'), 3)
+        )
+        hour = CompanyCandle.objects.get(company=self.company, interval=3600)
+        self.assertEqual((hour.open, hour.close, hour.ticks), (Decimal('100.00'), Decimal('101.00'), 4))
+
+        rebuilt = CompanyCandle.objects.from_ticks([(self.company.pk, cmp, timestamp) for timestamp, cmp in self.ticks])
+        for candle in CompanyCandle.objects.filter(company=self.company):
+            expected = rebuilt[(self.company.pk, candle.interval, candle.start)]
+            self.assertEqual(
+                (candle.open, candle.high, candle.low, candle.close, candle.ticks),
+                (expected.open, expected.high, expected.low, expected.close, expected.ticks)
+            )
+
+    def test_candle_api_serves_the_window(self):
+        for timestamp, cmp in self.ticks:
+            CompanyCandle.objects.record_ticks([(self.company.pk, cmp)], timestamp)
+        url = reverse('market:candle_api_data', kwargs={'code': 'CD'})
+        data = self.client.get(url, {'interval': '1m', 'limit': 1}).json()
+        self.assertEqual(len(data['candles']), 1)
+        self.assertEqual(data['candles'][0], [101.0, 101.0, 101.0, 101.0])
+        self.assertEqual(self.client.get(url, {'interval': '2m'}).status_code, 400)
+
+
+class TransactionHistoryTests(MarketTestCase):
+
+    def setUp(self):
+        self.user = self.create_user('history')
+        self.client.force_login(self.user)
+        company = self.create_company('TH')
+        Transaction.objects.bulk_create([
+            Transaction(user=self.user, company=company, num_stocks=i + 1, price=Decimal(100), mode='buy')
+            for i in range(7)
+        ])
+        base = datetime(2018, 3, 1, 10, tzinfo=utc)
+        for i, pk in enumerate(Transaction.objects.order_by('pk').values_list('pk', flat=True)):
+            Transaction.objects.filter(pk=pk).update(timestamp=base + timedelta(minutes=i // 3))  # ties of 3
+
+    @mock.patch('market.views.TRANSACTION_HISTORY_PAGE_SIZE', 2)
+    def test_pages_have_no_gaps_or_duplicates_across_equal_timestamps(self):
+        seen, params = [], {}
+        while True:
+            context = self.client.get(reverse('transaction_history'), params).context
+            seen.extend(obj.pk for obj in context['object_list'])
+            if 'next_cursor' not in context:
+                break
+            params = {'cursor': context['next_cursor'], 'start': context['next_start']}
+        expected = list(Transaction.objects.order_by('-timestamp', '-pk').values_list('pk', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_export_streams_every_transaction(self):
+        response = self.client.get(reverse('transaction_history_export'), {'format': 'csv'})
+        rows = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(rows), 1 + 7)
+        data = json.loads(b''.join(
+            self.client.get(reverse('transaction_history_export'), {'format': 'json'}).streaming_content
+        ).decode())
+        self.assertEqual(sorted(row['num_stocks'] for row in data), list(range(1, 8)))
+
+
+class CostBasisTests(MarketTestCase):
+
+    def setUp(self):
+        self.company = self.create_company('CB', cmp=Decimal(100))
+        self.user = self.create_user('ledger', cash=Decimal(1000))
+        Transaction.objects.execute(self.user, self.company, 'buy', 2)
+        Transaction.objects.execute(self.user, self.company, 'buy', 2, price=Decimal(110))
+        Transaction.objects.execute(self.user, self.company, 'sell', 3, price=Decimal(120))
+
+    def cost_basis(self):
+        return InvestmentRecord.objects.filter(user=self.user, company=self.company).values_list(
+            'stocks', 'average_price', 'realized_pnl'
+        ).get()
+
+    def test_snapshot_splits_unrealized_and_realized_pnl(self):
+        position, = get_holdings(self.user).positions
+        self.assertEqual(position['average_price'], Decimal('105.00'))
+        self.assertEqual((position['unrealized_pnl'], position['realized_pnl']), (Decimal(-5), Decimal(45)))
+        self.assertEqual(position['pnl'], Decimal(40))
+
+    def test_rebuild_from_the_history_matches_the_ledger(self):
+        ledger = self.cost_basis()
+        call_command('rebuild_cost_basis', stdout=StringIO())
+        self.assertEqual(self.cost_basis(), ledger)
+
+
+class ActiveHoldingsIndexTests(MarketTestCase):
+
+    def test_active_holdings_are_read_through_the_partial_index(self):
+        for i in range(20):
+            self.create_company('IX{i}'.format(i=i))
+        user, *_ = [self.create_user('indexed{i}'.format(i=i)) for i in range(20)]
+        InvestmentRecord.objects.filter(user=user, company__code='IX0').update(stocks=5)
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, InvestmentRecord._meta.db_table)
+        self.assertIn('market_inv_active_user_idx', constraints)
+        self.assertIn('market_inv_active_company_idx', constraints)
+        if connection.vendor != 'sqlite':
+            return
+        query = InvestmentRecord.objects.filter(user=user).active().values_list('company_id', 'stocks').query
+        sql, params = query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')  # most holdings are empty, as in a real game
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertIn('market_inv_active_user_idx', plan)
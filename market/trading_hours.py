@@ -0,0 +1,138 @@
+"""
+Trading calendar: when the market is open, and which companies are suspended.
+
+The market is open during the TradingSession rows, except while a market-wide TradingHalt is active; a halt
+of one company suspends that company only. While no session is defined, the START_TIME/STOP_TIME window of
+the settings is the only session. Sessions include their stop time, like the START_TIME/STOP_TIME check
+they replace, while halts end at their stop time.
+
+The calendar is loaded once per process and split at every start/stop into segments of constant state, so
+checking a request only compares the time with the bounds of the current segment and looks the company up in
+the set of suspended ones. Saving or deleting a session or a halt reloads the calendar of the process and bumps
+a version in the shared cache, which the other processes check every TRADING_CALENDAR_CHECK_INTERVAL seconds.
+"""
+import threading
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+
+TRADING_CALENDAR_CHECK_INTERVAL = getattr(settings, 'TRADING_CALENDAR_CHECK_INTERVAL', 5)  # seconds
+CALENDAR_VERSION_KEY = 'market:trading_calendar:version'
+START_TIME = timezone.make_aware(getattr(settings, 'START_TIME'))
+STOP_TIME = timezone.make_aware(getattr(settings, 'STOP_TIME'))
+MIN_TIME = datetime.min.replace(tzinfo=timezone.utc)
+MAX_TIME = datetime.max.replace(tzinfo=timezone.utc)
+RESOLUTION = timedelta(microseconds=1)
+
+
+def load_calendar():
+    """
+    (sessions, halts) of the calendar: [(start, stop)] and [(start, stop, company pk or None, reason)], all of
+    them half-open intervals (the stop of a session is moved one microsecond later, as it is included)
+    """
+    from .models import TradingSession, TradingHalt
+
+    sessions = list(TradingSession.objects.values_list('start', 'stop')) or [(START_TIME, STOP_TIME)]
+    sessions = [(start, stop + RESOLUTION) for start, stop in sessions]
+    halts = [
+        (start, stop or MAX_TIME, company_id, reason)
+        for start, stop, company_id, reason in TradingHalt.objects.values_list('start', 'stop', 'company', 'reason')
+    ]
+    return sessions, halts
+
+
+class Segment(object):
+    """ State of the market between two consecutive starts/stops of the calendar """
+
+    def __init__(self, start, stop, is_open, halt_reason, suspended):
+        self.start = start
+        self.stop = stop
+        self.is_open = is_open
+        self.halt_reason = halt_reason
+        self.suspended = suspended  # company pks
+
+    def covers(self, now):
+        return self.start <= now < self.stop
+
+
+class TradingCalendar(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.boundaries = None
+        self.segment = None
+        self.next_check = MIN_TIME
+
+    def closed_reason(self, company=None, now=None):
+        """ Why the market (or the company) cannot be traded now, None while it is open """
+        now = now or timezone.now()
+        segment = self.segment
+        if now >= self.next_check or segment is None or not segment.covers(now):
+            segment = self.current_segment(now)
+        if not segment.is_open:
+            return 'The market is closed!'
+        if segment.halt_reason is not None:
+            return 'Trading is halted! {reason}'.format(reason=segment.halt_reason).strip()
+        if company is not None and company.pk in segment.suspended:
+            return 'Trading in {company} is suspended!'.format(company=company.name)
+        return None
+
+    def is_open(self, company=None, now=None):
+        return self.closed_reason(company, now) is None
+
+    def current_segment(self, now):
+        with self.lock:
+            if now >= self.next_check:
+                version = cache.get(CALENDAR_VERSION_KEY)
+                if self.boundaries is None or version != self.version:
+                    self.load(version)
+                self.next_check = now + timedelta(seconds=TRADING_CALENDAR_CHECK_INTERVAL)
+            if self.segment is None or not self.segment.covers(now):
+                self.segment = self.build_segment(now)
+            return self.segment
+
+    def load(self, version):
+        self.sessions, self.halts = load_calendar()
+        times = {time for start, stop in self.sessions for time in (start, stop)}
+        times.update(time for start, stop, _, _ in self.halts for time in (start, stop))
+        self.boundaries = sorted(times)
+        self.version = version
+        self.segment = None
+
+    def build_segment(self, now):
+        """ State of the calendar from the last boundary before 'now' until the next one """
+        index = bisect_right(self.boundaries, now)
+        start = self.boundaries[index - 1] if index else MIN_TIME
+        stop = self.boundaries[index] if index < len(self.boundaries) else MAX_TIME
+        is_open = any(session_start <= now < session_stop for session_start, session_stop in self.sessions)
+        halt_reason = None
+        suspended = set()
+        for halt_start, halt_stop, company_id, reason in self.halts:
+            if halt_start <= now < halt_stop:
+                if company_id is None:
+                    halt_reason = reason
+                else:
+                    suspended.add(company_id)
+        return Segment(start, stop, is_open, halt_reason, suspended)
+
+    def expire(self):
+        with self.lock:
+            self.next_check = MIN_TIME
+            self.version = object()  # reloaded whatever the shared version is
+
+
+trading_calendar = TradingCalendar()
+
+
+def invalidate_trading_calendar(*args, **kwargs):
+    """ Reload the calendar in this process now and in the other ones within TRADING_CALENDAR_CHECK_INTERVAL """
+    try:
+        cache.incr(CALENDAR_VERSION_KEY)
+    except ValueError:  # first change or the key expired
+        cache.set(CALENDAR_VERSION_KEY, 1, None)
+    trading_calendar.expire()
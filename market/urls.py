@@ -3,9 +3,13 @@ from django.conf.urls import url
 from .views import (
     CompanySelectionView,
     CompanyTransactionView,
+    BasketOrderView,
     CompanyCMPChartData,
+    CompanyCMPBatchChartData,
+    CompanyCandleChartData,
     CompanyCMPCreateView,
     CompanyAdminCompanyUpdateView,
+    PriceFeedView,
     deduct_tax,
     update_market
 )
@@ -17,9 +21,13 @@ app_name = 'Market'
 urlpatterns = [
     url(r'^select/$', CompanySelectionView.as_view(), name='company_select'),
     url(r'^transact/(?P<code>\w+)$', CompanyTransactionView.as_view(), name='transaction'),
+    url(r'^basket/$', BasketOrderView.as_view(), name='basket'),
     url(r'^admin/(?P<code>\w+)$', CompanyAdminCompanyUpdateView.as_view(), name='admin'),
     url(r'^create/$', CompanyCMPCreateView.as_view(), name='create_cmp'),
     url(r'^company/api/(?P<code>\w+)$', CompanyCMPChartData.as_view(), name='cmp_api_data'),
+    url(r'^company/api/(?P<code>\w+)/candles/$', CompanyCandleChartData.as_view(), name='candle_api_data'),
+    url(r'^company/api/$', CompanyCMPBatchChartData.as_view(), name='cmp_api_batch_data'),
+    url(r'^feed/$', PriceFeedView.as_view(), name='price_feed'),
     url(r'^tax/$', deduct_tax, name='tax'),
     url(r'^update/$', update_market, name='update')
 ]
@@ -1,39 +1,57 @@
-from datetime import datetime
-from decimal import Decimal
+import csv
+import itertools
+import json
+import logging
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.shortcuts import render, redirect
-from django.http import HttpResponseRedirect, HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponseRedirect, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.generic import View, ListView
 from django.urls import reverse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
-from django.utils.timezone import localtime
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.permissions import IsAuthenticated
 
-from .models import Company, CompanyCMPRecord, InvestmentRecord, Transaction
-from .forms import StockTransactionForm, CompanyChangeForm
+from .models import Company, CompanyCMPRecord, CompanyCandle, InvestmentRecord, Transaction, UserNetWorth
+from .forms import StockTransactionForm, LimitOrderForm, CompanyChangeForm
+from .serializers import BasketOrderSerializer
+from .charts import get_chart, get_charts, get_version, push_cmp_points
+from .limit_orders import LIMIT_ORDER_MODE, place_limit_order, cancel_limit_order, open_orders
+from .journal import get_journal
+from .trading_hours import trading_calendar
+from .feed import get_broker, changes_since, publish_prices, PRICE_FEED_POLL_INTERVAL
 from stock_bridge.mixins import LoginRequiredMixin, CountNewsMixin, AdminRequiredMixin
+from accounts.models import Settlement
+from accounts.views import settlement_response
 
 
+logger = logging.getLogger(__name__)
+
 User = get_user_model()
-START_TIME = timezone.make_aware(getattr(settings, 'START_TIME'))
-STOP_TIME = timezone.make_aware(getattr(settings, 'STOP_TIME'))
+CANDLE_INTERVAL_CODES = {'1m': 60, '5m': 300, '1h': 3600}
+CANDLE_WINDOW_SIZE = getattr(settings, 'CANDLE_WINDOW_SIZE', 120)  # candles returned by default
+CANDLE_WINDOW_MAX = 1000
+TRANSACTION_HISTORY_PAGE_SIZE = getattr(settings, 'TRANSACTION_HISTORY_PAGE_SIZE', 50)
+EXPORT_CHUNK_SIZE = 2000  # rows fetched per round trip by the history export
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 
 @login_required
 def deduct_tax(request):
-    """ Deduct income tax """
+    """ Deduct income tax (?run=<id> makes the request idempotent) """
     if request.user.is_superuser:
-        for user in User.objects.all():
-            tax = user.cash * Decimal(0.4)
-            user.cash -= tax
-            user.save()
-        return HttpResponse('success')
+        settlement = Settlement.objects.settle('tax', run_id=request.GET.get('run'))
+        return settlement_response(settlement, 'success')
     return redirect('/')
 
 
@@ -42,11 +60,11 @@ def update_market(request):
     """ Update company's cmp after applying formula """
     if request.user.is_superuser:
         # update company cmp data
-        company_qs = Company.objects.all()
-        for company in company_qs:
-            company.update_cmp()
-            obj = CompanyCMPRecord.objects.create(company=company, cmp=company.cmp)
-        return HttpResponse('cmp updated')
+        timings = Company.objects.update_cmp()
+        msg = 'cmp updated: {companies} companies in {total:.4f}s (fetch {fetch:.4f}s, compute {compute:.4f}s, ' \
+              'update {update:.4f}s, records {records:.4f}s, net worth {net_worth:.4f}s)'.format(**timings)
+        logger.info(msg)
+        return HttpResponse(msg)
     return redirect('/')
 
 
@@ -68,7 +86,9 @@ class CompanyAdminCompanyUpdateView(AdminRequiredMixin, View):
         company.cmp = Decimal(int(price))
         company.save()
         company.calculate_change(old_price)
-        print('price', int(price))
+        UserNetWorth.objects.apply_price_changes({company.pk: company.cmp - old_price})
+        publish_prices({company.code: {'cmp': company.cmp, 'change': round(company.change, 2)}})
+        logger.debug('%s price set to %s by the admin', company.code, company.cmp)
         url = reverse('market:admin', kwargs={'code': company.code})
         return HttpResponseRedirect(url)
 
@@ -76,8 +96,13 @@ class CompanyAdminCompanyUpdateView(AdminRequiredMixin, View):
 class CompanyCMPCreateView(View):
 
     def get(self, request, *args, **kwargs):
-        for company in Company.objects.all():
-            obj = CompanyCMPRecord.objects.create(company=company, cmp=company.cmp)
+        company_qs = list(Company.objects.values_list('pk', 'code', 'cmp'))
+        CompanyCMPRecord.objects.bulk_create([
+            CompanyCMPRecord(company_id=pk, cmp=cmp) for pk, code, cmp in company_qs
+        ])
+        now = timezone.now()
+        CompanyCandle.objects.record_ticks([(pk, cmp) for pk, code, cmp in company_qs], now)
+        push_cmp_points([(code, cmp) for pk, code, cmp in company_qs], now)
         return HttpResponse('success')
 
 
@@ -89,31 +114,87 @@ class CompanySelectionView(LoginRequiredMixin, CountNewsMixin, View):
         })
 
 
+def chart_version(request):
+    """ Chart version, read from the cache once per request and shared by the etag and the view """
+    if not hasattr(request, 'chart_version'):
+        request.chart_version = get_version()
+    return request.chart_version
+
+
+def cmp_chart_etag(request, *args, **kwargs):
+    """ Charts only change when the chart version is bumped by a price change """
+    codes = kwargs.get('code') or request.GET.get('codes', '')
+    return '"{codes}-{version}"'.format(codes=codes, version=chart_version(request))
+
+
 class CompanyCMPChartData(APIView):  # used django rest framework
     authentication_classes = []
     permission_classes = []
 
+    @method_decorator(condition(etag_func=cmp_chart_etag))
     def get(self, request, format=None, *args, **kwargs):
-        qs = CompanyCMPRecord.objects.filter(company__code=kwargs.get('code'))
-        if qs.count() > 15:
-            qs = qs[:15]
-        qs = reversed(qs)  # reverse timestamp sorting i.e. latest data should be in front
-        labels = []
-        cmp_data = []
-        for cmp_record in qs:
-            labels.append(localtime(cmp_record.timestamp).strftime('%H:%M'))
-            cmp_data.append(cmp_record.cmp)
-        current_cmp = Company.objects.get(code=kwargs.get('code')).cmp
-        if cmp_data[-1] != current_cmp:
-            labels.append(timezone.make_aware(datetime.now()).strftime('%H:%M'))
-            cmp_data.append(current_cmp)
-        data = {
-            "labels": labels,
-            "cmp_data": cmp_data,
-        }
+        data = get_chart(kwargs.get('code'), chart_version(request))
+        if data is None:
+            return Response({'detail': 'Company not found'}, status=404)
         return Response(data)
 
 
+class CompanyCMPBatchChartData(APIView):
+    """ Charts of several companies in one response, e.g. ?codes=ABC,XYZ """
+    authentication_classes = []
+    permission_classes = []
+
+    @method_decorator(condition(etag_func=cmp_chart_etag))
+    def get(self, request, format=None, *args, **kwargs):
+        codes = [code for code in request.GET.get('codes', '').split(',') if code]
+        return Response(get_charts(codes, chart_version(request)))
+
+
+class CompanyCandleChartData(APIView):
+    """
+    OHLC candles of a company, served from the precomputed aggregates:
+    ?interval=1m|5m|1h (default 1m) &limit=<number of candles> (default CANDLE_WINDOW_SIZE)
+    """
+    authentication_classes = []
+    permission_classes = []
+
+    @method_decorator(condition(etag_func=cmp_chart_etag))
+    def get(self, request, format=None, *args, **kwargs):
+        interval = CANDLE_INTERVAL_CODES.get(request.GET.get('interval', '1m'))
+        if interval is None:
+            return Response({'detail': 'Unknown interval'}, status=400)
+        limit = request.GET.get('limit', '')
+        limit = min(int(limit), CANDLE_WINDOW_MAX) if limit.isdigit() else CANDLE_WINDOW_SIZE
+        company = Company.objects.filter(code=kwargs.get('code')).values_list('pk', flat=True).first()
+        if company is None:
+            return Response({'detail': 'Company not found'}, status=404)
+        candles = CompanyCandle.objects.window(company, interval, limit)
+        return Response({
+            'labels': [start for start, _, _, _, _ in candles],
+            'candles': [[open, high, low, close] for _, open, high, low, close in candles]
+        })
+
+
+def parse_seq(value):
+    if value is not None and value.isdigit():
+        return int(value)
+    return None
+
+
+class PriceFeedView(View):
+    """
+    Polled price feed: ?since=<seq> returns the companies whose prices moved after seq, right away.
+    Without 'since' it returns the current seq to start from.
+    """
+
+    def get(self, request, *args, **kwargs):
+        since = parse_seq(request.GET.get('since'))
+        if since is None:
+            return JsonResponse({'seq': get_broker().latest(), 'changes': {}, 'full': False})
+        seq, changes, full = changes_since(since)
+        return JsonResponse({'seq': seq, 'changes': changes, 'full': full})
+
+
 class CompanyTransactionView(LoginRequiredMixin, CountNewsMixin, View):
 
     def get(self, request, *args, **kwargs):
@@ -124,53 +205,39 @@ class CompanyTransactionView(LoginRequiredMixin, CountNewsMixin, View):
             'object': company,
             'company_list': Company.objects.all(),
             'stocks_owned': stocks_owned,
-            'form': StockTransactionForm()
+            'form': LimitOrderForm() if LIMIT_ORDER_MODE else StockTransactionForm(),
+            'limit_order_mode': LIMIT_ORDER_MODE,
+            'open_orders': open_orders(request.user, company) if LIMIT_ORDER_MODE else [],
+            'feed_poll_interval': PRICE_FEED_POLL_INTERVAL
         })
 
     def post(self, request, *args, **kwargs):
         company = Company.objects.get(code=kwargs.get('code'))
-        current_time = timezone.make_aware(datetime.now())
-        if current_time >= START_TIME and current_time <= STOP_TIME:
+        closed_reason = trading_calendar.closed_reason(company)
+        if closed_reason is None:
             user = request.user
             mode = request.POST.get('mode')
+            if LIMIT_ORDER_MODE and request.POST.get('cancel_order'):
+                self.cancel_order(request, company)
+                return HttpResponseRedirect(reverse('market:transaction', kwargs={'code': company.code}))
             quantity = int(request.POST.get('quantity'))
             price = company.cmp
             investment_obj, obj_created = InvestmentRecord.objects.get_or_create(user=user, company=company)
-            if quantity > 0:
+            if quantity > 0 and LIMIT_ORDER_MODE:
+                self.place_order(request, company, mode, quantity)
+            elif quantity > 0:
                 if mode == 'buy':
                     purchase_amount = Decimal(quantity) * price
                     if user.cash >= purchase_amount:
                         if company.stocks_remaining >= quantity:
-                            # user.buy_stocks(quantity, price)
-                            # company.user_buy_stocks(quantity)
-                            # investment_obj.add_stocks(quantity)
-                            obj = Transaction.objects.create(
-                                user=user,
-                                company=company,
-                                num_stocks=quantity,
-                                price=price,
-                                mode=mode,
-                                user_net_worth=InvestmentRecord.objects.calculate_net_worth(user)
-                            )
-                            messages.success(request, 'Transaction Complete!')
+                            self.execute(request, company, mode, quantity, price)
                         else:
                             messages.error(request, 'The company does not have that many stocks left!')
                     else:
                         messages.error(request, 'Insufficient Balance for this transaction!')
                 elif mode == 'sell':
                     if quantity <= investment_obj.stocks and quantity <= company.stocks_offered:
-                        # user.sell_stocks(quantity, price)
-                        # company.user_sell_stocks(quantity)
-                        # investment_obj.reduce_stocks(quantity)
-                        obj = Transaction.objects.create(
-                            user=user,
-                            company=company,
-                            num_stocks=quantity,
-                            price=price,
-                            mode=mode,
-                            user_net_worth=InvestmentRecord.objects.calculate_net_worth(user)
-                        )
-                        messages.success(request, 'Transaction Complete!')
+                        self.execute(request, company, mode, quantity, price)
                     else:
                         messages.error(request, 'Please enter a valid quantity!')
                 else:
@@ -178,18 +245,174 @@ class CompanyTransactionView(LoginRequiredMixin, CountNewsMixin, View):
             else:
                 messages.error(request, 'The quantity cannot be negative!')
         else:
-            # msg = 'The market will be live from {start} to {stop}'.format(
-            #     start=START_TIME.strftime('%H:%M'),
-            #     stop=STOP_TIME.strftime('%H:%M')
-            # )
-            msg = 'The market is closed!'
-            messages.info(request, msg)
+            messages.info(request, closed_reason)
         url = reverse('market:transaction', kwargs={'code': company.code})
         return HttpResponseRedirect(url)
 
+    def execute(self, request, company, mode, quantity, price):
+        journal = get_journal()
+        if journal is not None:  # applied in the background, see market.journal
+            journal.append(request.user, company, mode, quantity, price)
+            messages.success(request, 'Order received! It will appear in your transaction history shortly.')
+            return
+        obj = Transaction.objects.execute(request.user, company, mode, quantity, price)
+        if obj is not None:
+            messages.success(request, 'Transaction Complete!')
+        else:
+            messages.error(request, 'The transaction could not be completed! Please try again.')
+
+    def place_order(self, request, company, mode, quantity):
+        try:
+            price = Decimal(request.POST.get('price')).quantize(Decimal('0.01'))
+        except (TypeError, InvalidOperation):
+            price = None
+        if price is None or price <= 0:
+            messages.error(request, 'Please enter a valid limit price!')
+        elif mode not in ('buy', 'sell'):
+            messages.error(request, 'Please enter a valid mode!')
+        else:
+            order, fills = place_limit_order(request.user, company, mode, quantity, price)
+            if order is None:
+                messages.error(request, 'Insufficient balance or stocks for this order!')
+            else:
+                messages.success(request, 'Order placed: {filled} stocks filled, {remaining} open.'.format(
+                    filled=order.quantity - order.remaining - order.cancelled, remaining=order.remaining
+                ))
+                if order.cancelled:
+                    messages.warning(request, '{num} stocks were cancelled: they would have traded with your own '
+                                              'order.'.format(num=order.cancelled))
+
+    def cancel_order(self, request, company):
+        order_id = request.POST.get('cancel_order')
+        refunded = cancel_limit_order(request.user, company, int(order_id)) if order_id.isdigit() else 0
+        if refunded:
+            messages.success(request, 'Order cancelled, {num} stocks were unfilled.'.format(num=refunded))
+        else:
+            messages.error(request, 'This order cannot be cancelled!')
+
+
+class BasketOrderView(APIView):
+    """
+    Several buy/sell orders in one request, executed together or not at all:
+    POST {"legs": [{"company": "<code>", "mode": "buy"|"sell", "quantity": <n>}, ...]}
+    Returns the transactions, the user's cash and net worth and the resulting positions in the companies.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, format=None, *args, **kwargs):
+        closed_reason = trading_calendar.closed_reason()
+        if closed_reason is not None:
+            return Response({'detail': closed_reason}, status=403)
+        if LIMIT_ORDER_MODE:
+            return Response({'detail': 'Orders are placed in the order book in limit order mode.'}, status=403)
+        serializer = BasketOrderSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        legs = serializer.validated_data['legs']
+        suspended = [
+            {'leg': index, 'detail': trading_calendar.closed_reason(leg['company'])}
+            for index, leg in enumerate(legs) if not trading_calendar.is_open(leg['company'])
+        ]
+        if suspended:
+            return Response({'legs': suspended}, status=403)
+        user = request.user
+        transactions, errors = Transaction.objects.execute_basket(
+            user, [(leg['company'], leg['mode'], leg['quantity']) for leg in legs]
+        )
+        if transactions is None:
+            return Response({'legs': [{'leg': index, 'detail': message} for index, message in errors]}, status=400)
+        positions = InvestmentRecord.objects.filter(
+            user=user, company__in=[leg['company'] for leg in legs]
+        ).order_by('company__code').values_list('company__code', 'stocks', 'average_price', 'realized_pnl')
+        return Response({
+            'transactions': [{
+                'company': obj.company.code,
+                'mode': obj.mode,
+                'quantity': obj.num_stocks,
+                'price': obj.price
+            } for obj in transactions],
+            'cash': user.cash,
+            'net_worth': transactions[0].user_net_worth,
+            'positions': [{
+                'company': code,
+                'stocks': stocks,
+                'average_price': average_price,
+                'realized_pnl': realized_pnl
+            } for code, stocks, average_price, realized_pnl in positions]
+        }, status=201)
+
+
+def history_cursor(obj):
+    """ Keyset cursor of a transaction: '<timestamp in microseconds since the epoch>-<pk>' """
+    return '{timestamp}-{pk}'.format(timestamp=(obj.timestamp - EPOCH) // timedelta(microseconds=1), pk=obj.pk)
+
+
+def parse_history_cursor(value):
+    """ (timestamp, pk) of a cursor made by history_cursor, None if it is invalid """
+    timestamp, _, pk = (value or '').partition('-')
+    if not (timestamp.isdigit() and pk.isdigit()):
+        return None
+    return EPOCH + timedelta(microseconds=int(timestamp)), int(pk)
+
 
 class UserTransactionHistoryView(LoginRequiredMixin, CountNewsMixin, ListView):
+    """ Transaction history of the user, paginated on (timestamp, pk) so that every page costs the same """
     template_name = 'market/user_transaction_history.html'
 
     def get_queryset(self, *args, **kwargs):
-        return Transaction.objects.get_by_user(user=self.request.user)
+        queryset = Transaction.objects.get_by_user(user=self.request.user).select_related('company')
+        cursor = parse_history_cursor(self.request.GET.get('cursor'))
+        if cursor is not None:
+            queryset = queryset.before(*cursor)
+        rows = list(queryset.order_by('-timestamp', '-pk')[:TRANSACTION_HISTORY_PAGE_SIZE + 1])
+        self.has_next = len(rows) > TRANSACTION_HISTORY_PAGE_SIZE
+        return rows[:TRANSACTION_HISTORY_PAGE_SIZE]
+
+    def get_context_data(self, *args, **kwargs):
+        context = super(UserTransactionHistoryView, self).get_context_data(*args, **kwargs)
+        start = self.request.GET.get('start', '')
+        start = int(start) if start.isdigit() else 0
+        object_list = context['object_list']
+        context['start'] = start
+        context['is_first_page'] = 'cursor' not in self.request.GET
+        if self.has_next:
+            context['next_cursor'] = history_cursor(object_list[-1])
+            context['next_start'] = start + len(object_list)
+        return context
+
+
+class Echo(object):
+    """ File-like object whose write() returns the written value, for streaming csv.writer output """
+
+    def write(self, value):
+        return value
+
+
+class UserTransactionHistoryExportView(LoginRequiredMixin, View):
+    """ Streams the whole transaction history of the user as ?format=csv (default) or ?format=json """
+    fields = ('timestamp', 'company__code', 'company__name', 'mode', 'price', 'num_stocks', 'user_net_worth')
+    headers = ('timestamp', 'company_code', 'company_name', 'mode', 'price', 'num_stocks', 'net_worth')
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get('format', 'csv')
+        if export_format not in ('csv', 'json'):
+            return HttpResponse('Unknown format', status=400)
+        rows = Transaction.objects.get_by_user(user=request.user).order_by('-timestamp', '-pk').values_list(
+            *self.fields
+        ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        if export_format == 'csv':
+            writer = csv.writer(Echo())
+            content = itertools.chain([writer.writerow(self.headers)], (writer.writerow(row) for row in rows))
+            response = StreamingHttpResponse(content, content_type='text/csv')
+        else:
+            response = StreamingHttpResponse(self.stream_json(rows), content_type='application/json')
+        response['Content-Disposition'] = 'attachment; filename="transactions.{format}"'.format(format=export_format)
+        return response
+
+    def stream_json(self, rows):
+        yield '['
+        separator = ''
+        for row in rows:
+            yield separator + json.dumps(dict(zip(self.headers, row)), cls=DjangoJSONEncoder)
+            separator = ','
+        yield ']'
@@ -0,0 +1,68 @@
+"""
+Caching of the public pages.
+
+Cached pages and template fragments are keyed on a site-wide page version, bumped by every market tick
+and by Company/News changes, so they are never served past the data they show. Anonymous GET requests
+of the decorated views are served as full pages from the cache; templates cache their shared fragments
+with {% cache page_cache_timeout <name> page_version ... %} (see the 'page_cache' context processor); these
+fragments are the same for every user, anything specific to the user stays outside of them.
+"""
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.functional import SimpleLazyObject
+
+
+PAGE_CACHE_TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 60 * 10)
+PAGE_VERSION_KEY = 'stock_bridge:page_version'
+PAGE_KEY = 'stock_bridge:page:{version}:{role}:{path}'
+
+
+def get_page_version():
+    version = cache.get(PAGE_VERSION_KEY)
+    if version is None:
+        cache.add(PAGE_VERSION_KEY, 1, None)
+        version = cache.get(PAGE_VERSION_KEY, 1)
+    return version
+
+
+def bump_page_version(*args, **kwargs):
+    """ Make every cached page and fragment stale (usable as a signal receiver) """
+    try:
+        return cache.incr(PAGE_VERSION_KEY)
+    except ValueError:  # key expired or was never set
+        cache.set(PAGE_VERSION_KEY, 1, None)
+        return 1
+
+
+def cache_page_for_anonymous(view_func):
+    """
+    Serve anonymous GET requests of a view from the cache. Requests with pending messages and responses
+    that set cookies are not cached.
+    """
+    @wraps(view_func)
+    def wrapped_view(request, *args, **kwargs):
+        if request.method != 'GET' or request.user.is_authenticated or len(get_messages(request)):
+            return view_func(request, *args, **kwargs)
+        key = PAGE_KEY.format(version=get_page_version(), role='anonymous', path=request.get_full_path())
+        content = cache.get(key)
+        if content is not None:
+            return HttpResponse(content)
+        response = view_func(request, *args, **kwargs)
+        if response.status_code == 200 and not response.streaming and not response.cookies:
+            if callable(getattr(response, 'render', None)):  # TemplateResponse of the generic views
+                response.render()
+            cache.set(key, response.content, PAGE_CACHE_TIMEOUT)
+        return response
+    return wrapped_view
+
+
+def page_cache(request):
+    """ Context processor: the keys of the {% cache %} fragments, only computed when a template uses them """
+    return {
+        'page_cache_timeout': PAGE_CACHE_TIMEOUT,
+        'page_version': SimpleLazyObject(get_page_version)
+    }
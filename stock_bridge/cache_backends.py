@@ -0,0 +1,56 @@
+"""
+Database cache of the site (see settings/caches.py).
+
+Django's DatabaseCache reads every key of get_many() with its own SELECT; the holdings stamp, the chart
+buffers and the price feed read several keys per request, so they are fetched here with a single query.
+"""
+import base64
+import pickle
+
+from django.core.cache.backends.db import DatabaseCache as BaseDatabaseCache
+from django.db import connections, models, router
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.inspect import func_supports_parameter
+
+
+class DatabaseCache(BaseDatabaseCache):
+
+    def get_many(self, keys, version=None):
+        key_map = {}
+        for key in keys:
+            cache_key = self.make_key(key, version=version)
+            self.validate_key(cache_key)
+            key_map[cache_key] = key
+        if not key_map:
+            return {}
+
+        db = router.db_for_read(self.cache_model_class)
+        connection = connections[db]
+        table = connection.ops.quote_name(self._table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT cache_key, value, expires FROM {table} WHERE cache_key IN ({keys})'.format(
+                    table=table, keys=', '.join(['%s'] * len(key_map))
+                ),
+                list(key_map)
+            )
+            rows = cursor.fetchall()
+
+        expression = models.Expression(output_field=models.DateTimeField())
+        converters = connection.ops.get_db_converters(expression) + expression.get_db_converters(connection)
+        now = timezone.now()
+        result, expired = {}, []
+        for cache_key, value, expires in rows:
+            for converter in converters:
+                if func_supports_parameter(converter, 'context'):  # RemovedInDjango30Warning
+                    expires = converter(expires, expression, connection, {})
+                else:
+                    expires = converter(expires, expression, connection)
+            if expires < now:
+                expired.append(key_map[cache_key])
+            else:
+                value = connection.ops.process_clob(value)
+                result[key_map[cache_key]] = pickle.loads(base64.b64decode(force_bytes(value)))
+        self.delete_many(expired)
+        return result
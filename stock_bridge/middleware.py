@@ -0,0 +1,197 @@
+"""
+Per-request SQL and template instrumentation, enabled with REQUEST_METRICS = True.
+
+For every request it records the number of queries, the time spent in the database, the queries repeated
+with the same SQL (fingerprints, the usual sign of an N+1 loop) and the time spent rendering templates.
+Every request is logged as one JSON line on the 'stock_bridge.requests' logger, as a warning when the view
+ran more queries than its budget (REQUEST_QUERY_BUDGETS by view name, else REQUEST_QUERY_BUDGET) or repeated
+a query at least REQUEST_DUPLICATE_THRESHOLD times. The totals per view are kept in the process and served
+in the Prometheus text format by request_metrics_view ('/metrics/'), each process exporting its own.
+Queries run while rendering a template count in both the database and the template time.
+"""
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import Template
+
+
+logger = logging.getLogger('stock_bridge.requests')
+
+REQUEST_METRICS = getattr(settings, 'REQUEST_METRICS', False)
+REQUEST_QUERY_BUDGET = getattr(settings, 'REQUEST_QUERY_BUDGET', 50)
+REQUEST_QUERY_BUDGETS = getattr(settings, 'REQUEST_QUERY_BUDGETS', {})  # view name -> budget
+REQUEST_DUPLICATE_THRESHOLD = getattr(settings, 'REQUEST_DUPLICATE_THRESHOLD', 5)
+REQUEST_METRICS_TOKEN = getattr(settings, 'REQUEST_METRICS_TOKEN', None)  # lets a scraper read /metrics/
+REPORTED_DUPLICATES = 5  # fingerprints listed in a log line
+
+PLACEHOLDER_LIST = re.compile(r'%s(?:, %s)+')
+
+_local = threading.local()
+
+
+def fingerprint(sql):
+    """ SQL of a query with its IN (...) lists collapsed, the parameters are never part of it """
+    return PLACEHOLDER_LIST.sub('%s, ...', sql)
+
+
+def query_budget(view_name):
+    return REQUEST_QUERY_BUDGETS.get(view_name, REQUEST_QUERY_BUDGET)
+
+
+class RequestMetrics(object):
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.fingerprints = Counter()
+        self.rendering = False
+
+    def __call__(self, execute, sql, params, many, context):
+        """ Database execute wrapper """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def duplicates(self):
+        return [(sql, count) for sql, count in self.fingerprints.most_common() if count > 1]
+
+
+_template_render = Template.render
+
+
+def _timed_render(self, context):
+    """ Template.render counting the time of the outermost template of the request ({% include %} is nested) """
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is None or metrics.rendering:
+        return _template_render(self, context)
+    metrics.rendering = True
+    start = time.perf_counter()
+    try:
+        return _template_render(self, context)
+    finally:
+        metrics.template_time += time.perf_counter() - start
+        metrics.rendering = False
+
+
+class ViewTotals(object):
+    """ Totals of the instrumented requests of the process, by view """
+
+    FIELDS = ('requests', 'duration', 'queries', 'db_time', 'template_time', 'duplicate_queries', 'over_budget')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = defaultdict(lambda: dict.fromkeys(self.FIELDS, 0))
+        self.max_queries = defaultdict(int)
+
+    def add(self, view_name, duration, metrics, over_budget):
+        with self.lock:
+            totals = self.totals[view_name]
+            totals['requests'] += 1
+            totals['duration'] += duration
+            totals['queries'] += metrics.queries
+            totals['db_time'] += metrics.db_time
+            totals['template_time'] += metrics.template_time
+            totals['duplicate_queries'] += sum(count - 1 for _, count in metrics.duplicates())
+            totals['over_budget'] += over_budget
+            self.max_queries[view_name] = max(self.max_queries[view_name], metrics.queries)
+
+    def snapshot(self):
+        with self.lock:
+            return {view: dict(totals) for view, totals in self.totals.items()}, dict(self.max_queries)
+
+
+view_totals = ViewTotals()
+
+PROMETHEUS_METRICS = (
+    ('stock_bridge_requests_total', 'counter', 'requests', 'Instrumented requests'),
+    ('stock_bridge_request_duration_seconds_total', 'counter', 'duration', 'Time spent handling requests'),
+    ('stock_bridge_db_queries_total', 'counter', 'queries', 'SQL queries run by the requests'),
+    ('stock_bridge_db_duration_seconds_total', 'counter', 'db_time', 'Time spent in the database'),
+    ('stock_bridge_template_duration_seconds_total', 'counter', 'template_time', 'Time spent rendering templates'),
+    ('stock_bridge_duplicate_queries_total', 'counter', 'duplicate_queries',
+     'Queries repeating the SQL of an earlier query of the same request'),
+    ('stock_bridge_query_budget_exceeded_total', 'counter', 'over_budget',
+     'Requests that ran more queries than the budget of their view'),
+)
+
+
+def prometheus_text():
+    totals, max_queries = view_totals.snapshot()
+    lines = []
+    for name, kind, field, description in PROMETHEUS_METRICS:
+        lines.append('# HELP {name} {description}'.format(name=name, description=description))
+        lines.append('# TYPE {name} {kind}'.format(name=name, kind=kind))
+        for view in sorted(totals):
+            lines.append('{name}{{view="{view}"}} {value}'.format(name=name, view=view, value=totals[view][field]))
+    lines.append('# HELP stock_bridge_db_queries_max Most queries run by one request')
+    lines.append('# TYPE stock_bridge_db_queries_max gauge')
+    for view in sorted(max_queries):
+        lines.append('stock_bridge_db_queries_max{{view="{view}"}} {value}'.format(view=view, value=max_queries[view]))
+    lines.append('# HELP stock_bridge_query_budget Query budget of the view')
+    lines.append('# TYPE stock_bridge_query_budget gauge')
+    for view in sorted(totals):
+        lines.append('stock_bridge_query_budget{{view="{view}"}} {value}'.format(view=view, value=query_budget(view)))
+    return '\n'.join(lines) + '\n'
+
+
+class RequestMetricsMiddleware(object):
+    """ Records the queries, database time and template time of every request (see the module docstring) """
+
+    def __init__(self, get_response):
+        if not REQUEST_METRICS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        Template.render = _timed_render
+
+    def __call__(self, request):
+        metrics = _local.metrics = RequestMetrics()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _local.metrics = None
+        duration = time.perf_counter() - start
+        match = request.resolver_match
+        view_name = match.view_name if match else 'unresolved'
+        if view_name != 'metrics':
+            self.report(request, response, view_name, duration, metrics)
+        return response
+
+    def report(self, request, response, view_name, duration, metrics):
+        budget = query_budget(view_name)
+        duplicates = metrics.duplicates()
+        over_budget = metrics.queries > budget
+        view_totals.add(view_name, duration, metrics, over_budget)
+        flagged = over_budget or (duplicates and duplicates[0][1] >= REQUEST_DUPLICATE_THRESHOLD)
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'view': view_name,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 2),
+            'queries': metrics.queries,
+            'query_budget': budget,
+            'over_budget': over_budget,
+            'db_ms': round(metrics.db_time * 1000, 2),
+            'template_ms': round(metrics.template_time * 1000, 2),
+            'duplicates': [
+                {'sql': sql, 'count': count} for sql, count in duplicates[:REPORTED_DUPLICATES]
+            ],
+        }
+        logger.log(logging.WARNING if flagged else logging.INFO, json.dumps(record))
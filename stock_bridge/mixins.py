@@ -14,7 +14,9 @@ class CountNewsMixin(object):
     """ Count current news amount for display in navbar """
 
     def dispatch(self, request, *args, **kwargs):
-        request.session['news'] = News.objects.filter(is_active=True).count()
+        count = News.objects.active_count()
+        if request.session.get('news') != count:  # avoid a session save on every request
+            request.session['news'] = count
         return super(CountNewsMixin, self).dispatch(request, *args, **kwargs)
 
 
@@ -0,0 +1,16 @@
+# Cache shared by every worker process (imported by base, local and production).
+# The chart buffers and their ETags, the holdings snapshots, the page and fragment versions, the news count
+# and the trading calendar version all rely on every process seeing the same cache, which the default
+# per-process LocMemCache does not do. The table is created with 'python manage.py createcachetable'
+# (run on every release, see the Procfile).
+
+CACHES = {
+    'default': {
+        'BACKEND': 'stock_bridge.cache_backends.DatabaseCache',  # get_many() in one query
+        'LOCATION': 'stock_bridge_cache',
+        'TIMEOUT': 60 * 5,
+        'OPTIONS': {
+            'MAX_ENTRIES': 50000,
+        },
+    },
+}
@@ -43,8 +43,13 @@ RATE_OF_INTEREST = Decimal(0.15)  # 15%
 TAX_RATE = Decimal(0.40)  # 40%
 
 # Global settings
+# market hours while no TradingSession is defined (see market.trading_hours)
 START_TIME = datetime(2018, 5, 4, 19, 30, 0)
 STOP_TIME = datetime(2018, 5, 5, 2, 00, 0)
+LIMIT_ORDER_MODE = False  # users trade with each other through limit orders (single worker process only)
+TRADE_JOURNAL_DIR = None  # directory of the write-ahead trade journal, None executes trades synchronously
+REQUEST_METRICS = False  # per-request query and template instrumentation (stock_bridge.middleware)
+REQUEST_QUERY_BUDGET = 50  # queries a request may run before it is flagged
 
 
 # Application definition
@@ -75,6 +80,7 @@ LOGIN_URL_REDIRECT = '/'
 LOGOUT_URL = '/logout/'
 
 MIDDLEWARE = [
+    'stock_bridge.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -98,6 +104,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'stock_bridge.cache.page_cache',
             ],
         },
     },
@@ -105,6 +112,23 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'stock_bridge.wsgi.application'
 
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'stock_bridge.requests': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 
 # Database
 
@@ -115,6 +139,10 @@ DATABASES = {
 }
 
 
+# Cache
+from .caches import CACHES
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
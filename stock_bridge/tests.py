@@ -0,0 +1,52 @@
+import json
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.template.base import Template
+from django.test import RequestFactory, TestCase
+
+from . import middleware
+
+
+User = get_user_model()
+
+
+class RequestMetricsMiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, Template, 'render', Template.render)
+        for name, value in (('REQUEST_METRICS', True), ('REQUEST_QUERY_BUDGET', 2),
+                            ('view_totals', middleware.ViewTotals())):
+            patcher = mock.patch.object(middleware, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def view(self, request):
+        for pk in range(3):
+            User.objects.filter(pk=pk).exists()  # the same SQL three times
+        return HttpResponse(Template('{{ value }}').render(mock.MagicMock()))
+
+    def test_request_over_its_budget_is_logged_with_its_duplicates(self):
+        instrumented = middleware.RequestMetricsMiddleware(self.view)
+        with self.assertLogs('stock_bridge.requests', level='WARNING') as logs:
+            instrumented(RequestFactory().get('/'))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['queries'], record['over_budget']), (3, True))
+        self.assertEqual(record['duplicates'][0]['count'], 3)
+        self.assertIn('stock_bridge_db_queries_total{view="unresolved"} 3', middleware.prometheus_text())
+
+
+class DatabaseCacheTests(TestCase):
+
+    def test_get_many_reads_every_key_in_one_query(self):
+        cache.set_many({'a': 1, 'b': [2]})
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.get_many(['a', 'b', 'missing']), {'a': 1, 'b': [2]})
+
+    def test_get_many_drops_the_expired_keys(self):
+        cache.set('expired', 1, -1)
+        cache.set('fresh', 2)
+        self.assertEqual(cache.get_many(['expired', 'fresh']), {'fresh': 2})
+        self.assertFalse(cache.has_key('expired'))
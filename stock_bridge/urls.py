@@ -5,9 +5,9 @@ from django.conf.urls.static import static
 from django.contrib.auth.views import LogoutView
 from django.views.generic import RedirectView
 
-from .views import HomeView, instruction_view
+from .views import HomeView, instruction_view, request_metrics_view
 from accounts.views import RegisterView, LoginView, LeaderBoardView, ProfileView, NewsView
-from market.views import UserTransactionHistoryView
+from market.views import UserTransactionHistoryView, UserTransactionHistoryExportView
 
 
 urlpatterns = [
@@ -24,6 +24,8 @@ urlpatterns = [
     url(r'^instructions/$', instruction_view, name='instructions'),
     url(r'^stocks/', include('market.urls', namespace='market')),
     url(r'^history/$', UserTransactionHistoryView.as_view(), name='transaction_history'),
+    url(r'^history/export/$', UserTransactionHistoryExportView.as_view(), name='transaction_history_export'),
+    url(r'^metrics/$', request_metrics_view, name='metrics'),
     url(r'^admin/', admin.site.urls),
 ]
 
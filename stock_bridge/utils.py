@@ -1,4 +1,5 @@
 import random
+import secrets
 import string
 
 
@@ -6,12 +7,9 @@ def random_string_generator(size=10, chars=string.ascii_lowercase + string.digit
     return ''.join(random.choice(chars) for _ in range(size))
 
 
-def unique_key_generator(instance):
-    size = random.randint(30, 45)
-    new_key = random_string_generator(size=size)
-
-    Klass = instance.__class__
-    qs_exists = Klass.objects.filter(key=new_key).exists()
-    if qs_exists:
-        return unique_key_generator(instance)
-    return new_key
+def secure_key_generator(nbytes=32):
+    """
+    URL-safe key made of 'nbytes' random bytes from the secrets module (43 characters for 32 bytes).
+    Uniqueness is left to a unique index: a collision is practically impossible, and it is retried on insert.
+    """
+    return secrets.token_urlsafe(nbytes)
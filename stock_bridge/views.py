@@ -1,9 +1,15 @@
+from django.http import Http404, HttpResponse
 from django.shortcuts import render
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
 from django.views.generic import View
 
+from .cache import cache_page_for_anonymous
+from .middleware import REQUEST_METRICS, REQUEST_METRICS_TOKEN, prometheus_text
 from .mixins import CountNewsMixin
 
 
+@method_decorator(cache_page_for_anonymous, name='dispatch')
 class HomeView(CountNewsMixin, View):
 
     def get(self, request, *args, **kwargs):
@@ -13,5 +19,19 @@ class HomeView(CountNewsMixin, View):
         return render(request, 'home.html', {})
 
 
+@cache_page_for_anonymous
 def instruction_view(request):
     return render(request, 'instructions.html', {})
+
+
+def request_metrics_view(request):
+    """ Request metrics of this process in the Prometheus text format, for superusers or a scraper with the token """
+    if not REQUEST_METRICS:
+        raise Http404
+    token = request.META.get('HTTP_AUTHORIZATION', '')
+    authorized = REQUEST_METRICS_TOKEN and constant_time_compare(token, 'Bearer {token}'.format(
+        token=REQUEST_METRICS_TOKEN
+    ))
+    if not (authorized or (request.user.is_authenticated and request.user.is_superuser)):
+        return HttpResponse(status=403)
+    return HttpResponse(prometheus_text(), content_type='text/plain; version=0.0.4; charset=utf-8')